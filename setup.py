@@ -42,10 +42,12 @@ setup(
     install_requires=reqs,
     extras_require={
         "CLI": ["clint>=0.3.0"],
+        "msgpack": ["msgpack-python"],
     },
     entry_points="""
     [console_scripts]
     zooky = zktools.locking:lock_cli [CLI]
+    zktools-bench = zktools.bench:main
 
     """
 )
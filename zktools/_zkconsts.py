@@ -0,0 +1,120 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Constants and exceptions of the Zookeeper Python binding
+
+Used in place of the ``zookeeper`` module when the binding isn't
+installed, so that :mod:`zktools.testing` can stand in for Zookeeper
+without it. The values match those of the binding.
+
+"""
+
+# Return codes
+OK = 0
+SYSTEMERROR = -1
+RUNTIMEINCONSISTENCY = -2
+DATAINCONSISTENCY = -3
+CONNECTIONLOSS = -4
+MARSHALLINGERROR = -5
+UNIMPLEMENTED = -6
+OPERATIONTIMEOUT = -7
+BADARGUMENTS = -8
+INVALIDSTATE = -9
+APIERROR = -100
+NONODE = -101
+NOAUTH = -102
+BADVERSION = -103
+NOCHILDRENFOREPHEMERALS = -108
+NODEEXISTS = -110
+NOTEMPTY = -111
+SESSIONEXPIRED = -112
+INVALIDCALLBACK = -113
+INVALIDACL = -114
+AUTHFAILED = -115
+CLOSING = -116
+NOTHING = -117
+SESSIONMOVED = -118
+
+# Node creation flags
+EPHEMERAL = 1
+SEQUENCE = 2
+
+# Permissions
+PERM_READ = 1
+PERM_WRITE = 2
+PERM_CREATE = 4
+PERM_DELETE = 8
+PERM_ADMIN = 16
+PERM_ALL = 31
+
+# Watch event types
+CREATED_EVENT = 1
+DELETED_EVENT = 2
+CHANGED_EVENT = 3
+CHILD_EVENT = 4
+SESSION_EVENT = -1
+NOTWATCHING_EVENT = -2
+
+# Connection states
+EXPIRED_SESSION_STATE = -112
+AUTH_FAILED_STATE = -113
+CONNECTING_STATE = 1
+ASSOCIATING_STATE = 2
+CONNECTED_STATE = 3
+
+
+class ZooKeeperException(Exception):
+    pass
+
+
+_messages = {}
+
+
+def _error(code, name, message):
+    """Define the exception of a return code"""
+    _messages[code] = message
+    exception = type(name, (ZooKeeperException,), {})
+    exception.__module__ = __name__
+    globals()[name] = exception
+
+
+for _code, _name, _message in [
+        (SYSTEMERROR, 'SystemErrorException', 'system error'),
+        (RUNTIMEINCONSISTENCY, 'RuntimeInconsistencyException',
+         'run time inconsistency'),
+        (DATAINCONSISTENCY, 'DataInconsistencyException',
+         'data inconsistency'),
+        (CONNECTIONLOSS, 'ConnectionLossException', 'connection loss'),
+        (MARSHALLINGERROR, 'MarshallingErrorException',
+         'marshalling error'),
+        (UNIMPLEMENTED, 'UnimplementedException', 'unimplemented'),
+        (OPERATIONTIMEOUT, 'OperationTimeoutException',
+         'operation timeout'),
+        (BADARGUMENTS, 'BadArgumentsException', 'bad arguments'),
+        (INVALIDSTATE, 'InvalidStateException',
+         'invalid zhandle state'),
+        (APIERROR, 'ApiErrorException', 'api error'),
+        (NONODE, 'NoNodeException', 'no node'),
+        (NOAUTH, 'NoAuthException', 'not authenticated'),
+        (BADVERSION, 'BadVersionException', 'bad version'),
+        (NOCHILDRENFOREPHEMERALS, 'NoChildrenForEphemeralsException',
+         'no children for ephemerals'),
+        (NODEEXISTS, 'NodeExistsException', 'node exists'),
+        (NOTEMPTY, 'NotEmptyException', 'not empty'),
+        (SESSIONEXPIRED, 'SessionExpiredException', 'session expired'),
+        (INVALIDCALLBACK, 'InvalidCallbackException',
+         'invalid callback'),
+        (INVALIDACL, 'InvalidACLException', 'invalid acl'),
+        (AUTHFAILED, 'AuthFailedException', 'authentication failed'),
+        (CLOSING, 'ClosingException', 'zookeeper is closing'),
+        (NOTHING, 'NothingException', '(not error) no server responses '
+         'to process'),
+        (SESSIONMOVED, 'SessionMovedException', 'session moved to another '
+         'server, so operation is ignored')]:
+    _error(_code, _name, _message)
+del _code, _name, _message
+
+
+def zerror(code):
+    """Return the message of a return code"""
+    return _messages.get(code, 'unknown error')
@@ -0,0 +1,475 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Zookeeper Locks for asyncio
+
+This module provides :class:`AsyncioZkLock`, :class:`AsyncioZkReadLock` and
+:class:`AsyncioZkWriteLock`, which implement the same locking recipe as
+:class:`~zktools.locking.ZkLock` and the shared read/write locks, but are
+driven entirely by Zookeeper completion callbacks that are handed to an
+asyncio event loop with ``call_soon_threadsafe``. Waiting for a lock costs
+a future rather than a thread, and the lock nodes are compatible with the
+threaded lock classes using the same lock name.
+
+Example::
+
+    import trollius as asyncio
+    from trollius import From
+    from zc.zk import ZooKeeper
+    from zktools.aio import AsyncioZkLock
+
+    conn = ZooKeeper()
+    lock = AsyncioZkLock(conn, 'my_lock_name')
+
+    @asyncio.coroutine
+    def work():
+        acquired = yield From(lock.acquire(timeout=2))
+        if acquired:
+            try:
+                # do something with the lock
+            finally:
+                yield From(lock.release())
+
+Like the threaded locks, ``acquire`` takes a ``priority`` class, see
+:mod:`zktools.locking`.
+
+.. note::
+
+    Requires Python's ``asyncio`` module, or ``trollius`` on Python 2.
+    The locks are also asynchronous context managers, for ``async with``
+    on Python versions that have it.
+
+"""
+import uuid
+
+try:
+    import zookeeper
+except ImportError:  # pragma: nocover
+    from zktools import _zkconsts as zookeeper
+
+from zktools.locking import LockQueue
+from zktools.locking import ZOO_OPEN_ACL_UNSAFE
+from zktools.locking import _candidate_name
+from zktools.locking import has_read_lock
+from zktools.locking import has_write_lock
+from zktools.locking import retryable
+from zktools.util import DEFAULT_RETRY_POLICY
+from zktools.util import add_known_path
+from zktools.util import forget_path
+from zktools.util import is_known_path
+
+try:
+    import asyncio
+except ImportError:  # pragma: nocover
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+__all__ = ['AsyncioZkLock', 'AsyncioZkReadLock', 'AsyncioZkWriteLock']
+
+
+def _ignore(*args):
+    """Completion for requests whose result doesn't matter"""
+
+
+class _Attempt(object):
+    """State of a single lock acquisition"""
+    def __init__(self, future, prefix, node_name, started):
+        self.future = future
+        self.prefix = prefix
+        self.node_name = node_name
+        self.started = started
+        self.timer = None
+        self.retries = None
+        # Candidates told they're outranked by ours
+        self.notified = set()
+
+
+class AsyncioZkLock(object):
+    """asyncio Zookeeper Lock
+
+    All methods must be called from the thread running the event loop,
+    and the futures they return resolve on that loop.
+
+    """
+    _node_name = 'lock'
+    _has_lock = staticmethod(has_write_lock)
+
+    def __init__(self, connection, lock_name, lock_root='/ZktoolsLocks',
+                 loop=None, retry_policy=None):
+        """Create an asyncio Zookeeper Lock
+
+        :param connection: Zookeeper connection object
+        :type connection: zc.zk Zookeeper instance
+        :param lock_name: Path to the lock node that should be used
+        :param lock_root: Path to the root lock node to create the locks
+                          under
+        :type lock_root: string
+        :param loop: Event loop to resolve futures on, defaults to the
+                     current event loop when the lock is acquired
+        :param retry_policy: Policy to retry requests with after
+                             connection loss. When it gives up, the
+                             acquisition fails with an exception.
+        :type retry_policy: :class:`~zktools.util.RetryPolicy`
+
+        """
+        if asyncio is None:  # pragma: nocover
+            raise ImportError("asyncio or trollius is required for "
+                              "zktools.aio")
+        self._zk = connection
+        self._loop = loop
+        self._retry_policy = retry_policy or DEFAULT_RETRY_POLICY
+        self._lock_root = lock_root
+        self._locknode = '%s/%s' % (lock_root, lock_name)
+        self._attempt = None
+        self._candidate_path = None
+        self._acquired = False
+        self._revoked = False
+
+    def __aenter__(self):
+        """Asynchronous context manager interface, waits for the lock
+
+        Used by ``async with`` on Python versions that have it, see the
+        module documentation for the ``trollius`` form.
+
+        """
+        return self.acquire()
+
+    def __aexit__(self, exc_type, exc_value, traceback):
+        """Asynchronous context manager interface, releases the lock"""
+        done = asyncio.Future(loop=self._loop)
+        self.release().add_done_callback(
+            lambda future: done.set_result(None))
+        return done
+
+    @property
+    def acquired(self):
+        """Attribute indicating whether the lock has been acquired"""
+        return self._acquired
+
+    @property
+    def revoked(self):
+        """Indicate if this lock has been revoked
+
+        :returns: True if the lock has been revoked, False otherwise.
+        :rtype: bool
+
+        """
+        return self._revoked
+
+    def acquire(self, timeout=None, priority=0):
+        """Acquire the lock
+
+        :param timeout: How long to wait to acquire the lock, defaults to
+                        waiting forever.
+        :type timeout: int
+        :param priority: Priority class of the candidate, waiting
+                         candidates of a lower class give way to it, see
+                         :class:`~zktools.locking.ZkLock`.
+        :type priority: int
+        :returns: A future that resolves to True if the lock was acquired,
+                  or False if the timeout expired. Cancelling the future
+                  abandons the acquisition.
+        :rtype: :class:`asyncio.Future`
+
+        """
+        if self._attempt is not None or self._acquired:
+            raise Exception("Lock already acquired or being acquired")
+        node_name = _candidate_name(self._node_name, priority)
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+
+        future = asyncio.Future(loop=self._loop)
+        attempt = self._attempt = _Attempt(future, uuid.uuid4().hex,
+                                           node_name, self._loop.time())
+        self._revoked = False
+        future.add_done_callback(lambda f: self._acquire_done(attempt))
+        if timeout is not None:
+            attempt.timer = self._loop.call_later(
+                timeout, self._finish, attempt, False)
+
+        if is_known_path(self._zk, self._locknode):
+            self._create_candidate(attempt)
+        else:
+            self._create_lock_dir(attempt, self._lock_root)
+        return future
+
+    def release(self):
+        """Release the lock
+
+        :returns: A future that resolves to True if the lock was released,
+                  or False if it is no longer valid.
+        :rtype: :class:`asyncio.Future`
+
+        """
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        future = asyncio.Future(loop=self._loop)
+        if self._attempt is not None:
+            # Abandon an acquisition in progress
+            attempt, self._attempt = self._attempt, None
+            attempt.future.cancel()
+        path, self._candidate_path = self._candidate_path, None
+        self._acquired = False
+        if path is None:
+            future.set_result(False)
+        else:
+            self._delete(path, future)
+        return future
+
+    def _call(self, method, *args):
+        """Run a completion callback on the event loop"""
+        loop = self._loop
+
+        def completion(*results):
+            loop.call_soon_threadsafe(method, *(args + results))
+        return completion
+
+    def _live(self, attempt):
+        return attempt is self._attempt and not attempt.future.done()
+
+    def _finish(self, attempt, acquired, error=None):
+        if not self._live(attempt):
+            return
+        if error is not None:
+            attempt.future.set_exception(error)
+        else:
+            attempt.future.set_result(acquired)
+
+    def _acquire_done(self, attempt):
+        """Clean up after an acquisition is resolved"""
+        if attempt.timer is not None:
+            attempt.timer.cancel()
+        if attempt is not self._attempt:
+            # Released while in progress
+            return
+        self._attempt = None
+        acquired = not attempt.future.cancelled() and \
+            attempt.future.exception() is None and attempt.future.result()
+        if acquired:
+            self._acquired = True
+        elif self._candidate_path is not None:
+            # Remove ourselves from the lock queue
+            path, self._candidate_path = self._candidate_path, None
+            self._delete(path, None)
+
+    def _retry(self, attempt, return_code, action, func, *args):
+        """Call func again after the retry policy's backoff, or fail the
+        acquisition"""
+        if attempt.retries is None:
+            attempt.retries = self._retry_policy.start()
+        delay = attempt.retries.next_delay()
+        if delay is None:
+            self._error(attempt, return_code, action)
+        else:
+            self._loop.call_later(delay, func, *args)
+
+    def _delete(self, path, future, retries=None):
+        self._zk.adelete(path, -1, self._call(self._delete_callback, path,
+                                              future, retries))
+
+    def _delete_callback(self, path, future, retries, handle, return_code):
+        if retryable(return_code):
+            retries = retries or self._retry_policy.start()
+            delay = retries.next_delay()
+            if delay is not None:
+                self._loop.call_later(delay, self._delete, path, future,
+                                      retries)
+                return
+        if future is not None and not future.done():
+            future.set_result(return_code == zookeeper.OK)
+
+    def _create_lock_dir(self, attempt, path):
+        self._zk.acreate(path, "zktools ZLock dir", [ZOO_OPEN_ACL_UNSAFE], 0,
+                         self._call(self._lock_dir_callback, attempt, path))
+
+    def _lock_dir_callback(self, attempt, path, handle, return_code,
+                           value=None):
+        if not self._live(attempt):
+            return
+        if retryable(return_code):
+            self._retry(attempt, return_code, 'Lock node creation',
+                        self._create_lock_dir, attempt, path)
+        elif return_code not in (zookeeper.OK, zookeeper.NODEEXISTS):
+            self._error(attempt, return_code, 'Lock node creation')
+        elif path != self._locknode:
+            self._create_lock_dir(attempt, self._locknode)
+        else:
+            add_known_path(self._zk, self._locknode)
+            self._create_candidate(attempt)
+
+    def _create_candidate(self, attempt):
+        name = '%s/%s-%s' % (self._locknode, attempt.prefix,
+                             attempt.node_name[1:])
+        self._zk.acreate(name, "0", [ZOO_OPEN_ACL_UNSAFE],
+                         zookeeper.EPHEMERAL | zookeeper.SEQUENCE,
+                         self._call(self._candidate_callback, attempt))
+
+    def _candidate_callback(self, attempt, handle, return_code, value=None):
+        if return_code == zookeeper.OK:
+            if attempt is not self._attempt:
+                # Abandoned while the node was being created
+                self._delete(value, None)
+                return
+            self._candidate_path = value
+            self._watch_candidate(value)
+            self._check(attempt)
+        elif not self._live(attempt):
+            return
+        elif return_code == zookeeper.NONODE:
+            # The lock node was removed, create it again
+            forget_path(self._zk, self._locknode)
+            self._create_lock_dir(attempt, self._lock_root)
+        elif retryable(return_code):
+            # Find out whether the node was created before retrying
+            self._zk.aget_children(
+                self._locknode, None,
+                self._call(self._find_candidate_callback, attempt))
+        else:
+            self._error(attempt, return_code, 'Candidate creation')
+
+    def _find_candidate_callback(self, attempt, handle, return_code,
+                                 children=None):
+        if not self._live(attempt):
+            return
+        if retryable(return_code):
+            self._retry(attempt, return_code, 'Check children for prefix',
+                        self._candidate_callback, attempt, None, return_code)
+        elif return_code != zookeeper.OK:
+            self._error(attempt, return_code, 'Check children for prefix')
+        else:
+            child = LockQueue(children).find_prefix(attempt.prefix)
+            if child is None:
+                self._create_candidate(attempt)
+            else:
+                self._candidate_callback(attempt, handle, zookeeper.OK,
+                                         '%s/%s' % (self._locknode, child))
+
+    def _watch_candidate(self, path):
+        """Watch our candidate node for revocation requests"""
+        self._zk.aget(path, self._call(self._revoke_watcher, path),
+                      self._call(self._revoke_callback, path))
+
+    def _revoke_callback(self, path, handle, return_code, value=None,
+                         stat=None):
+        if path != self._candidate_path:
+            return
+        if return_code == zookeeper.NONODE or value == 'unlock':
+            self._revoked = True
+
+    def _revoke_watcher(self, path, handle, type, state, watched_path):
+        if path != self._candidate_path:
+            return
+        if type == zookeeper.CHANGED_EVENT:
+            self._watch_candidate(path)
+        elif type == zookeeper.DELETED_EVENT or \
+                state == zookeeper.EXPIRED_SESSION_STATE:
+            self._revoked = True
+
+    def _check(self, attempt):
+        """Check whether our candidate is at the head of the queue"""
+        self._zk.aget_children(self._locknode, None,
+                               self._call(self._check_callback, attempt))
+
+    def _check_callback(self, attempt, handle, return_code, children=None):
+        if not self._live(attempt):
+            return
+        if retryable(return_code):
+            self._retry(attempt, return_code, 'Check candidate nodes',
+                        self._check, attempt)
+            return
+        elif return_code != zookeeper.OK:
+            self._error(attempt, return_code, 'Check candidate nodes')
+            return
+
+        queue = LockQueue(children)
+        keyname = self._candidate_path.rsplit('/', 1)[-1]
+        if keyname not in queue:
+            # Session trouble removed our node, start over
+            self._candidate_path = None
+            self._create_candidate(attempt)
+            return
+
+        acquired, blocking_nodes = self._has_lock(
+            keyname, queue, self._loop.time() - attempt.started)
+        if acquired:
+            self._finish(attempt, True)
+            return
+
+        if queue.index(blocking_nodes[0]) > queue.index(keyname):
+            # Give way to the candidates of a higher priority queued
+            # after ours, by queueing again behind them
+            path, self._candidate_path = self._candidate_path, None
+            attempt.prefix = uuid.uuid4().hex
+            self._create_candidate(attempt)
+            self._delete(path, None)
+            return
+
+        self._notify_outranked(attempt, keyname, queue)
+
+        # Watch the closest blocking node for its removal
+        prior_node = '%s/%s' % (self._locknode, blocking_nodes[-1])
+        self._zk.aexists(prior_node, self._call(self._prior_watcher, attempt),
+                         self._call(self._prior_callback, attempt))
+
+    def _notify_outranked(self, attempt, keyname, queue):
+        """Tell the waiting candidates queued before ours that give way to
+        it, as threaded locks may take the lock over without listing the
+        queue again"""
+        for name in queue.outranked(keyname):
+            if name in attempt.notified:
+                continue
+            attempt.notified.add(name)
+            # Only candidates with untouched data, so that requests to
+            # release aren't overwritten
+            self._zk.aset('%s/%s' % (self._locknode, name), 'outranked', 0,
+                          _ignore)
+
+    def _prior_callback(self, attempt, handle, return_code, stat=None):
+        if not self._live(attempt):
+            return
+        if return_code == zookeeper.NONODE:
+            # Gone already, check the queue again
+            self._check(attempt)
+        elif retryable(return_code):
+            self._retry(attempt, return_code, 'Watch prior node',
+                        self._check, attempt)
+        elif return_code != zookeeper.OK:
+            self._error(attempt, return_code, 'Watch prior node')
+        # Node still exists, wait for the watcher
+
+    def _prior_watcher(self, attempt, handle, type, state, path):
+        if type != zookeeper.SESSION_EVENT and self._live(attempt):
+            self._check(attempt)
+
+    def _error(self, attempt, return_code, action):
+        self._finish(attempt, False, Exception(
+            "%s failed: %s" % (action, zookeeper.zerror(return_code))))
+
+
+class AsyncioZkReadLock(AsyncioZkLock):
+    """asyncio Shared Zookeeper Read Lock
+
+    A read-lock is considered successful if there are no active write
+    locks. It is compatible with :class:`~zktools.locking.ZkReadLock`.
+
+    This class takes the same initialization parameters as
+    :class:`AsyncioZkLock`.
+
+    """
+    _node_name = 'read'
+    _has_lock = staticmethod(has_read_lock)
+
+
+class AsyncioZkWriteLock(AsyncioZkLock):
+    """asyncio Shared Zookeeper Write Lock
+
+    A write-lock is only successful if there are no read or write locks
+    active. It is compatible with :class:`~zktools.locking.ZkWriteLock`.
+
+    This class takes the same initialization parameters as
+    :class:`AsyncioZkLock`.
+
+    """
+    _node_name = 'write'
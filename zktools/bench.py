@@ -0,0 +1,539 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Lock Benchmarks
+
+This module measures how the `zktools` locks perform under contention. A
+number of threads, optionally in several processes, repeatedly acquire
+and release a set of lock names, and the benchmark reports:
+
+* acquisitions per second
+* the 50th, 99th and 99.9th percentile of the time taken to acquire a lock
+* Zookeeper requests sent per acquisition
+* the peak number of threads in the process, and the number of
+  :class:`~zktools.util.Dispatcher` workers
+
+With ``--herd``, the benchmark instead queues a number of readers behind
+a write lock, releases it, and reports the Zookeeper requests sent and
+the time taken to admit the readers.
+
+With ``--decode``, the benchmark instead converts a sample of node values
+with :class:`~zktools.node.ZkNode` value decoding, and with the prior
+decoding that tried a regular expression per type in turn, and
+reports the values converted per second by each.
+
+The benchmark runs against an in-memory Zookeeper from
+:mod:`zktools.testing` by default, which can be given a simulated
+latency, or against a real Zookeeper ensemble with ``--host``.
+
+Usage:
+
+.. code-block:: bash
+
+    $ zktools-bench --threads 8 --locks 2 --latency 1
+    CLASS   ACQ/S    P50 MS   P99 MS   P999 MS  OPS/ACQ  THREADS
+    lock    812.3    9.102    18.331   21.540   6.1      20
+    read    ...
+
+    $ zktools-bench --host localhost:2181 --processes 4 -c write --json
+
+    $ zktools-bench --herd 200 --connections 200 --latency 1
+    READERS  ADMIT MS  P50 MS   MAX MS   OPS/ADMISSION
+    200      ...
+
+    $ zktools-bench --decode 100000
+    DECODER    VALUES/S    SPEEDUP
+    regexes    ...
+
+"""
+import datetime
+import decimal
+import json
+import math
+import multiprocessing
+import re
+import sys
+import threading
+import time
+import uuid
+from optparse import OptionParser
+
+from zktools.locking import ZOO_OPEN_ACL_UNSAFE
+from zktools.locking import ZkAsyncLock
+from zktools.locking import ZkLock
+from zktools.locking import ZkReadLock
+from zktools.locking import ZkWriteLock
+from zktools.node import _load_value
+from zktools.util import get_dispatcher
+
+__all__ = ['CountingConnection', 'run_benchmark', 'run_reader_herd',
+           'run_decode_benchmark', 'main']
+
+# Asynchronous connection methods are counted as their synchronous
+# operation
+OPERATIONS = {
+    'create': 'create', 'acreate': 'create',
+    'delete': 'delete', 'adelete': 'delete',
+    'get': 'get', 'aget': 'get',
+    'set': 'set', 'aset': 'set',
+    'exists': 'exists', 'aexists': 'exists',
+    'get_children': 'get_children', 'aget_children': 'get_children',
+}
+
+
+class CountingConnection(object):
+    """Zookeeper connection wrapper counting the requests sent"""
+    def __init__(self, connection):
+        self._connection = connection
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def __getattr__(self, name):
+        value = getattr(self._connection, name)
+        operation = OPERATIONS.get(name)
+        if operation is None:
+            return value
+
+        def counted(*args, **kwargs):
+            with self._lock:
+                self.counts[operation] = self.counts.get(operation, 0) + 1
+            return value(*args, **kwargs)
+        return counted
+
+    def reset(self):
+        with self._lock:
+            self.counts = {}
+
+
+def _sync_lock(lock_class):
+    def make(connection, name, lock_root):
+        lock = lock_class(connection, name, lock_root=lock_root)
+        return lock.acquire, lock.release
+    return make
+
+
+def _async_lock(connection, name, lock_root):
+    lock = ZkAsyncLock(connection, name, lock_root=lock_root)
+
+    def acquire():
+        lock.acquire()
+        lock.wait_for_acquire()
+
+    def release():
+        lock.release()
+        lock.wait_for_release()
+    return acquire, release
+
+
+# Functions creating the acquire and release functions of a lock
+LOCK_CLASSES = {
+    'lock': _sync_lock(ZkLock),
+    'read': _sync_lock(ZkReadLock),
+    'write': _sync_lock(ZkWriteLock),
+    'async': _async_lock,
+}
+LOCK_CLASS_ORDER = ['lock', 'read', 'write', 'async']
+
+
+def percentile(values, fraction):
+    """Return a percentile of sorted values, using the nearest rank"""
+    if not values:
+        return 0.0
+    rank = int(math.ceil(fraction * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def _connect(options, server):
+    if options.host:
+        from zc.zk import ZooKeeper
+        return ZooKeeper(options.host)
+    from zktools.testing import FakeZooKeeper
+    return FakeZooKeeper(server, latency=options.latency / 1000.0)
+
+
+def _run_threads(options, lock_class, lock_root, server=None):
+    """Run the benchmark threads of one process, returning the acquire
+    latencies and request counts"""
+    connections = [CountingConnection(_connect(options, server))
+                   for x in range(options.connections)]
+    make_lock = LOCK_CLASSES[lock_class]
+    names = ['lock%d' % x for x in range(options.locks)]
+    latencies = []
+    errors = []
+    running = threading.Event()
+    running.set()
+    peak_threads = [threading.active_count()]
+
+    def worker(index):
+        connection = connections[index % len(connections)]
+        locks = [make_lock(connection, name, lock_root) for name in names]
+        times = []
+        try:
+            for count in range(options.count):
+                acquire, release = locks[(index + count) % len(locks)]
+                start = time.time()
+                acquire()
+                times.append(time.time() - start)
+                if options.hold:
+                    time.sleep(options.hold / 1000.0)
+                release()
+        except Exception as exc:
+            errors.append(repr(exc))
+        latencies.extend(times)
+
+    def sample_threads():
+        while running.is_set():
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+            time.sleep(0.005)
+
+    # Create the lock nodes before starting the clock
+    connections[0].create_recursive(lock_root, '', [ZOO_OPEN_ACL_UNSAFE])
+    for name in names:
+        make_lock(connections[0], name, lock_root)
+    for connection in connections:
+        connection.reset()
+
+    sampler = threading.Thread(target=sample_threads)
+    sampler.daemon = True
+    sampler.start()
+    threads = [threading.Thread(target=worker, args=(index,))
+               for index in range(options.threads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+    running.clear()
+    sampler.join()
+
+    counts = {}
+    for connection in connections:
+        for operation, count in connection.counts.items():
+            counts[operation] = counts.get(operation, 0) + count
+    if options.host:
+        try:
+            connections[0].delete_recursive(lock_root, force=True)
+        except Exception:
+            pass
+    for connection in connections:
+        connection.close()
+    return dict(latencies=latencies, duration=duration, ops=counts,
+                errors=errors, peak_threads=peak_threads[0],
+                dispatcher_workers=get_dispatcher().stats()['workers'])
+
+
+def _process_main(options, lock_class, lock_root, results):
+    results.put(_run_threads(options, lock_class, lock_root))
+
+
+def run_benchmark(options, lock_class):
+    """Benchmark a lock class, returning a dict of results
+
+    :param options: Benchmark options, as parsed by :func:`main`
+    :param lock_class: Name of the lock class, one of ``lock``, ``read``,
+                       ``write`` or ``async``
+    :type lock_class: str
+
+    """
+    lock_root = '/ZktoolsBench/%s' % uuid.uuid4().hex
+    if options.processes > 1:
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(
+                     target=_process_main,
+                     args=(options, lock_class, lock_root, queue))
+                     for x in range(options.processes)]
+        for process in processes:
+            process.start()
+        runs = [queue.get() for process in processes]
+        for process in processes:
+            process.join()
+    else:
+        from zktools.testing import FakeZooKeeperServer
+        runs = [_run_threads(options, lock_class, lock_root,
+                             FakeZooKeeperServer())]
+
+    latencies = sorted(latency for run in runs
+                       for latency in run['latencies'])
+    duration = max(run['duration'] for run in runs)
+    ops = {}
+    for run in runs:
+        for operation, count in run['ops'].items():
+            ops[operation] = ops.get(operation, 0) + count
+    acquisitions = len(latencies)
+    return dict(
+        lock_class=lock_class,
+        backend=options.host or 'fake',
+        processes=options.processes,
+        threads=options.threads,
+        connections=options.connections,
+        locks=options.locks,
+        acquisitions=acquisitions,
+        duration=duration,
+        acquisitions_per_sec=duration and acquisitions / duration or 0.0,
+        latency_ms=dict(
+            p50=percentile(latencies, 0.5) * 1000,
+            p99=percentile(latencies, 0.99) * 1000,
+            p999=percentile(latencies, 0.999) * 1000,
+            max=latencies and latencies[-1] * 1000 or 0.0),
+        ops=ops,
+        ops_per_acquisition=acquisitions and
+        float(sum(ops.values())) / acquisitions or 0.0,
+        peak_threads=max(run['peak_threads'] for run in runs),
+        dispatcher_workers=max(run['dispatcher_workers'] for run in runs),
+        errors=[error for run in runs for error in run['errors']],
+    )
+
+
+def run_reader_herd(options):
+    """Queue readers behind a write lock and measure admitting them,
+    returning a dict of results
+
+    Each of the ``options.herd`` readers waits in its own thread, spread
+    over ``options.connections`` Zookeeper sessions. Only the requests
+    sent from the moment the writer releases until the last reader has
+    the lock are counted.
+
+    :param options: Benchmark options, as parsed by :func:`main`
+
+    """
+    server = None
+    if not options.host:
+        from zktools.testing import FakeZooKeeperServer
+        server = FakeZooKeeperServer()
+    lock_root = '/ZktoolsBench/%s' % uuid.uuid4().hex
+    connections = [CountingConnection(_connect(options, server))
+                   for x in range(min(options.connections, options.herd))]
+    connections[0].create_recursive(lock_root, '', [ZOO_OPEN_ACL_UNSAFE])
+    writer = ZkWriteLock(connections[0], 'herd', lock_root=lock_root)
+    writer.acquire()
+
+    readers = [ZkReadLock(connections[x % len(connections)], 'herd',
+                          lock_root=lock_root) for x in range(options.herd)]
+    admitted = []
+    errors = []
+    done = threading.Event()
+    leave = threading.Event()
+    released = [None]
+
+    def reader(lock):
+        try:
+            lock.acquire()
+        except Exception as exc:
+            errors.append(repr(exc))
+        admitted.append(time.time() - released[0])
+        if len(admitted) == len(readers):
+            done.set()
+        leave.wait()
+        lock.release()
+
+    threads = [threading.Thread(target=reader, args=(lock,))
+               for lock in readers]
+    for thread in threads:
+        thread.start()
+
+    # Wait for every reader to queue up before releasing the writer
+    locknode = '%s/herd' % lock_root
+    raw = connections[0]._connection
+    while len(raw.get_children(locknode)) < len(readers) + 1:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    for connection in connections:
+        connection.reset()
+    released[0] = time.time()
+    writer.release()
+    done.wait()
+    duration = time.time() - released[0]
+
+    counts = {}
+    for connection in connections:
+        for operation, count in connection.counts.items():
+            counts[operation] = counts.get(operation, 0) + count
+    leave.set()
+    for thread in threads:
+        thread.join()
+    if options.host:
+        try:
+            raw.delete_recursive(lock_root, force=True)
+        except Exception:
+            pass
+    for connection in connections:
+        connection.close()
+
+    latencies = sorted(admitted)
+    return dict(
+        backend=options.host or 'fake',
+        readers=len(readers),
+        connections=len(connections),
+        duration=duration,
+        latency_ms=dict(
+            p50=percentile(latencies, 0.5) * 1000,
+            p99=percentile(latencies, 0.99) * 1000,
+            max=latencies and latencies[-1] * 1000 or 0.0),
+        ops=counts,
+        ops_per_admission=float(sum(counts.values())) / len(readers),
+        errors=errors,
+    )
+
+
+# Node values typical of a configuration tree
+DECODE_SAMPLES = [
+    '8080', '0.25', 'true', 'False', 'None', 'localhost', '/var/log/app',
+    '2012-03-04T05:06:07.891011Z', '2012-03-04 05:06:07.8Z', '2012-03-04',
+    '', 'db01.example.com:5432', '1500', 'http://example.com/', '3.14159',
+]
+
+
+# The conversions node values were decoded with, an expression per type
+_CONVERSIONS = {
+    re.compile(r'^\d+\.\d+$'): decimal.Decimal,
+    re.compile(r'^\d+$'): int,
+    re.compile(r'^true$', re.IGNORECASE): lambda x: True,
+    re.compile(r'^false$', re.IGNORECASE): lambda x: False,
+    re.compile(r'^None$', re.IGNORECASE): lambda x: None,
+    re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d+Z$'):
+        lambda x: datetime.datetime.strptime(x, '%Y-%m-%dT%H:%M:%S.%fZ'),
+    re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d+Z$'):
+        lambda x: datetime.datetime.strptime(x, '%Y-%m-%d %H:%M:%S.%fZ'),
+    re.compile(r'^\d{4}-\d{2}-\d{2}$'):
+        lambda x: datetime.datetime.strptime(x, '%Y-%m-%d'),
+}
+
+
+def _regexes_load_value(value):
+    """Value decoding before the single expression, for comparison"""
+    for regex, convert in _CONVERSIONS.iteritems():
+        if regex.match(value):
+            return convert(value)
+    return value
+
+
+def run_decode_benchmark(options):
+    """Measure converting node values, returning a dict of results
+
+    ``options.decode`` values are taken in turn from
+    :obj:`DECODE_SAMPLES` and converted by each decoder.
+
+    :param options: Benchmark options, as parsed by :func:`main`
+
+    """
+    values = [DECODE_SAMPLES[x % len(DECODE_SAMPLES)]
+              for x in range(options.decode)]
+    mismatches = [value for value in DECODE_SAMPLES
+                  if _regexes_load_value(value) != _load_value(value)]
+    rates = {}
+    for name, decoder in [('regexes', _regexes_load_value),
+                          ('compiled', _load_value)]:
+        start = time.time()
+        for value in values:
+            decoder(value)
+        duration = time.time() - start
+        rates[name] = duration and len(values) / duration or 0.0
+    return dict(
+        values=len(values),
+        values_per_sec=rates,
+        speedup=rates['regexes'] and rates['compiled'] / rates['regexes'],
+        mismatches=mismatches,
+    )
+
+
+def _print_decode_results(result, out):
+    columns = '%-10s %-11s %s\n'
+    out.write(columns % ('DECODER', 'VALUES/S', 'SPEEDUP'))
+    rates = result['values_per_sec']
+    out.write(columns % ('regexes', '%.1f' % rates['regexes'], '1.00'))
+    out.write(columns % ('compiled', '%.1f' % rates['compiled'],
+                         '%.2f' % result['speedup']))
+    for value in result['mismatches']:
+        out.write('  mismatch: %r\n' % value)
+
+
+def _print_herd_results(result, out):
+    columns = '%-8s %-9s %-8s %-8s %s\n'
+    out.write(columns % ('READERS', 'ADMIT MS', 'P50 MS', 'MAX MS',
+                         'OPS/ADMISSION'))
+    latency = result['latency_ms']
+    out.write(columns % (
+        result['readers'], '%.3f' % (result['duration'] * 1000),
+        '%.3f' % latency['p50'], '%.3f' % latency['max'],
+        '%.2f' % result['ops_per_admission']))
+    for error in result['errors']:
+        out.write('  error: %s\n' % error)
+
+
+def _print_results(results, out):
+    columns = '%-7s %-9s %-8s %-8s %-8s %-8s %s\n'
+    out.write(columns % ('CLASS', 'ACQ/S', 'P50 MS', 'P99 MS', 'P999 MS',
+                         'OPS/ACQ', 'THREADS'))
+    for result in results:
+        latency = result['latency_ms']
+        out.write(columns % (
+            result['lock_class'], '%.1f' % result['acquisitions_per_sec'],
+            '%.3f' % latency['p50'], '%.3f' % latency['p99'],
+            '%.3f' % latency['p999'],
+            '%.1f' % result['ops_per_acquisition'], result['peak_threads']))
+        for error in result['errors']:
+            out.write('  error: %s\n' % error)
+
+
+def main(argv=None, out=None):
+    """Zktools Lock Benchmark CLI"""
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("--host", dest="host", type="str", default=None,
+                      help="Zookeeper host string, an in-memory Zookeeper "
+                           "is used by default")
+    parser.add_option("--latency", dest="latency", type="float", default=0,
+                      help="Latency of the in-memory Zookeeper, in ms")
+    parser.add_option("-c", "--lock-class", dest="lock_classes",
+                      action="append", choices=LOCK_CLASS_ORDER,
+                      help="Lock class to benchmark, can be given more "
+                           "than once. Defaults to all of them: "
+                           + ', '.join(LOCK_CLASS_ORDER))
+    parser.add_option("-t", "--threads", dest="threads", type="int",
+                      default=4, help="Threads per process")
+    parser.add_option("-p", "--processes", dest="processes", type="int",
+                      default=1, help="Processes, requires --host when "
+                                      "more than 1")
+    parser.add_option("--connections", dest="connections", type="int",
+                      default=1, help="Zookeeper sessions per process")
+    parser.add_option("-l", "--locks", dest="locks", type="int", default=1,
+                      help="Lock names to spread the threads over")
+    parser.add_option("-n", "--count", dest="count", type="int",
+                      default=100, help="Acquisitions per thread")
+    parser.add_option("--hold", dest="hold", type="float", default=0,
+                      help="Time to hold each lock, in ms")
+    parser.add_option("--herd", dest="herd", type="int", default=0,
+                      help="Measure admitting this many readers queued "
+                           "behind a write lock, instead of contention")
+    parser.add_option("--decode", dest="decode", type="int", default=0,
+                      help="Measure converting this many node values, "
+                           "instead of contention")
+    parser.add_option("--json", dest="json", action="store_true",
+                      default=False, help="Print the results as JSON")
+    options, args = parser.parse_args(argv)
+    if options.processes > 1 and not options.host:
+        parser.error("--processes requires a Zookeeper --host")
+    out = out or sys.stdout
+
+    if options.decode:
+        results = [run_decode_benchmark(options)]
+    elif options.herd:
+        results = [run_reader_herd(options)]
+    else:
+        results = [run_benchmark(options, lock_class) for lock_class in
+                   options.lock_classes or LOCK_CLASS_ORDER]
+    if options.json:
+        json.dump(results, out, indent=2, sort_keys=True)
+        out.write('\n')
+    elif options.decode:
+        _print_decode_results(results[0], out)
+    elif options.herd:
+        _print_herd_results(results[0], out)
+    else:
+        _print_results(results, out)
+    return results
+
+
+if __name__ == '__main__':  # pragma: nocover
+    main()
@@ -0,0 +1,307 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Zookeeper Counters
+
+This module provides a :class:`ZkCounter`, a number that any number of
+processes can add to without taking a lock.
+
+The counter is spread over shard nodes under the counter's node, each a
+:class:`~zktools.node.ZkNode` holding part of the total. An increment
+is a single version-checked ``set`` of a shard picked at random. When
+two increments of the same shard collide, the losing one moves on to
+the next shard instead of waiting on the winner, so more shards allow
+more concurrent increments. The value of the counter is the sum of the
+shards, which are kept up to date with data watches and cost nothing to
+read.
+
+Increments can also be added up locally and flushed periodically, which
+takes a single ``set`` for many increments.
+
+Each increment writes a random token to its shard, which keeps the last
+:data:`TOKEN_WINDOW` of them. When the connection is lost before the
+reply to a ``set``, the shard is read again and the token looked for,
+so an increment that went through isn't added twice.
+
+Example::
+
+    from zc.zk import ZooKeeper
+    from zktools.counter import ZkCounter
+
+    conn = ZooKeeper()
+    requests = ZkCounter(conn, '/stats/requests', shards=16)
+
+    requests.add()
+    requests.add(5)
+    print requests.value
+
+"""
+import logging
+import random
+import threading
+import uuid
+
+try:
+    import zookeeper
+except ImportError:  # pragma: nocover
+    from zktools import _zkconsts as zookeeper
+
+from zktools.node import JSON_CODEC
+from zktools.node import ZOO_OPEN_ACL_UNSAFE
+from zktools.node import ZkNode
+from zktools.util import RETRYABLE_ERRORS
+from zktools.util import add_known_path
+from zktools.util import forget_path
+from zktools.util import get_callback_dispatcher
+from zktools.util import is_known_path
+from zktools.util import safe_call
+
+__all__ = ['ZkCounter']
+
+log = logging.getLogger(__name__)
+
+# Number of increment tokens kept by each shard
+TOKEN_WINDOW = 16
+
+
+def _shard_total(value):
+    """Return the amount held by a shard
+
+    Shards written before increments had tokens hold a bare number.
+
+    """
+    if isinstance(value, dict):
+        return value['total']
+    return value
+
+
+def _shard_count(value):
+    """Return the number of increments a shard has tokens for"""
+    if isinstance(value, dict):
+        return value['count']
+    return 0
+
+
+class ZkCounter(object):
+    """Zookeeper Counter
+
+    With a ``flush_interval``, :meth:`add` only adds to a local amount,
+    which is added to the counter in Zookeeper once the interval has
+    passed, on :func:`~zktools.util.get_callback_dispatcher`.
+    :meth:`flush` adds it right away.
+
+    If the connection is lost before the reply to an increment, the
+    shard is read again to find out whether it went through. Without a
+    ``retry_policy`` that read may fail too. :meth:`add` then raises the
+    connection error and the increment may or may not have been added.
+    :meth:`flush` keeps the increment, and checks for it again on the
+    next flush before adding it.
+
+    .. note::
+
+        The number of shards of a counter must not change while it's in
+        use, shards beyond the number a :class:`ZkCounter` was created
+        with are not part of its value.
+
+    .. note::
+
+        If more than :data:`TOKEN_WINDOW` increments were made to the
+        shard before it could be read again, whether the increment went
+        through can't be told. It's then counted as added, and a
+        warning is logged.
+
+    """
+    def __init__(self, connection, path, shards=8, flush_interval=None,
+                 retry_policy=None):
+        """Create a Zookeeper Counter
+
+        The counter's node and its shards are created if missing, the
+        parent node of the counter must exist.
+
+        :param connection: Zookeeper connection object
+        :type connection: zc.zk Zookeeper instance
+        :param path: Path to the counter's node
+        :type path: str
+        :param shards: Number of shard nodes to spread increments over
+        :type shards: int
+        :param flush_interval: Seconds to add up increments locally for
+                               before adding them to the counter, they're
+                               added right away by default.
+        :type flush_interval: float
+        :param retry_policy: Policy to retry reading and setting shards
+                             with after connection loss, connection errors
+                             are raised right away by default.
+        :type retry_policy: :class:`~zktools.util.RetryPolicy`
+
+        """
+        self._zk = connection
+        self._path = path
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._flush_scheduled = False
+        self._flush_lock = threading.Lock()
+        # Increment of a flush that may have gone through
+        self._unconfirmed = None
+        self._retry_policy = retry_policy
+
+        if not is_known_path(connection, path):
+            self._create()
+        try:
+            self._shards = self._load_shards(shards)
+        except zookeeper.NoNodeException:
+            # Removed since we last saw it
+            forget_path(connection, path)
+            self._create()
+            self._shards = self._load_shards(shards)
+
+    def _create(self):
+        """Create the counter's node"""
+        try:
+            safe_call(self._zk, 'create', self._path, 'zktools counter',
+                      [ZOO_OPEN_ACL_UNSAFE], 0,
+                      retry_policy=self._retry_policy)
+        except zookeeper.NodeExistsException:
+            pass
+        add_known_path(self._zk, self._path)
+
+    def _load_shards(self, shards):
+        return [ZkNode(self._zk, '%s/shard-%s' % (self._path, x), 0,
+                       codec=JSON_CODEC, retry_policy=self._retry_policy)
+                for x in range(shards)]
+
+    @property
+    def value(self):
+        """The value of the counter in Zookeeper
+
+        Increments not flushed yet aren't included, see :attr:`pending`.
+
+        """
+        return sum(_shard_total(shard.value) for shard in self._shards)
+
+    @property
+    def pending(self):
+        """The amount added locally and not flushed yet"""
+        return self._pending
+
+    def add(self, amount=1):
+        """Add to the counter
+
+        :param amount: Amount to add, can be negative
+        :type amount: int
+        :raises: :class:`zookeeper.ConnectionLossException` if the
+                 connection was lost and whether the amount was added
+                 couldn't be checked
+
+        """
+        if self._flush_interval is None:
+            self._add(amount, [])
+            return
+        with self._lock:
+            self._pending += amount
+        self._schedule_flush()
+
+    def flush(self):
+        """Add the amount added locally to the counter in Zookeeper"""
+        with self._flush_lock:
+            if self._unconfirmed is not None:
+                amount, attempt = self._unconfirmed
+                if not self._applied(*attempt):
+                    with self._lock:
+                        self._pending += amount
+                self._unconfirmed = None
+            with self._lock:
+                amount = self._pending
+                self._pending = 0
+            if not amount:
+                return
+            attempt = []
+            try:
+                self._add(amount, attempt)
+            except RETRYABLE_ERRORS:
+                if attempt:
+                    # It may have been added, check on the next flush
+                    self._unconfirmed = (amount, attempt)
+                else:
+                    with self._lock:
+                        self._pending += amount
+                raise
+            except Exception:
+                # Keep it for the next flush
+                with self._lock:
+                    self._pending += amount
+                raise
+
+    def _schedule_flush(self):
+        with self._lock:
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        # Flushing blocks on Zookeeper, keep it off the dispatcher that
+        # handles Zookeeper events
+        get_callback_dispatcher().submit_later(self._flush_interval, self,
+                                               self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        with self._lock:
+            self._flush_scheduled = False
+        try:
+            self.flush()
+        except Exception:
+            log.exception("Error flushing counter %s", self._path)
+            self._schedule_flush()
+
+    def _add(self, amount, attempt):
+        """Add to a shard, moving on to the next one on conflicts
+
+        :param attempt: Empty list, set to the token, shard index and
+                        increment count of a ``set`` whose reply was lost
+        :type attempt: list
+
+        """
+        token = uuid.uuid4().hex[:16]
+        index = random.randrange(len(self._shards))
+        while 1:
+            written = []
+
+            def increment(value):
+                count = _shard_count(value) + 1
+                written[:] = [token, index, count]
+                tokens = isinstance(value, dict) and value['tokens'] or []
+                return dict(total=_shard_total(value) + amount, count=count,
+                            tokens=(tokens + [token])[-TOKEN_WINDOW:])
+            try:
+                self._shards[index].update(increment, max_attempts=1)
+                return
+            except zookeeper.BadVersionException:
+                index = (index + 1) % len(self._shards)
+            except RETRYABLE_ERRORS:
+                if not written:
+                    # Lost before the set was sent
+                    raise
+                attempt[:] = written
+                if self._applied(*written):
+                    return
+                del attempt[:]
+
+    def _applied(self, token, index, count):
+        """Read a shard again to tell whether an increment whose reply
+        was lost went through"""
+        path = '%s/shard-%s' % (self._path, index)
+        data = safe_call(self._zk, 'get', path,
+                         retry_policy=self._retry_policy)[0]
+        value = JSON_CODEC.decode(data)
+        if not isinstance(value, dict):
+            return False
+        if token in value['tokens']:
+            return True
+        if value['count'] - count >= TOKEN_WINDOW:
+            log.warning("Can't tell whether an increment of %s went "
+                        "through, counting it as added", path)
+            return True
+        return False
+
+    @property
+    def connected(self):
+        """Indicate whether a connection to Zookeeper exists"""
+        return self._zk.connected
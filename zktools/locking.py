@@ -34,6 +34,19 @@ implemented. A read lock can be acquired as long as no write locks are active,
 while a write-lock can only be acquired when there are no other read or write
 locks active.
 
+**Priority Locks**
+
+Lock candidates are normally served in the order they were queued. The
+``priority`` given to ``acquire`` puts a candidate in a higher priority
+class, such as ``lock.acquire(priority=1)`` for a latency sensitive
+request path contending with batch jobs using the default class of 0.
+
+A lock holder is never preempted. A candidate that would get the lock
+instead gives way to candidates of a higher priority class queued after
+it, by queueing again behind them. Each :data:`PRIORITY_AGING` seconds a
+candidate has waited raises it a class, so that candidates of lower
+classes are not starved.
+
 **Using the Lock Command Line Interface**
 
 `zktools` comes with a CLI to easily see current locks, details of each
@@ -58,31 +71,288 @@ The `modifed_ago` and `created_ago` fields in INFO show how many seconds
 ago the lock was created and modified.
 
 """
+import bisect
 import logging
+import thread
 import threading
 import time
 import uuid
+import weakref
+from collections import deque
 from optparse import OptionParser
 
-from zc.zk import ZooKeeper
-import zookeeper
-
+try:
+    import zookeeper
+except ImportError:  # pragma: nocover
+    from zktools import _zkconsts as zookeeper
+
+from zktools import metrics
+from zktools.util import ChildrenCache
+from zktools.util import DEFAULT_RETRY_POLICY
+from zktools.util import RETRYABLE_CODES
+from zktools.util import add_known_path
+from zktools.util import async_call
+from zktools.util import dispatched
+from zktools.util import forget_path
+from zktools.util import get_callback_dispatcher
+from zktools.util import get_dispatcher
+from zktools.util import is_known_path
+from zktools.util import pipeline
 from zktools.util import safe_call
 from zktools.util import safe_create_ephemeral_sequence
-from zktools.util import threaded
 
 ZOO_OPEN_ACL_UNSAFE = {"perms": 0x1f, "scheme": "world", "id": "anyone"}
 IMMEDIATE = object()
 
+# Maximum number of requests in flight when revoking or clearing locks
+PIPELINE_WINDOW = 256
+
+# Seconds a lock candidate waits to be raised a priority class
+PRIORITY_AGING = 5.0
+
 log = logging.getLogger(__name__)
 
 
-__all__ = ['ZkAsyncLock', 'ZkLock', 'ZkReadLock', 'ZkWriteLock']
+__all__ = ['ZkAsyncLock', 'ZkLock', 'ZkRLock', 'ZkReadLock', 'ZkWriteLock',
+           'ZkLockSet', 'LockQueue', 'acquire_many', 'try_acquire_stats']
 
 
 def retryable(d):
-    return d in (zookeeper.CONNECTIONLOSS, zookeeper.CLOSING,
-                 zookeeper.OPERATIONTIMEOUT)
+    return d in RETRYABLE_CODES
+
+
+def _parse_candidate(name):
+    """Split a lock candidate name into its sequence, kind, prefix and
+    priority
+
+    Candidate names look like ``<uuid>-<kind>-<sequence>``, such as
+    ``dfad3fa294d745e499d883b0a38bbc93-write--0000000001``. Candidates
+    created by :func:`~zktools.util.safe_create_ephemeral_sequence` have
+    two dashes before the sequence. Candidates of a priority class above
+    0 have it after their kind, as in ``<uuid>-write-p2--0000000001``.
+
+    """
+    head, sep, tail = name.rpartition('-')
+    try:
+        sequence = int(tail)
+    except ValueError:
+        sequence = -1
+    prefix, sep, kind = head.rstrip('-').rpartition('-')
+    priority = 0
+    if kind[:1] == 'p' and kind[1:].isdigit():
+        priority = int(kind[1:])
+        prefix, sep, kind = prefix.rpartition('-')
+    return sequence, kind, prefix, priority
+
+
+def _candidate_name(kind, priority=0):
+    """Return the node name to create a lock candidate of a kind and
+    priority class with"""
+    if priority < 0:
+        raise ValueError("Lock priority must not be negative")
+    if priority:
+        return '/%s-p%d-' % (kind, priority)
+    return '/%s-' % kind
+
+
+class LockQueue(object):
+    """Sorted queue of lock candidates
+
+    Each candidate name is parsed once into its sequence number, kind,
+    UUID prefix and priority class, and kept sorted by sequence so that
+    lock decisions are answered without re-sorting or scanning the
+    candidates.
+
+    Example::
+
+        queue = LockQueue(zk.get_children('/ZktoolsLocks/my_lock'))
+        if queue.is_first(my_candidate):
+            # lock acquired
+        else:
+            watch_node = queue.predecessor(my_candidate)
+
+    """
+    __slots__ = ('_names', '_sequences', '_kinds', '_prefixes',
+                 '_priorities', '_max_priority', '_index', '_writers')
+
+    def __init__(self, children):
+        """Create a LockQueue
+
+        :param children: Names of the candidate nodes, in any order
+        :type children: list
+
+        """
+        entries = sorted((_parse_candidate(name), name) for name in children)
+        self._names = [name for _, name in entries]
+        self._sequences = [parsed[0] for parsed, _ in entries]
+        self._kinds = [parsed[1] for parsed, _ in entries]
+        self._prefixes = [parsed[2] for parsed, _ in entries]
+        self._priorities = [parsed[3] for parsed, _ in entries]
+        self._max_priority = max(self._priorities or [0])
+        self._index = dict((name, i) for i, name in enumerate(self._names))
+        self._writers = [i for i, kind in enumerate(self._kinds)
+                         if kind == 'write']
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __getitem__(self, index):
+        return self._names[index]
+
+    def index(self, name):
+        """Return the position of a candidate in the queue"""
+        try:
+            return self._index[name]
+        except KeyError:
+            raise ValueError("%s is not in the lock queue" % name)
+
+    def is_first(self, name):
+        """Indicate whether a candidate is at the head of the queue"""
+        return self._index.get(name) == 0
+
+    def predecessor(self, name):
+        """Return the candidate immediately before this one, or None"""
+        index = self.index(name)
+        if index == 0:
+            return None
+        return self._names[index - 1]
+
+    def prior_nodes(self, name):
+        """Return all the candidates before this one"""
+        return self._names[:self.index(name)]
+
+    def prior_writer(self, name):
+        """Return the closest write candidate before this one, or None"""
+        position = bisect.bisect_left(self._writers, self.index(name))
+        if position == 0:
+            return None
+        return self._names[self._writers[position - 1]]
+
+    def prior_writers(self, name):
+        """Return all the write candidates before this one"""
+        position = bisect.bisect_left(self._writers, self.index(name))
+        return [self._names[i] for i in self._writers[:position]]
+
+    def has_writers(self):
+        """Indicate whether any write candidate is queued"""
+        return bool(self._writers)
+
+    def kind(self, name):
+        """Return the kind of a candidate, such as ``read``"""
+        return self._kinds[self.index(name)]
+
+    def priority(self, name):
+        """Return the priority class of a candidate"""
+        return self._priorities[self.index(name)]
+
+    def has_priorities(self):
+        """Indicate whether any candidate of a priority class above 0 is
+        queued"""
+        return self._max_priority > 0
+
+    def outranking(self, name, waited=0, writers=False):
+        """Return the candidates after this one that it gives way to
+
+        Those are the candidates of a higher priority class than this
+        one, which is raised a class for every :data:`PRIORITY_AGING`
+        seconds it waited.
+
+        :param waited: How long the candidate has waited, in seconds
+        :type waited: float
+        :param writers: Whether only write candidates are considered
+        :type writers: bool
+
+        """
+        index = self.index(name)
+        rank = self._priorities[index] + waited / PRIORITY_AGING
+        if self._max_priority <= rank:
+            return []
+        return [self._names[i] for i in range(index + 1, len(self._names))
+                if self._priorities[i] > rank and
+                (not writers or self._kinds[i] == 'write')]
+
+    def outranked(self, name):
+        """Return the waiting candidates before this one that give way
+        to it
+
+        Those are the candidates of a lower priority class that don't
+        hold the lock. Readers only give way to writers.
+
+        """
+        priority = self.priority(name)
+        if not priority:
+            return []
+        writer = self.kind(name) != 'read'
+        names = []
+        for other in self.prior_nodes(name):
+            if self.priority(other) >= priority:
+                continue
+            if self.kind(other) == 'read':
+                # Readers hold the lock once no writer is before them
+                if not writer or self.prior_writer(other) is None:
+                    continue
+            elif self.is_first(other):
+                continue
+            names.append(other)
+        return names
+
+    def find_prefix(self, prefix):
+        """Return the candidate created with a UUID prefix, or None"""
+        for i, candidate_prefix in enumerate(self._prefixes):
+            if candidate_prefix == prefix:
+                return self._names[i]
+        return None
+
+
+_children_caches = weakref.WeakKeyDictionary()
+_children_caches_lock = threading.Lock()
+
+_probe_counts = dict(attempts=0, avoided=0)
+_probe_counts_lock = threading.Lock()
+
+
+def try_acquire_stats():
+    """Return a dict of counters of the locks' ``try_acquire`` calls
+
+    The counters include the amount of ``attempts``, the amount of them
+    ``avoided`` because the lock wasn't free, and the ``writes_avoided``
+    by those, as ``acquire(timeout=0)`` would have created and deleted a
+    candidate node.
+
+    """
+    with _probe_counts_lock:
+        return dict(_probe_counts,
+                    writes_avoided=_probe_counts['avoided'] * 2)
+
+
+def _count_probe(avoided):
+    with _probe_counts_lock:
+        _probe_counts['attempts'] += 1
+        if avoided:
+            _probe_counts['avoided'] += 1
+
+
+def lock_children_cache(connection):
+    """Return the lock candidate cache shared by all locks of a connection
+
+    :param connection: Zookeeper connection object
+    :type connection: zc.zk Zookeeper instance
+    :returns: :class:`~zktools.util.ChildrenCache` holding a
+              :class:`LockQueue` for each lock node
+
+    """
+    with _children_caches_lock:
+        cache = _children_caches.get(connection)
+        if cache is None:
+            cache = _children_caches[connection] = ChildrenCache(
+                connection, transform=LockQueue)
+        return cache
 
 
 class ZkAsyncLock(object):
@@ -127,7 +397,8 @@ class ZkAsyncLock(object):
         that were encountered.
 
     """
-    def __init__(self, connection, lock_name, lock_root='/ZktoolsLocks'):
+    def __init__(self, connection, lock_name, lock_root='/ZktoolsLocks',
+                 retry_policy=None):
         """Create an Asynchronous Zookeeper Lock
 
         :param connection: Zookeeper connection object
@@ -136,6 +407,10 @@ class ZkAsyncLock(object):
         :param lock_root: Path to the root lock node to create the locks
                           under
         :type lock_root: string
+        :param retry_policy: Policy to retry requests with after
+                             connection loss. When it gives up, the error
+                             is added to :attr:`~ZkAsyncLock.errors`.
+        :type retry_policy: :class:`~zktools.util.RetryPolicy`
 
         """
         self._zk = connection
@@ -144,13 +419,22 @@ class ZkAsyncLock(object):
         self._acquired = False
         self._candidate_path = None
         self._acquire_func = self._release_func = None
+        self._retry_policy = retry_policy or DEFAULT_RETRY_POLICY
+        self._retries = None
+        self._sole_predecessor = None
         self.errors = []
+        self._ensure_lock_dir()
 
+    def _ensure_lock_dir(self):
+        if is_known_path(self._zk, self._lock_path):
+            return
         try:
             safe_call(self._zk, 'create_recursive', self._lock_path,
-                      "zktools ZLock dir", [ZOO_OPEN_ACL_UNSAFE])
+                      "zktools ZLock dir", [ZOO_OPEN_ACL_UNSAFE],
+                      retry_policy=self._retry_policy)
         except zookeeper.NodeExistsException:
             pass
+        add_known_path(self._zk, self._lock_path)
 
     def __enter__(self):
         """Context manager blocking interface"""
@@ -215,6 +499,8 @@ class ZkAsyncLock(object):
         self._lock_event.clear()
         self._acquire_func = func
         self._node_prefix = uuid.uuid4().hex
+        self._retries = None
+        self._sole_predecessor = None
         self._create_candidate()
         return False
 
@@ -241,10 +527,23 @@ class ZkAsyncLock(object):
         self._delete_candidate()
         return False
 
+    def _retry(self, return_code, action, func):
+        """Call func again after the retry policy's backoff, or give up
+        and report the error"""
+        if self._retries is None:
+            self._retries = self._retry_policy.start()
+        delay = self._retries.next_delay()
+        if delay is None:
+            self.errors.append((return_code, action))
+            self._lock_event.set()
+            return
+        get_dispatcher().submit_later(delay, self, func)
+
     def _delete_candidate(self):
-        self._zk.adelete(self._candidate_path, -1, self._delete_callback)
+        self._zk.adelete(self._candidate_path, -1, metrics.timed_completion(
+            'adelete', self._candidate_path, self._delete_callback))
 
-    @threaded
+    @dispatched
     def _delete_callback(self, p, return_code):
         if return_code in (zookeeper.OK, zookeeper.NONODE):
             self._candidate_path = self._node_prefix = None
@@ -252,60 +551,72 @@ class ZkAsyncLock(object):
             self._acquired = False
             self._lock_event.set()
         elif retryable(return_code):
-            time.sleep(0.1)
-            return self._delete_candidate()
+            return self._retry(return_code, 'Delete callback',
+                               self._delete_candidate)
         else:
             self.errors.append((return_code, 'Delete callback'))
         if self._release_func:
-            self._release_func()
+            # Run separately so the callback may use this lock again
+            get_callback_dispatcher().submit(None, self._release_func)
 
     def _create_candidate(self):
         self._zk.create(self._lock_path + "/%s-lock-" % self._node_prefix,
                         "0", [ZOO_OPEN_ACL_UNSAFE],
                         zookeeper.EPHEMERAL | zookeeper.SEQUENCE,
-                        self._candidate_creation_callback)
+                        metrics.timed_completion(
+                            'acreate', self._lock_path,
+                            self._candidate_creation_callback))
 
     def _acquire(self):
-        self._zk.aget_children(self._lock_path, None,
-                               self._check_candidate_nodes_callback)
+        self._zk.aget_children(self._lock_path, None, metrics.timed_completion(
+            'aget_children', self._lock_path,
+            self._check_candidate_nodes_callback))
 
-    @threaded
+    def _check_children_for_prefix(self):
+        self._zk.aget_children(self._lock_path, None, metrics.timed_completion(
+            'aget_children', self._lock_path,
+            self._check_children_for_prefix_callback))
+
+    @dispatched
     def _candidate_creation_callback(self, p, return_code, value):
         """Callback for after the node creation runs"""
         if return_code == zookeeper.OK:
             self._candidate_path = value
             return self._acquire()
+        elif return_code == zookeeper.NONODE:
+            # The lock node was removed, create it again
+            forget_path(self._zk, self._lock_path)
+            self._ensure_lock_dir()
+            self._create_candidate()
         elif retryable(return_code):
-            self._zk.aget_children(self._lock_path, None,
-                                   self._check_children_for_prefix_callback)
+            self._check_children_for_prefix()
         else:
             self.errors.append((return_code, 'Candidate creation'))
             self._lock_event.set()
 
-    @threaded
+    @dispatched
     def _check_children_for_prefix_callback(self, p, return_code, children):
         """Checks to see during candidate creation errors if the node
         was actually created"""
         if return_code == zookeeper.OK:
-            for child in children:
-                if child.startswith(self._node_prefix):  # Child was created
-                    self._candidate_path = self._lock_path + '/' + child
-                    return self._acquire()
+            child = LockQueue(children).find_prefix(self._node_prefix)
+            if child is not None:  # Child was created
+                self._candidate_path = self._lock_path + '/' + child
+                return self._acquire()
             # No matching child, recreate the candidate
             self._create_candidate()
-        elif retryable(return_code):  # Small sleep to avoid CPU hit
-            time.sleep(0.1)
-            self._zk.aget_children(self._lock_path, None,
-                                   self._check_children_for_prefix_callback)
+        elif retryable(return_code):
+            self._retry(return_code, 'Check children for prefix',
+                        self._check_children_for_prefix)
         else:
             self.errors.append((return_code, 'Check children for prefix'))
             self._lock_event.set()
 
-    @threaded
+    @dispatched
     def _check_candidate_nodes_callback(self, p, return_code, children):
-        if retryable(return_code):  # Small sleep to avoid CPU hit
-            time.sleep(0.1)
-            return self._acquire()
+        if retryable(return_code):
+            return self._retry(return_code, 'Check candidate nodes',
+                               self._acquire)
         elif self._candidate_path is None:  # We were released early
             return
         elif return_code != zookeeper.OK:
@@ -313,35 +624,74 @@ class ZkAsyncLock(object):
             return
 
         candidate_name = self._candidate_path.split('/')[-1]
-        if candidate_name not in children:  # Not in list? start over
+        queue = LockQueue(children)
+        if candidate_name not in queue:  # Not in list? start over
             self._candidate_path = None
             return self._create_candidate()
 
-        # Sort by sequence, ignore proceeding UUID hex
-        children.sort(key=lambda k: k.split('-')[-1])
-        index = children.index(candidate_name)
-
-        if index == 0:  # We're first, lock acquired
-            self._acquired = True
-            self._lock_event.set()
-            if self._acquire_func:
-                self._acquire_func(self)
-            return
+        predecessor = queue.predecessor(candidate_name)
+        if predecessor is None:  # We're first, lock acquired
+            return self._lock_acquired()
 
         # We're not first, watch the next in line
-        prior_node = '/'.join([self._lock_path, children[index - 1]])
+        prior_node = '/'.join([self._lock_path, predecessor])
+        if queue.index(candidate_name) == 1:
+            # Nothing else is ahead of us, nor can be queued ahead of us
+            # later, so its removal hands the lock over
+            self._sole_predecessor = prior_node
+        else:
+            self._sole_predecessor = None
         self._zk.aget(prior_node, self._prior_node_watcher,
-                      self._prior_node_get_callback)
+                      metrics.timed_completion('aget', prior_node,
+                                               self._prior_node_get_callback))
+
+    def _lock_acquired(self):
+        self._sole_predecessor = None
+        self._acquired = True
+        self._lock_event.set()
+        if self._acquire_func:
+            # Run separately so the callback may release the lock
+            get_callback_dispatcher().submit(None, self._acquire_func, self)
+
+    def _handed_off(self, prior_node):
+        """Take the lock when the only node ahead of us is removed,
+        checking our candidate still exists in the background"""
+        if self._candidate_path is None or self._acquired or \
+           prior_node is None or prior_node != self._sole_predecessor:
+            return False
+        self._lock_acquired()
+        self._verify_candidate()
+        return True
 
-    @threaded
+    def _verify_candidate(self):
+        self._zk.aexists(self._candidate_path, None, metrics.timed_completion(
+            'aexists', self._candidate_path, self._verify_candidate_callback))
+
+    @dispatched
+    def _verify_candidate_callback(self, p, return_code, stat=None):
+        if not self._acquired:
+            return
+        elif retryable(return_code):
+            self._retry(return_code, 'Verify candidate',
+                        self._verify_candidate)
+        elif return_code != zookeeper.OK:
+            # Our candidate went away with the session, we don't have it
+            self._acquired = False
+            self.errors.append((return_code, 'Verify candidate'))
+
+    @dispatched
     def _prior_node_get_callback(self, p, return_code, value, stat):
         if return_code == zookeeper.NONODE:
-            # No node? Check candidates again
-            self._acquire()
+            # No node? Check candidates again, unless that hands the lock
+            # over to us
+            if not self._handed_off(self._sole_predecessor):
+                self._acquire()
         # Node still exists, wait for the watcher and ignore here
 
-    @threaded
+    @dispatched
     def _prior_node_watcher(self, handle, type, state, path):
+        if type == zookeeper.DELETED_EVENT and self._handed_off(path):
+            return
         if type != zookeeper.SESSION_EVENT:
             # Retrigger our children check
             self._acquire()
@@ -349,7 +699,8 @@ class ZkAsyncLock(object):
 
 class _LockBase(object):
     """Base lock implementation for subclasses"""
-    def __init__(self, connection, lock_name, lock_root='/ZktoolsLocks'):
+    def __init__(self, connection, lock_name, lock_root='/ZktoolsLocks',
+                 retry_policy=None):
         """Create a Zookeeper lock object
 
         :param connection: Zookeeper connection object
@@ -357,39 +708,69 @@ class _LockBase(object):
         :param lock_root: Path to the root lock node to create the locks
                           under
         :type lock_root: string
+        :param retry_policy: Policy to retry requests with after
+                             connection loss, connection errors are raised
+                             once it gives up.
+        :type retry_policy: :class:`~zktools.util.RetryPolicy`
 
         """
         self._zk = connection
         self._lock_root = lock_root
+        self._retry_policy = retry_policy
         self._revoked = []
         self._lock_args = ([], {})
         self._has_lock = has_write_lock
         self._log_debug = logging.DEBUG >= log.getEffectiveLevel()
         self._locknode = '%s/%s' % (self._lock_root, lock_name)
         self._candidate_path = ''
+        self._handed_off = None
+        self._children = lock_children_cache(connection)
         self._ensure_lock_dir()
 
+    def _safe_call(self, func, *args):
+        return safe_call(self._zk, func, *args,
+                         retry_policy=self._retry_policy)
+
     def _ensure_lock_dir(self):
         # Ensure our lock dir exists
-        if safe_call(self._zk, 'exists', self._locknode):
+        if is_known_path(self._zk, self._locknode):
+            return
+        if self._safe_call('exists', self._locknode):
+            add_known_path(self._zk, self._locknode)
             return
 
         try:
-            safe_call(self._zk, 'create', self._lock_root,
-                      "zktools ZLock dir", [ZOO_OPEN_ACL_UNSAFE], 0)
+            self._safe_call('create', self._lock_root,
+                            "zktools ZLock dir", [ZOO_OPEN_ACL_UNSAFE], 0)
         except zookeeper.NodeExistsException:
             if self._log_debug:
                 log.debug("Lock node in Zookeeper already created")
 
         # Try and create our locking node
         try:
-            safe_call(self._zk, 'create', self._locknode, "lock",
-                      [ZOO_OPEN_ACL_UNSAFE], 0)
+            self._safe_call('create', self._locknode, "lock",
+                            [ZOO_OPEN_ACL_UNSAFE], 0)
         except zookeeper.NodeExistsException:
             # Ok if this exists already
             pass
+        add_known_path(self._zk, self._locknode)
 
-    def _acquire_lock(self, node_name, timeout=None, revoke=False):
+    def _create_candidate(self, node_name):
+        """Create a lock candidate node, re-creating the lock node if it
+        was removed"""
+        try:
+            return safe_create_ephemeral_sequence(
+                self._zk, self._locknode + node_name, "0",
+                [ZOO_OPEN_ACL_UNSAFE], self._retry_policy)
+        except zookeeper.NoNodeException:
+            forget_path(self._zk, self._locknode)
+            self._ensure_lock_dir()
+            return safe_create_ephemeral_sequence(
+                self._zk, self._locknode + node_name, "0",
+                [ZOO_OPEN_ACL_UNSAFE], self._retry_policy)
+
+    def _acquire_lock(self, node_name, timeout=None, revoke=False,
+                      znode=None):
         """Acquire a lock
 
         Internal function used by read/write lock
@@ -404,113 +785,350 @@ class _LockBase(object):
                        their lock, or :obj:`IMMEDIATE` to destroy the blocking
                        read/write locks and attempt to acquire a write lock.
         :type revoke: bool or :obj:``IMMEDIATE``
+        :param znode: Full path of an already created candidate node to
+                      wait with, instead of creating a new one.
+        :type znode: str
 
 
         :returns: True if the lock was acquired, False otherwise
         :rtype: bool
 
         """
-        # First clear out any prior revocation warnings
-        self._revoked = []
+        # First clear out any prior revocation warnings. Events of our
+        # prior candidates are reported to the list they came with.
+        revoked = self._revoked = []
 
         # Create a lock node
-        self._candidate_path = znode = safe_create_ephemeral_sequence(
-            self._zk, self._locknode + node_name, "0", [ZOO_OPEN_ACL_UNSAFE])
+        if znode is None:
+            znode = self._create_candidate(node_name)
+        self._candidate_path = znode
+
+        # Set once our own node is known to be gone
+        lost = []
+
+        # Set when a candidate we give way to tells us it queued
+        outranked = []
+
+        acquired = False
+        cv = threading.Event()
+        events = []
 
-        @threaded
         def revoke_watcher(handle, type, state, path):
+            if path != znode and type != zookeeper.SESSION_EVENT:
+                # Events of a candidate we replaced since
+                return
+            if type == zookeeper.DELETED_EVENT or \
+               state == zookeeper.EXPIRED_SESSION_STATE:
+                lost.append(True)
+            elif type == zookeeper.CHANGED_EVENT:
+                # We may have been outranked. Until our data is read the
+                # queue is listed again rather than taking a hand-off, as
+                # the candidate that outranks us is already in it.
+                outranked.append(True)
+                cv.set()
+            get_dispatcher().submit(self, revoke_check, path, type, state)
+
+        def revoke_check(path, type, state):
             # This method must be in closure scope to ensure that
             # it can append to the thread it is called from
             # to indicate if this particular thread's lock was
             # revoked or removed
             if type == zookeeper.CHANGED_EVENT:
-                data = safe_call(self._zk, 'get', path, revoke_watcher)[0]
-                if data == 'unlock':
-                    self._revoked.append(True)
+                # Read asynchronously, so a connection loss doesn't
+                # hold a dispatcher worker
+                async_call(self._zk, 'aget', (path, revoke_watcher),
+                           revoke_data, retry_policy=self._retry_policy)
             elif type == zookeeper.DELETED_EVENT or \
                  state == zookeeper.EXPIRED_SESSION_STATE:
                 # Trigger if node was deleted
-                self._revoked.append(True)
-
-        data = safe_call(self._zk, 'get', znode, revoke_watcher)[0]
+                revoked.append(True)
+
+        def revoke_data(handle, return_code, data=None, stat=None):
+            # A deleted node is reported by its watch
+            if return_code != zookeeper.OK:
+                return
+            if data == 'unlock':
+                revoked.append(True)
+            elif data == 'outranked':
+                outranked.append(True)
+                cv.set()
+
+        data = self._safe_call('get', znode, revoke_watcher)[0]
         if data == 'unlock':
             self._revoked.append(True)
         keyname = znode[znode.rfind('/') + 1:]
 
-        acquired = False
-        cv = threading.Event()
-
         def lock_watcher(handle, type, state, path):
+            events.append((type, path))
             cv.set()
 
+        def wait_time():
+            # Wait for a notification, no longer than the timeout
+            if timeout is None:
+                return None
+            return timeout - (time.time() - lock_start)
+
+        # A waiting reader is only blocked by the writers queued before
+        # it, as writers queued later come after it. Those are kept, and
+        # once the closest one is gone the rest are checked in turn,
+        # rather than every reader listing the whole queue again when a
+        # writer releases.
+        waiting = None
+
+        # The node ahead of us, when nothing else is queued before it.
+        # Its removal hands the lock over, as no node can be queued
+        # before ours later on. When the queue has candidates with a
+        # priority, or one told us it outranks ours, the queue is listed
+        # again instead, as we may have to give way.
+        sole_prior_node = None
+        handed_off = False
+        prioritized = False
+        notified = set()
+
         lock_start = time.time()
         first_run = True
+        refresh = False
         while not acquired:
             cv.clear()
+            fired, events[:] = events[:], []
 
             # Have we been at this longer than the timeout?
             if not first_run:
                 if timeout is not None and time.time() - lock_start > timeout:
                     try:
-                        safe_call(self._zk, 'delete', znode)
+                        self._safe_call('delete', znode)
                     except zookeeper.NoNodeException:
                         pass
                     return False
             first_run = False
-
-            # Get all the children of the node
-            children = safe_call(self._zk, 'get_children', self._locknode)
-            children.sort(key=lambda val: val[val.rfind('-') + 1:])
+            prioritized = prioritized or bool(outranked)
+
+            if sole_prior_node is not None:
+                if not lost and not prioritized and \
+                   (zookeeper.DELETED_EVENT, sole_prior_node) in fired:
+                    acquired = handed_off = True
+                    break
+                sole_prior_node = None
+
+            if waiting is not None:
+                if not lost and not [event for event in fired
+                                     if event[0] == zookeeper.SESSION_EVENT]:
+                    waiting = self._writers_left(waiting, lock_watcher, fired)
+                    if waiting:
+                        cv.wait(wait_time())
+                        continue
+                    if not prioritized:
+                        acquired = True
+                        break
+                # Our node or the watches may be gone, or a candidate we
+                # give way to queued, check the queue
+                waiting = None
+                refresh = True
+
+            # Get all the children of the node, sorted by sequence
+            del outranked[:]
+            children = self._children.get(self._locknode, refresh)
+            if not refresh and keyname not in children:
+                # The cache may not have seen our node yet
+                children = self._children.get(self._locknode, True)
+            refresh = False
+            prioritized = children.has_priorities()
 
             if len(children) == 0 or not keyname in children:
                 # Disconnects or other errors can cause this
-                self._candidate_path = znode = safe_create_ephemeral_sequence(
-                    self._zk, self._locknode + node_name, "0",
-                    [ZOO_OPEN_ACL_UNSAFE])
+                self._candidate_path = znode = self._create_candidate(
+                    node_name)
                 keyname = znode[znode.rfind('/') + 1:]
-                data = safe_call(self._zk, 'get', znode, revoke_watcher)[0]
+                del lost[:]
+                data = self._safe_call('get', znode, revoke_watcher)[0]
                 if data == 'unlock':
                     self._revoked.append(True)
                 continue
 
-            acquired, blocking_nodes = self._has_lock(keyname, children)
+            acquired, blocking_nodes = self._has_lock(
+                keyname, children, time.time() - lock_start)
             if acquired:
                 break
 
+            if children.index(blocking_nodes[0]) > children.index(keyname):
+                # Give way to the candidates of a higher priority queued
+                # after ours, by queueing again behind them
+                prior_znode = znode
+                self._candidate_path = znode = self._create_candidate(
+                    node_name)
+                keyname = znode[znode.rfind('/') + 1:]
+                try:
+                    self._safe_call('delete', prior_znode)
+                except zookeeper.NoNodeException:
+                    pass
+                del lost[:]
+                data = self._safe_call('get', znode, revoke_watcher)[0]
+                if data == 'unlock':
+                    self._revoked.append(True)
+                continue
+
             if revoke == IMMEDIATE:
                 # Remove all prior nodes
                 for node in blocking_nodes:
                     try:
-                        safe_call(self._zk, 'delete',
-                                  self._locknode + '/' + node)
+                        self._safe_call('delete', self._locknode + '/' + node)
                     except zookeeper.NoNodeException:
                         pass
+                refresh = True
                 continue  # Now try again
             elif revoke:
                 # Ask all prior blocking nodes to release
                 for node in blocking_nodes:
                     try:
-                        safe_call(self._zk, 'set',
-                                  self._locknode + '/' + node, "unlock")
+                        self._safe_call('set',
+                                        self._locknode + '/' + node, "unlock")
                     except zookeeper.NoNodeException:
                         pass
 
+            self._notify_outranked(keyname, children, notified)
+
+            if self._has_lock is has_read_lock:
+                waiting = self._writers_left(blocking_nodes, lock_watcher)
+                if not waiting:
+                    # The writers left meanwhile, check the queue again
+                    waiting = None
+                    refresh = True
+                    continue
+                cv.wait(wait_time())
+                continue
+
             prior_blocking_node = self._locknode + '/' + blocking_nodes[-1]
-            exists = safe_call(self._zk, 'exists', prior_blocking_node,
-                               lock_watcher)
+            exists = self._safe_call('exists', prior_blocking_node,
+                                     lock_watcher)
             if not exists:
-                # The node disappeared? Rinse and repeat.
+                if len(blocking_nodes) == 1 and not lost and \
+                   not prioritized and not outranked:
+                    acquired = handed_off = True
+                    break
+                # The node disappeared? Rinse and repeat, without trusting
+                # a cache that may not have caught up yet.
+                refresh = True
                 continue
+            if len(blocking_nodes) == 1:
+                sole_prior_node = prior_blocking_node
 
-            # Wait for a notification from get_children, no longer
-            # than the timeout
-            wait_for = None
-            if timeout is not None:
-                time_spent = time.time() - lock_start
-                wait_for = timeout - time_spent
-            cv.wait(wait_for)
+            cv.wait(wait_time())
+
+        if handed_off:
+            # The queue wasn't listed again, check our node is still
+            # there without holding up the lock holder
+            self._handed_off = znode
+            get_dispatcher().submit(self, self._verify_candidate, znode)
         return True
 
+    def try_acquire(self):
+        """Acquire the lock if it's free, without waiting
+
+        ``acquire(timeout=0)`` creates a candidate node, and deletes it
+        again if the lock is held. This checks the lock queue first,
+        through the candidate cache shared by the locks of the
+        connection, and only creates a candidate if the lock looks free.
+        Polling a held lock this way sends no writes to Zookeeper, see
+        :func:`try_acquire_stats`.
+
+        :returns: True if the lock was acquired, False otherwise
+        :rtype: bool
+
+        """
+        try:
+            queue = self._children.get(self._locknode)
+        except zookeeper.NoNodeException:
+            # Removed since we last saw it, along with any candidates
+            forget_path(self._zk, self._locknode)
+            self._ensure_lock_dir()
+            queue = LockQueue([])
+        if not self._looks_free(queue):
+            _count_probe(True)
+            return False
+        _count_probe(False)
+        return self.acquire(timeout=0)
+
+    def _looks_free(self, queue):
+        """Indicate whether a new candidate would get the lock right away
+
+        :param queue: The lock queue
+        :type queue: :class:`LockQueue`
+
+        """
+        return not len(queue)
+
+    def _notify_outranked(self, keyname, children, notified):
+        """Tell the waiting candidates queued before ours that give way to
+        it, as they may take the lock over without listing the queue again
+
+        :param keyname: Name of our candidate
+        :type keyname: str
+        :param children: The lock queue
+        :type children: :class:`LockQueue`
+        :param notified: Names of the candidates told already, the
+                         candidates told are added
+        :type notified: set
+
+        """
+        paths = []
+        for name in children.outranked(keyname):
+            if name not in notified:
+                notified.add(name)
+                paths.append(self._locknode + '/' + name)
+        if paths:
+            # Only candidates with untouched data, so that requests to
+            # release aren't overwritten
+            pipeline(self._zk, [('aset', (path, 'outranked', 0))
+                                for path in paths])
+
+    def _verify_candidate(self, znode):
+        """Mark a lock that was handed off as revoked if its candidate
+        node is gone"""
+        if self._handed_off != znode:
+            return
+        revoked = self._revoked
+
+        def verified(handle, return_code, stat=None):
+            if return_code == zookeeper.NONODE and \
+               self._handed_off == znode:
+                revoked.append(True)
+        async_call(self._zk, 'aexists', (znode, None), verified,
+                   retry_policy=self._retry_policy)
+
+    def _writers_left(self, writers, watcher, events=()):
+        """Return the writers a reader is still waiting on, in queue
+        order, with a watch set on the last one
+
+        :param writers: Names of the writers the reader waited on
+        :type writers: list
+        :param watcher: Watcher to set on the closest writer left
+        :param events: ``(type, path)`` of the watch events received
+                       since, a writer reported deleted isn't checked
+
+        When more than one writer is left to check, the queue is listed
+        once instead of checking each writer in turn.
+
+        """
+        writers = list(writers)
+        deleted = set(path for type, path in events
+                      if type == zookeeper.DELETED_EVENT)
+        listed = False
+        while writers:
+            path = self._locknode + '/' + writers[-1]
+            if path not in deleted:
+                if len(writers) > 1 and not listed:
+                    # Rather than an exists per writer gone, list the
+                    # queue once and keep the writers still in it
+                    listed = True
+                    children = self._children.get(self._locknode)
+                    writers = [writer for writer in writers
+                               if writer in children]
+                    continue
+                if self._safe_call('exists', path, watcher):
+                    break
+            writers.pop()
+        return writers
+
     def __call__(self, *args, **kwargs):
         self._lock_args = (args, kwargs)
         return self
@@ -532,11 +1150,14 @@ class _LockBase(object):
 
         """
         self._revoked = []
+        self._handed_off = None
         try:
-            safe_call(self._zk, 'delete', self._candidate_path)
+            self._safe_call('delete', self._candidate_path)
             return True
         except (zookeeper.NoNodeException, AttributeError):
             return False
+        finally:
+            self._children.invalidate(self._locknode)
 
     def has_lock(self):
         """Check with Zookeeper to see if the lock is acquired
@@ -551,9 +1172,10 @@ class _LockBase(object):
 
         znode = self._candidate_path
         keyname = znode[znode.rfind('/') + 1:]
-        # Get all the children of the node
-        children = safe_call(self._zk, 'get_children', self._locknode)
-        children.sort(key=lambda val: val[val.rfind('-') + 1:])
+        # Get all the children of the node, sorted by sequence
+        children = self._children.get(self._locknode)
+        if keyname not in children:
+            children = self._children.get(self._locknode, True)
         if keyname not in children:
             return False
 
@@ -568,17 +1190,17 @@ class _LockBase(object):
             You must be sure this is a dead lock, as clearing it will
             forcibly release it by deleting all lock nodes.
 
-        :returns: True if the lock was cleared, or False if it
-                  is no longer valid.
-        :rtype: bool
+        :returns: The number of lock nodes deleted
+        :rtype: int
 
         """
-        children = safe_call(self._zk, 'get_children', self._locknode)
-        for child in children:
-            try:
-                safe_call(self._zk, 'delete', self._locknode + '/' + child)
-            except zookeeper.NoNodeException:
-                pass
+        try:
+            children = self._safe_call('get_children', self._locknode)
+        except zookeeper.NoNodeException:
+            # Removed along with any locks since it was last seen
+            forget_path(self._zk, self._locknode)
+            return 0
+        return self._pipelined('delete', children, -1)
 
     def revoke_all(self):
         """Revoke any existing locks, gently
@@ -586,23 +1208,47 @@ class _LockBase(object):
         Unlike :meth:`clear`, this asks all existing locks to
         release, rather than forcibly revoking them.
 
-        :returns: True if existing locks were present, False if
+        :returns: The number of existing locks asked to release, 0 if
                   there were no existing locks.
-        :rtype: bool
+        :rtype: int
 
         """
         # Get all the children of the node
-        children = safe_call(self._zk, 'get_children', self._locknode)
-        if not children:
-            return False
+        try:
+            children = self._safe_call('get_children', self._locknode)
+        except zookeeper.NoNodeException:
+            forget_path(self._zk, self._locknode)
+            return 0
+        return self._pipelined('set', children, "unlock", -1)
+
+    def _pipelined(self, func, children, *args):
+        """Run a call for each of the lock nodes with pipelined
+        asynchronous requests
+
+        :param func: Name of the synchronous call, such as ``delete``
+        :type func: str
+        :param children: Names of the lock nodes
+        :type children: list
+        :returns: The number of lock nodes the call succeeded for, lock
+                  nodes removed in the meantime aren't counted.
+        :rtype: int
 
-        for child in children:
-            try:
-                safe_call(self._zk, 'set', self._locknode + '/' + child,
-                          "unlock")
-            except zookeeper.NoNodeException:
-                pass
-        return True
+        """
+        paths = [self._locknode + '/' + child for child in children]
+        results = pipeline(self._zk, [('a' + func, (path,) + args)
+                                      for path in paths],
+                           window=PIPELINE_WINDOW)
+        done = 0
+        for path, result in zip(paths, results):
+            if retryable(result[0]):
+                try:
+                    self._safe_call(func, path, *args)
+                except zookeeper.NoNodeException:
+                    continue
+            elif result[0] != zookeeper.OK:
+                continue
+            done += 1
+        return done
 
     @property
     def revoked(self):
@@ -619,6 +1265,115 @@ class _LockBase(object):
         return self._zk.connected
 
 
+class _LocalQueue(object):
+    """Threads of a process waiting on a lock name, see :class:`ZkLock`
+
+    The first thread in line acquires the lock in Zookeeper with a lock
+    of its own, the others wait in line here. On release the lock is
+    handed to the next thread in line, until ``max_handoffs`` threads got
+    it that way, after which the lock is released in Zookeeper.
+
+    """
+    def __init__(self, connection, lock_name, lock_root, retry_policy,
+                 max_handoffs):
+        self._lock = ZkLock(connection, lock_name, lock_root=lock_root,
+                            retry_policy=retry_policy)
+        self._max_handoffs = max_handoffs
+        self._cv = threading.Condition()
+        self._line = deque()
+        self._owner = None
+        self._held = False
+        # Whether a thread is acquiring or releasing in Zookeeper
+        self._acquiring = False
+        self._releasing = False
+        self._handoffs = 0
+
+    def acquire(self, lock, timeout=None, revoke=False, priority=0):
+        deadline = timeout is not None and time.time() + timeout or None
+        turn = object()
+        with self._cv:
+            self._line.append(turn)
+            try:
+                while 1:
+                    if self._line[0] is turn and self._owner is None:
+                        if self._held:
+                            # Handed over by the prior owner
+                            self._owner = lock
+                            return True
+                        if not self._acquiring and not self._releasing:
+                            break
+                    remaining = deadline and deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cv.wait(remaining)
+
+                # First in line, acquire the lock in Zookeeper
+                self._acquiring = True
+                self._cv.release()
+                try:
+                    remaining = deadline and max(deadline - time.time(), 0)
+                    acquired = self._lock.acquire(remaining, revoke,
+                                                  priority)
+                finally:
+                    self._cv.acquire()
+                    self._acquiring = False
+                if acquired:
+                    self._held = True
+                    self._owner = lock
+                    self._handoffs = 0
+                return acquired
+            finally:
+                self._line.remove(turn)
+                self._cv.notify_all()
+
+    def release(self, lock):
+        with self._cv:
+            if self._owner is not lock:
+                return False
+            self._owner = None
+            if self._line and self._handoffs < self._max_handoffs and \
+               not self._lock.revoked:
+                self._handoffs += 1
+                self._cv.notify_all()
+                return True
+            # Nobody acquires with the Zookeeper lock until it's released
+            self._held = False
+            self._releasing = True
+        try:
+            return self._lock.release()
+        finally:
+            with self._cv:
+                self._releasing = False
+                self._cv.notify_all()
+
+    def has_lock(self, lock):
+        return self._owner is lock and self._lock.has_lock()
+
+    def revoked(self, lock):
+        return self._owner is lock and self._lock.revoked
+
+
+_local_queues = weakref.WeakKeyDictionary()
+_local_queues_lock = threading.Lock()
+
+
+def _local_queue(connection, lock_name, lock_root, retry_policy,
+                 max_handoffs):
+    """Return the local queue of a lock name shared by the hierarchical
+    locks of a connection"""
+    with _local_queues_lock:
+        queues = _local_queues.get(connection)
+        if queues is None:
+            queues = _local_queues[connection] = \
+                weakref.WeakValueDictionary()
+        key = (lock_root, lock_name)
+        queue = queues.get(key)
+        if queue is None:
+            queue = queues[key] = _LocalQueue(
+                connection, lock_name, lock_root, retry_policy, max_handoffs)
+        return queue
+
+
 class ZkLock(_LockBase):
     """Zookeeper Lock
 
@@ -643,8 +1398,56 @@ class ZkLock(_LockBase):
         with my_lock:
             # do something with the lock
 
+    **Hierarchical Locks**
+
+    When many threads of a process contend for a lock name, each of them
+    queues its own candidate node in Zookeeper and watches the one ahead.
+    Hierarchical locks instead queue the threads of a process in memory:
+    only the first thread in line queues a candidate, and once it
+    releases, the lock is handed to the next thread in line without going
+    through Zookeeper. After ``max_handoffs`` handoffs in a row the lock
+    is released in Zookeeper, letting other processes have their turn.
+
+    Example::
+
+        my_lock = ZkLock(conn, "my_lock_name", hierarchical=True)
+
+    All the hierarchical locks of a connection for a lock name share the
+    line, using the ``retry_policy`` and ``max_handoffs`` of the first
+    one created. Prior locks are only revoked by the first thread in
+    line, when it acquires the lock in Zookeeper.
+
     """
-    def acquire(self, timeout=None, revoke=False):
+    def __init__(self, connection, lock_name, lock_root='/ZktoolsLocks',
+                 retry_policy=None, hierarchical=False, max_handoffs=16):
+        """Create a Zookeeper lock object
+
+        :param connection: Zookeeper connection object
+        :type connection: zc.zk Zookeeper instance
+        :param lock_root: Path to the root lock node to create the locks
+                          under
+        :type lock_root: string
+        :param retry_policy: Policy to retry requests with after
+                             connection loss, connection errors are raised
+                             once it gives up.
+        :type retry_policy: :class:`~zktools.util.RetryPolicy`
+        :param hierarchical: Whether threads of the process wait in line
+                             in memory, rather than each in Zookeeper.
+        :type hierarchical: bool
+        :param max_handoffs: How many times in a row a hierarchical lock
+                             is handed to a thread of the process before
+                             being released in Zookeeper.
+        :type max_handoffs: int
+
+        """
+        _LockBase.__init__(self, connection, lock_name, lock_root,
+                           retry_policy)
+        self._local = None
+        if hierarchical:
+            self._local = _local_queue(connection, lock_name, lock_root,
+                                       retry_policy, max_handoffs)
+
+    def acquire(self, timeout=None, revoke=False, priority=0):
         """Acquire a lock
 
         :param timeout: How long to wait to acquire the lock, set to 0 to
@@ -655,15 +1458,160 @@ class ZkLock(_LockBase):
                        their lock, or :obj:`IMMEDIATE` to destroy the blocking
                        read/write locks and attempt to acquire a write lock.
         :type revoke: bool or :obj:`IMMEDIATE`
+        :param priority: Priority class of the lock candidate, candidates
+                         of higher classes are served first.
+        :type priority: int
 
         :returns: True if the lock was acquired, False otherwise
         :rtype: bool
 
         """
-        node_name = '/lock-'
+        if self._local is not None:
+            return self._local.acquire(self, timeout, revoke, priority)
+        node_name = _candidate_name('lock', priority)
         self._has_lock = has_write_lock
         return self._acquire_lock(node_name, timeout, revoke)
 
+    def release(self):
+        """Release a lock
+
+        :returns: True if the lock was released, or False if it is no
+                  longer valid.
+        :rtype: bool
+
+        """
+        if self._local is not None:
+            return self._local.release(self)
+        return _LockBase.release(self)
+
+    def has_lock(self):
+        """Check with Zookeeper to see if the lock is acquired
+
+        :returns: Whether the lock is acquired or not
+        :rtype: bool
+
+        """
+        if self._local is not None:
+            return self._local.has_lock(self)
+        return _LockBase.has_lock(self)
+
+    @property
+    def revoked(self):
+        """Indicate if this lock has been revoked
+
+        :returns: True if the lock has been revoked, False otherwise.
+        :rtype: bool
+        """
+        if self._local is not None:
+            return self._local.revoked(self)
+        return bool(self._revoked)
+
+
+class ZkRLock(ZkLock):
+    """Reentrant Zookeeper Lock
+
+    A lock that the thread holding it can acquire again, like Python's
+    ``threading.RLock``. The thread holding the lock and how many times
+    it acquired it are kept in memory, so only the outermost
+    :meth:`acquire` and :meth:`release` send requests to Zookeeper.
+    Other threads using the same lock object wait in memory until the
+    outermost release, as the object has a single lock candidate.
+
+    This class takes the same initialization parameters as
+    :class:`ZkLock`.
+
+    Example::
+
+        lock = ZkRLock(conn, "my_lock_name")
+
+        with lock:
+            with lock:
+                # still holding the lock, no Zookeeper request sent
+            # still holding the lock
+
+    """
+    def __init__(self, *args, **kwargs):
+        ZkLock.__init__(self, *args, **kwargs)
+        self._cv = threading.Condition()
+        # Thread holding the lock, or acquiring it in Zookeeper
+        self._owner = None
+        self._count = 0
+
+    def acquire(self, timeout=None, revoke=False, priority=0):
+        """Acquire a lock, or acquire it again from the thread holding it
+
+        The parameters are the same as :meth:`ZkLock.acquire`.
+
+        :returns: True if the lock was acquired, False otherwise
+        :rtype: bool
+
+        """
+        me = thread.get_ident()
+        deadline = timeout is not None and time.time() + timeout or None
+        with self._cv:
+            if self._owner == me:
+                self._count += 1
+                return True
+            while self._owner is not None:
+                remaining = deadline and deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cv.wait(remaining)
+            self._owner = me
+
+        acquired = False
+        try:
+            remaining = deadline and max(deadline - time.time(), 0)
+            acquired = ZkLock.acquire(self, remaining, revoke, priority)
+        finally:
+            with self._cv:
+                if acquired:
+                    self._count = 1
+                else:
+                    self._owner = None
+                    self._cv.notify_all()
+        return acquired
+
+    def try_acquire(self):
+        """Acquire the lock if it's free or held by the calling thread,
+        without waiting
+
+        :returns: True if the lock was acquired, False otherwise
+        :rtype: bool
+
+        """
+        with self._cv:
+            if self._owner == thread.get_ident():
+                self._count += 1
+                return True
+            if self._owner is not None:
+                # Held by another thread of the process
+                return False
+        return ZkLock.try_acquire(self)
+
+    def release(self):
+        """Release a lock once, releasing it in Zookeeper once it has been
+        released as many times as it was acquired
+
+        :returns: True if the lock was released, or False if it is no
+                  longer valid.
+        :rtype: bool
+        :raises: :class:`RuntimeError` if the calling thread doesn't hold
+                 the lock
+
+        """
+        if self._owner != thread.get_ident() or not self._count:
+            raise RuntimeError("cannot release un-acquired lock")
+        self._count -= 1
+        if self._count:
+            return True
+        try:
+            return ZkLock.release(self)
+        finally:
+            with self._cv:
+                self._owner = None
+                self._cv.notify_all()
+
 
 class ZkReadLock(_LockBase):
     """Shared Zookeeper Read Lock
@@ -675,7 +1623,7 @@ class ZkReadLock(_LockBase):
     :class:`ZkLock`.
 
     """
-    def acquire(self, timeout=None, revoke=False):
+    def acquire(self, timeout=None, revoke=False, priority=0):
         """Acquire a shared read lock
 
         :param timeout: How long to wait to acquire the lock, set to 0 to
@@ -686,15 +1634,21 @@ class ZkReadLock(_LockBase):
                        their lock, or :obj:`IMMEDIATE` to destroy the blocking
                        write locks and attempt to acquire a read lock.
         :type revoke: bool or :obj:`IMMEDIATE`
+        :param priority: Priority class of the lock candidate, candidates
+                         of higher classes are served first.
+        :type priority: int
 
         :returns: True if the lock was acquired, False otherwise
         :rtype: bool
 
         """
-        node_name = '/read-'
+        node_name = _candidate_name('read', priority)
         self._has_lock = has_read_lock
         return self._acquire_lock(node_name, timeout, revoke)
 
+    def _looks_free(self, queue):
+        return not queue.has_writers()
+
 
 class ZkWriteLock(_LockBase):
     """Shared Zookeeper Write Lock
@@ -706,7 +1660,7 @@ class ZkWriteLock(_LockBase):
     :class:`ZkLock`.
 
     """
-    def acquire(self, timeout=None, revoke=False):
+    def acquire(self, timeout=None, revoke=False, priority=0):
         """Acquire a shared write lock
 
         :param timeout: How long to wait to acquire the lock, set to 0 to
@@ -717,46 +1671,363 @@ class ZkWriteLock(_LockBase):
                        their lock, or :obj:`IMMEDIATE` to destroy the blocking
                        read/write locks and attempt to acquire a write lock.
         :type revoke: bool or :obj:`IMMEDIATE`
+        :param priority: Priority class of the lock candidate, candidates
+                         of higher classes are served first.
+        :type priority: int
 
         :returns: True if the lock was acquired, False otherwise
         :rtype: bool
 
         """
-        node_name = '/write-'
+        node_name = _candidate_name('write', priority)
         return self._acquire_lock(node_name, timeout, revoke)
 
 
-def has_read_lock(keyname, children):
+class ZkLockSet(object):
+    """Set of Zookeeper Locks acquired together
+
+    Acquires many :class:`ZkLock` compatible locks at once, such as one
+    lock per shard. Rather than paying several round-trips per lock, the
+    lock nodes, lock candidates and the lock queues of every lock are
+    handled in pipelined batches, so acquiring uncontended locks costs a
+    few round-trips no matter how many locks are in the set.
+
+    Locks are always acquired in sorted order of their names. When a lock
+    is contended, the candidates of the locks after it are withdrawn and
+    the remaining locks are acquired one at a time in that order, which
+    prevents deadlocks between lock sets with overlapping locks.
+
+    Example::
+
+        from zc.zk import ZooKeeper
+        from zktools.locking import ZkLockSet
+
+        conn = ZooKeeper()
+        shard_locks = ZkLockSet(conn, ['shard1', 'shard2', 'shard3'])
+
+        with shard_locks:
+            # do something with all the shards
+
+    """
+    def __init__(self, connection, lock_names, lock_root='/ZktoolsLocks',
+                 retry_policy=None):
+        """Create a Zookeeper lock set
+
+        :param connection: Zookeeper connection object
+        :type connection: zc.zk Zookeeper instance
+        :param lock_names: Names of the locks
+        :type lock_names: list
+        :param lock_root: Path to the root lock node to create the locks
+                          under
+        :type lock_root: string
+        :param retry_policy: Policy to retry requests with after
+                             connection loss
+        :type retry_policy: :class:`~zktools.util.RetryPolicy`
+
+        """
+        self._zk = connection
+        self._lock_root = lock_root
+        self._retry_policy = retry_policy
+        self._lock_names = sorted(set(lock_names))
+        self._locknodes = ['%s/%s' % (lock_root, name)
+                           for name in self._lock_names]
+        self._candidates = {}
+        self._locks = []
+        self._revoked = []
+        self._lock_args = ([], {})
+        self._children = lock_children_cache(connection)
+        self._ensure_lock_dirs()
+
+    def _safe_call(self, func, *args):
+        return safe_call(self._zk, func, *args,
+                         retry_policy=self._retry_policy)
+
+    def _ensure_lock_dirs(self):
+        unknown = [locknode for locknode in self._locknodes
+                   if not is_known_path(self._zk, locknode)]
+        results = pipeline(self._zk, [('aexists', (locknode, None))
+                                      for locknode in unknown])
+        missing = []
+        for locknode, result in zip(unknown, results):
+            if result[0] == zookeeper.OK:
+                add_known_path(self._zk, locknode)
+            else:
+                missing.append(locknode)
+        if not missing:
+            return
+
+        try:
+            self._safe_call('create', self._lock_root,
+                            "zktools ZLock dir", [ZOO_OPEN_ACL_UNSAFE], 0)
+        except zookeeper.NodeExistsException:
+            pass
+        results = pipeline(self._zk, [
+            ('acreate', (locknode, "lock", [ZOO_OPEN_ACL_UNSAFE], 0))
+            for locknode in missing])
+        for locknode, result in zip(missing, results):
+            if result[0] not in (zookeeper.OK, zookeeper.NODEEXISTS):
+                # Let the synchronous call retry or raise the error
+                try:
+                    self._safe_call('create', locknode, "lock",
+                                    [ZOO_OPEN_ACL_UNSAFE], 0)
+                except zookeeper.NodeExistsException:
+                    pass
+            add_known_path(self._zk, locknode)
+
+    def __call__(self, *args, **kwargs):
+        self._lock_args = (args, kwargs)
+        return self
+
+    def __enter__(self):
+        args, kwargs = self._lock_args
+        self.acquire(*args, **kwargs)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._lock_args = ([], {})
+        self.release()
+
+    def acquire(self, timeout=None):
+        """Acquire all the locks
+
+        :param timeout: How long to wait to acquire the locks, set to 0 to
+                        get non-blocking behavior.
+        :type timeout: int
+
+        :returns: True if all the locks were acquired, False otherwise, in
+                  which case none of the locks are held.
+        :rtype: bool
+
+        """
+        lock_start = time.time()
+        self._revoked = []
+        self._locks = []
+        prefix = uuid.uuid4().hex + '-'
+
+        # Create all the candidates at once
+        self._create_candidates(prefix, self._locknodes)
+
+        # Check all the lock queues, and watch our candidates for
+        # revocation
+        calls = [('aget_children', (locknode, None))
+                 for locknode in self._locknodes]
+        calls.extend(('aget', (self._candidates[locknode],
+                               self._revoke_watcher))
+                     for locknode in self._locknodes
+                     if locknode in self._candidates)
+        results = pipeline(self._zk, calls)
+        for result in results[len(self._locknodes):]:
+            if result[0] == zookeeper.NONODE or \
+               (result[0] == zookeeper.OK and result[1] == 'unlock'):
+                self._revoked.append(True)
+
+        contended = None
+        for index, (locknode, result) in enumerate(
+                zip(self._locknodes, results)):
+            candidate = self._candidates.get(locknode)
+            if result[0] != zookeeper.OK or candidate is None or \
+               not LockQueue(result[1]).is_first(candidate.rsplit('/')[-1]):
+                contended = index
+                break
+        if contended is None:
+            return True
+
+        # Withdraw from the queues of the locks after the contended
+        # lock, then acquire the rest in order
+        later = self._locknodes[contended + 1:]
+        self._delete_candidates([self._candidates.pop(locknode)
+                                 for locknode in later
+                                 if locknode in self._candidates])
+        for name, locknode in zip(self._lock_names[contended:],
+                                  self._locknodes[contended:]):
+            lock = ZkLock(self._zk, name, self._lock_root,
+                          self._retry_policy)
+            wait_for = None
+            if timeout is not None:
+                wait_for = max(0, timeout - (time.time() - lock_start))
+            candidate = self._candidates.pop(locknode, None)
+            if not lock._acquire_lock('/lock-', wait_for, znode=candidate):
+                self.release()
+                return False
+            self._locks.append(lock)
+            self._candidates[locknode] = lock._candidate_path
+        return True
+
+    def _create_candidates(self, prefix, locknodes, retry=True):
+        results = pipeline(self._zk, [
+            ('acreate', (locknode + '/' + prefix + 'lock-', "0",
+                         [ZOO_OPEN_ACL_UNSAFE],
+                         zookeeper.EPHEMERAL | zookeeper.SEQUENCE))
+            for locknode in locknodes])
+        removed = []
+        for locknode, result in zip(locknodes, results):
+            if result[0] == zookeeper.OK:
+                self._candidates[locknode] = result[1]
+            elif result[0] == zookeeper.NONODE:
+                forget_path(self._zk, locknode)
+                removed.append(locknode)
+            elif retryable(result[0]):
+                # It may have been created anyways
+                children = self._safe_call('get_children', locknode)
+                child = LockQueue(children).find_prefix(prefix[:-1])
+                if child is not None:
+                    self._candidates[locknode] = locknode + '/' + child
+
+        if removed and retry:
+            # The lock nodes were removed since they were last seen,
+            # re-create them and try once more. Locks still without a
+            # candidate are acquired on their own afterwards.
+            self._ensure_lock_dirs()
+            self._create_candidates(prefix, removed, retry=False)
+
+    def _revoke_watcher(self, handle, type, state, path):
+        get_dispatcher().submit(self, self._revoke_check, path, type, state)
+
+    def _revoke_check(self, path, type, state):
+        if path not in self._candidates.values():
+            return
+        if type == zookeeper.CHANGED_EVENT:
+            def revoke_data(handle, return_code, data=None, stat=None):
+                if path not in self._candidates.values():
+                    return
+                if return_code == zookeeper.NONODE or \
+                   (return_code == zookeeper.OK and data == 'unlock'):
+                    self._revoked.append(True)
+            # Read asynchronously, so a connection loss doesn't hold a
+            # dispatcher worker
+            async_call(self._zk, 'aget', (path, self._revoke_watcher),
+                       revoke_data, retry_policy=self._retry_policy)
+        elif type == zookeeper.DELETED_EVENT or \
+                state == zookeeper.EXPIRED_SESSION_STATE:
+            self._revoked.append(True)
+
+    def _delete_candidates(self, candidates):
+        results = pipeline(self._zk, [('adelete', (candidate, -1))
+                                      for candidate in candidates])
+        deleted = 0
+        for candidate, result in zip(candidates, results):
+            if retryable(result[0]):
+                try:
+                    self._safe_call('delete', candidate)
+                except zookeeper.NoNodeException:
+                    continue
+            elif result[0] != zookeeper.OK:
+                continue
+            deleted += 1
+        for candidate in candidates:
+            self._children.invalidate(candidate.rsplit('/', 1)[0])
+        return deleted
+
+    def release(self):
+        """Release all the locks
+
+        :returns: True if all the locks were released, or False if any of
+                  them is no longer valid.
+        :rtype: bool
+
+        """
+        self._revoked = []
+        self._locks = []
+        candidates = list(self._candidates.values())
+        self._candidates = {}
+        return self._delete_candidates(candidates) == len(candidates)
+
+    @property
+    def revoked(self):
+        """Indicate if any of the locks has been revoked
+
+        :returns: True if a lock has been revoked, False otherwise.
+        :rtype: bool
+
+        """
+        return bool(self._revoked) or any(lock.revoked
+                                          for lock in self._locks)
+
+
+def acquire_many(connection, lock_names, timeout=None,
+                 lock_root='/ZktoolsLocks', retry_policy=None):
+    """Acquire many Zookeeper Locks at once
+
+    :param connection: Zookeeper connection object
+    :type connection: zc.zk Zookeeper instance
+    :param lock_names: Names of the locks
+    :type lock_names: list
+    :param timeout: How long to wait to acquire the locks, set to 0 to
+                    get non-blocking behavior.
+    :type timeout: int
+    :param lock_root: Path to the root lock node to create the locks
+                      under
+    :type lock_root: string
+    :param retry_policy: Policy to retry requests with after connection
+                         loss
+    :type retry_policy: :class:`~zktools.util.RetryPolicy`
+    :returns: The acquired :class:`ZkLockSet`, or None if the locks could
+              not be acquired within the timeout.
+
+    Example::
+
+        locks = acquire_many(conn, ['shard1', 'shard2'])
+        try:
+            # do something with all the shards
+        finally:
+            locks.release()
+
+    """
+    locks = ZkLockSet(connection, lock_names, lock_root, retry_policy)
+    if locks.acquire(timeout):
+        return locks
+    return None
+
+
+def has_read_lock(keyname, children, waited=None):
     """Determines if this keyname has a valid read lock
 
     :param keyname: The keyname without full path prefix of the current node
                     being examined
     :type keyname: str
-    :param children: List of the children nodes at this lock point
-    :type children: list
+    :param children: The children nodes at this lock point
+    :type children: :class:`LockQueue` or list
+    :param waited: How long a waiting candidate has waited, in seconds. A
+                   waiting reader gives way to the writers of a higher
+                   priority queued after it, which are returned as the
+                   blocking nodes, see :meth:`LockQueue.outranking`.
+    :type waited: float
 
     """
-    prior_nodes = children[:children.index(keyname)]
-    prior_write_nodes = [x for x in prior_nodes if '-write-' in x]
-    if not prior_write_nodes:
-        return True, None
-    else:
-        return False, prior_write_nodes
-
-
-def has_write_lock(keyname, children):
+    if not isinstance(children, LockQueue):
+        children = LockQueue(children)
+    if children.prior_writer(keyname) is not None:
+        return False, children.prior_writers(keyname)
+    if waited is not None:
+        outranking = children.outranking(keyname, waited, writers=True)
+        if outranking:
+            return False, outranking
+    return True, None
+
+
+def has_write_lock(keyname, children, waited=None):
     """Determines if this keyname has a valid write lock
 
     :param keyname: The keyname without full path prefix of the current node
                     being examined
     :type keyname: str
-    :param children: List of the children nodes at this lock point
-    :type children: list
+    :param children: The children nodes at this lock point
+    :type children: :class:`LockQueue` or list
+    :param waited: How long a waiting candidate has waited, in seconds. A
+                   waiting candidate gives way to the candidates of a
+                   higher priority queued after it, which are returned as
+                   the blocking nodes, see :meth:`LockQueue.outranking`.
+    :type waited: float
 
     """
-    if keyname == children[0]:
-        return True, None
-    return False, children[:children.index(keyname)]
+    if not isinstance(children, LockQueue):
+        children = LockQueue(children)
+    if not children.is_first(keyname):
+        return False, children.prior_nodes(keyname)
+    if waited is not None:
+        outranking = children.outranking(keyname, waited)
+        if outranking:
+            return False, outranking
+    return True, None
 
 
 def lock_cli():
@@ -764,6 +2035,7 @@ def lock_cli():
     from clint.textui import colored
     from clint.textui import columns
     from clint.textui import puts
+    from zc.zk import ZooKeeper
 
     usage = "usage: %prog COMMAND"
     parser = OptionParser(usage=usage)
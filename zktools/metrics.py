@@ -0,0 +1,323 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Zookeeper Operation Metrics
+
+`zktools` reports every Zookeeper request it makes to the metrics hook
+installed with :func:`set_hook`. No hook is installed by default, in which
+case recording costs a single check per request.
+
+A hook is any object with a ``record`` method, see :class:`MetricsHook`.
+Two are provided: an :class:`Aggregator` which keeps per-operation
+statistics grouped by path prefix in memory, and a
+:class:`StatsdExporter` which periodically sends an aggregator's
+statistics to a StatsD server.
+
+The following operations are recorded:
+
+* every :func:`~zktools.util.safe_call`, under the name of the connection
+  method called, with the time spent waiting for the connection to
+  return after connection loss
+* ``create_ephemeral_sequence`` for
+  :func:`~zktools.util.safe_create_ephemeral_sequence`
+* the asynchronous requests of :class:`~zktools.locking.ZkAsyncLock` and
+  :func:`~zktools.util.pipeline`, from the request until its completion is
+  called, under the name of the asynchronous method
+* ``node_load`` for :class:`~zktools.node.ZkNode` value loads
+
+Example::
+
+    from zktools import metrics
+
+    aggregator = metrics.Aggregator(depth=2)
+    metrics.set_hook(aggregator)
+    metrics.StatsdExporter(aggregator, 'statsd.local').start()
+
+    # ... use locks and nodes
+
+    print aggregator.snapshot()[('get_children', '/ZktoolsLocks/my_lock')]
+
+"""
+import logging
+import socket
+import threading
+import time
+
+__all__ = ['MetricsHook', 'Aggregator', 'StatsdExporter', 'set_hook',
+           'get_hook', 'path_prefix', 'timed_call', 'timed_completion']
+
+log = logging.getLogger(__name__)
+
+# The installed hook, None when metrics are disabled
+hook = None
+
+
+def set_hook(new_hook):
+    """Install the hook metrics are reported to
+
+    :param new_hook: Object with a ``record`` method, or None to disable
+                     metrics
+
+    """
+    global hook
+    hook = new_hook
+
+
+def get_hook():
+    """Return the installed metrics hook, or None"""
+    return hook
+
+
+def path_prefix(path, depth):
+    """Return the first `depth` components of a path
+
+    Lock candidates and other generated node names are dropped this way,
+    so operations on the same lock or node are grouped together.
+
+    Example:
+
+    .. code-block:: pycon
+
+        >>> path_prefix('/ZktoolsLocks/my_lock/ab12-lock--0000000001', 2)
+        '/ZktoolsLocks/my_lock'
+
+    """
+    if not path:
+        return ''
+    return '/'.join(path.split('/')[:depth + 1]) or '/'
+
+
+def timed_call(operation, path, func, *args, **kwargs):
+    """Call a function, recording it as an operation on a path"""
+    current = hook
+    if current is None:
+        return func(*args, **kwargs)
+    start = time.time()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as exc:
+        current.record(operation, path, time.time() - start, error=exc)
+        raise
+    current.record(operation, path, time.time() - start)
+    return result
+
+
+def timed_completion(operation, path, completion):
+    """Wrap an asynchronous completion to record the time until it's
+    called
+
+    The completion is returned as is when metrics are disabled.
+
+    """
+    current = hook
+    if current is None:
+        return completion
+    start = time.time()
+
+    def recorded(handle, return_code, *args):
+        current.record(operation, path, time.time() - start,
+                       error=return_code or None)
+        return completion(handle, return_code, *args)
+    return recorded
+
+
+class MetricsHook(object):
+    """Metrics hook interface
+
+    Hooks are called from the thread making the request, or from the
+    Zookeeper event thread for asynchronous requests, and should return
+    quickly.
+
+    """
+    def record(self, operation, path, duration, retries=0, wait=0.0,
+               error=None):
+        """Record an operation
+
+        :param operation: Name of the operation, such as ``get_children``
+        :type operation: str
+        :param path: Zookeeper path operated on, or an empty string
+        :type path: str
+        :param duration: Seconds the operation took, including retries
+        :type duration: float
+        :param retries: Number of times the operation was retried after
+                        connection loss
+        :type retries: int
+        :param wait: Seconds spent waiting for the connection to return
+        :type wait: float
+        :param error: The exception raised by the operation, or the
+                      Zookeeper error code of an asynchronous request,
+                      None if it succeeded
+
+        """
+
+
+class _Stats(object):
+    __slots__ = ('count', 'errors', 'retries', 'total', 'max', 'wait')
+
+    def __init__(self):
+        self.count = self.errors = self.retries = 0
+        self.total = self.max = self.wait = 0.0
+
+    def as_dict(self):
+        return dict(count=self.count, errors=self.errors,
+                    retries=self.retries, total=self.total, max=self.max,
+                    avg=self.count and self.total / self.count or 0.0,
+                    wait=self.wait)
+
+
+class Aggregator(MetricsHook):
+    """In-process metrics aggregator
+
+    Keeps the count, errors, retries, time taken and connection wait of
+    each operation, grouped by path prefix.
+
+    """
+    def __init__(self, depth=2):
+        """Create an aggregator
+
+        :param depth: Number of path components to group operations by
+        :type depth: int
+
+        """
+        self.depth = depth
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, operation, path, duration, retries=0, wait=0.0,
+               error=None):
+        key = (operation, path_prefix(path, self.depth))
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = _Stats()
+            stats.count += 1
+            stats.retries += retries
+            stats.total += duration
+            stats.wait += wait
+            if duration > stats.max:
+                stats.max = duration
+            if error is not None:
+                stats.errors += 1
+
+    def snapshot(self, reset=False):
+        """Return the statistics recorded so far
+
+        :param reset: Whether to start over afterwards
+        :type reset: bool
+        :returns: Dict keyed by the ``(operation, path prefix)`` tuples,
+                  of dicts with the ``count``, ``errors``, ``retries``,
+                  ``total``, ``avg``, ``max`` and ``wait`` of the
+                  operations, times are in seconds.
+        :rtype: dict
+
+        """
+        with self._lock:
+            stats = self._stats
+            if reset:
+                self._stats = {}
+            return dict((key, value.as_dict())
+                        for key, value in stats.items())
+
+    def reset(self):
+        """Clear the statistics"""
+        with self._lock:
+            self._stats = {}
+
+
+class StatsdExporter(object):
+    """Send aggregated metrics to a StatsD server
+
+    Each flush sends the statistics gathered since the last one, then
+    resets the aggregator. For the ``get_children`` operation on
+    ``/ZktoolsLocks/my_lock``, the metrics sent are::
+
+        zktools.get_children.ZktoolsLocks.my_lock.count:12|c
+        zktools.get_children.ZktoolsLocks.my_lock.errors:0|c
+        zktools.get_children.ZktoolsLocks.my_lock.retries:1|c
+        zktools.get_children.ZktoolsLocks.my_lock.avg:1.250|ms
+        zktools.get_children.ZktoolsLocks.my_lock.max:4.100|ms
+        zktools.get_children.ZktoolsLocks.my_lock.wait:0.000|ms
+
+    """
+    max_packet = 512
+
+    def __init__(self, aggregator, host='localhost', port=8125,
+                 prefix='zktools'):
+        """Create a StatsD exporter
+
+        :param aggregator: Aggregator to export the statistics of
+        :type aggregator: :class:`Aggregator`
+        :param host: StatsD host
+        :type host: str
+        :param port: StatsD port
+        :type port: int
+        :param prefix: Prefix of the metric names
+        :type prefix: str
+
+        """
+        self.aggregator = aggregator
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _metric_name(self, operation, path):
+        parts = [self.prefix, operation]
+        parts.extend(part.replace('.', '_')
+                     for part in path.strip('/').split('/') if part)
+        return '.'.join(parts)
+
+    def lines(self, snapshot):
+        """Format a snapshot of statistics as StatsD lines"""
+        lines = []
+        for (operation, path), stats in sorted(snapshot.items()):
+            name = self._metric_name(operation, path)
+            lines.append('%s.count:%d|c' % (name, stats['count']))
+            lines.append('%s.errors:%d|c' % (name, stats['errors']))
+            lines.append('%s.retries:%d|c' % (name, stats['retries']))
+            for key in ('avg', 'max', 'wait'):
+                lines.append('%s.%s:%.3f|ms' % (name, key,
+                                                stats[key] * 1000))
+        return lines
+
+    def flush(self):
+        """Send the statistics gathered since the last flush"""
+        packet = []
+        size = 0
+        for line in self.lines(self.aggregator.snapshot(reset=True)):
+            if packet and size + len(line) + 1 > self.max_packet:
+                self._send('\n'.join(packet))
+                packet, size = [], 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            self._send('\n'.join(packet))
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data.encode('utf-8'), self.address)
+        except socket.error:
+            log.warning("Unable to send metrics to %s:%s", *self.address)
+
+    def start(self, interval=10):
+        """Flush the statistics every `interval` seconds in a thread"""
+        def run():
+            while 1:
+                self._stopped.wait(interval)
+                if self._stopped.is_set():
+                    return
+                self.flush()
+        self._stopped.clear()
+        self._thread = thread = threading.Thread(
+            target=run, name='zktools-statsd')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stop the flushing thread, sending the remaining statistics"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
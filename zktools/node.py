@@ -7,35 +7,79 @@ This module provides a :class:`ZkNode` object which can represent a single
 node from Zookeeper. It can reflect a single value, or a JSON serialized
 value.
 
+All the :class:`ZkNode` objects for the same path on a connection share a
+single data watch and loaded value, so creating many of them for a path
+costs Zookeeper one read and one watch. Decoded values are cached by
+their data for each connection, see :class:`DecodedValueCache`.
+
+How values are saved in nodes is chosen with a :class:`Codec`.
+
+A whole hierarchy of nodes, such as a service configuration, can be
+mirrored at once with a :class:`ZkNodeTree`.
+
 """
 import datetime
 import decimal
+from collections import OrderedDict
 import json
+import logging
 import re
 import threading
+import weakref
+import zlib
+
+try:
+    import zookeeper
+except ImportError:  # pragma: nocover
+    from zktools import _zkconsts as zookeeper
+
+from zktools import metrics
+from zktools.util import add_known_path
+from zktools.util import async_call
+from zktools.util import forget_path
+from zktools.util import get_callback_dispatcher
+from zktools.util import get_dispatcher
+from zktools.util import is_known_path
+from zktools.util import RetryPolicy
+from zktools.util import pipeline
+from zktools.util import safe_call
 
-import zookeeper
+try:
+    import msgpack
+except ImportError:  # pragma: nocover
+    msgpack = None
+
+# Conditional sets aren't retried after connection loss
+_NO_RETRY_POLICY = RetryPolicy(max_attempts=1)
 
 ZOO_OPEN_ACL_UNSAFE = dict(perms=zookeeper.PERM_ALL, scheme='world',
                            id='anyone')
 
 
-CONVERSIONS = {
-    re.compile(r'^\d+\.\d+$'): decimal.Decimal,
-    re.compile(r'^\d+$'): int,
-    re.compile(r'^true$', re.IGNORECASE): lambda x: True,
-    re.compile(r'^false$', re.IGNORECASE): lambda x: False,
-    re.compile(r'^None$', re.IGNORECASE): lambda x: None,
-    re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d+Z$'):
-       lambda x: datetime.datetime.strptime(x, '%Y-%m-%dT%H:%M:%S.%fZ'),
-    re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d+Z$'):
-       lambda x: datetime.datetime.strptime(x, '%Y-%m-%d %H:%M:%S.%fZ'),
-    re.compile(r'^\d{4}-\d{2}-\d{2}$'):
-       lambda x: datetime.datetime.strptime(x, '%Y-%m-%d'),
-}
+log = logging.getLogger(__name__)
 
 JSON_REGEX = re.compile(r'^[\{\[].*[\}\]]$')
 
+# The value conversions in a single expression, tried in this order.
+# Like the '$' of the expressions per type it replaced, a trailing
+# newline is ignored.
+VALUE_REGEX = re.compile(
+    r'^(?:(?P<int>\d+)|(?P<decimal>\d+\.\d+)|'
+    r'(?P<datetime>(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})'
+    r'(?:(?P<separator>[T ])(?P<hour>\d{2}):(?P<minute>\d{2}):'
+    r'(?P<second>\d{2})\.(?P<fraction>\d+)Z)?))$')
+
+KEYWORDS = {}
+for _word, _value in [('true', True), ('false', False), ('none', None)]:
+    KEYWORDS[_word] = KEYWORDS[_word + '\n'] = _value
+del _word, _value
+
+DATETIME_FORMATS = {
+    None: '%Y-%m-%d',
+    'T': '%Y-%m-%dT%H:%M:%S.%fZ',
+    ' ': '%Y-%m-%d %H:%M:%S.%fZ',
+}
+
 # Sad fix for http://bugs.python.org/issue7980
 # We import and use strptime here to ensure the whole chain is fully
 # imported before threading is likely to occur which remedies the bug
@@ -43,17 +87,49 @@ assert datetime.datetime.strptime('2004-02-03T12:10:32.4Z',
                                   '%Y-%m-%dT%H:%M:%S.%fZ')
 
 
+def _load_datetime(value, match):
+    """Build the datetime matched by VALUE_REGEX, as strptime would"""
+    year, month, day, separator, hour, minute, second, fraction = \
+        match.group('year', 'month', 'day', 'separator', 'hour', 'minute',
+                    'second', 'fraction')
+    if value[-1] != '\n' and (fraction is None or len(fraction) <= 6):
+        try:
+            if separator is None:
+                return datetime.datetime(int(year), int(month), int(day))
+            return datetime.datetime(int(year), int(month), int(day),
+                                     int(hour), int(minute), int(second),
+                                     int(fraction.ljust(6, '0')))
+        except ValueError:
+            pass
+    # Not a valid datetime, let strptime raise its error
+    return datetime.datetime.strptime(value, DATETIME_FORMATS[separator])
+
+
 def _load_value(value, use_json=False):
-    """Convert a saved value to the best Python match"""
+    """Convert a saved value to the best Python match
+
+    The value is classified with a single match of :obj:`VALUE_REGEX`,
+    rather than trying an expression per type in turn.
+
+    """
     if use_json and JSON_REGEX.match(value):
         try:
             return json.loads(value)
         except ValueError:
             return value
-    for regex, convert in CONVERSIONS.iteritems():
-        if regex.match(value):
-            return convert(value)
-    return value
+    if len(value) < 7:
+        keyword = KEYWORDS.get(value.lower(), value)
+        if keyword is not value:
+            return keyword
+    match = VALUE_REGEX.match(value)
+    if match is None:
+        return value
+    kind = match.lastgroup
+    if kind == 'int':
+        return int(value)
+    elif kind == 'decimal':
+        return decimal.Decimal(value)
+    return _load_datetime(value, match)
 
 
 def _save_value(value, use_json=False):
@@ -72,6 +148,462 @@ def _save_value(value, use_json=False):
         return str(value)
 
 
+class Codec(object):
+    """Conversion of node values to and from the data saved in Zookeeper
+
+    Subclasses implement :meth:`encode` and :meth:`decode`. Decoded
+    values are cached by their data, unless :attr:`cached` is False.
+
+    Codecs are compared by identity when caching decoded values, so the
+    nodes of a connection should share codec objects, such as the
+    module-level ones.
+
+    """
+    #: Whether decoded values are worth caching
+    cached = True
+
+    def encode(self, value):
+        """Return the data to save for a value"""
+        raise NotImplementedError
+
+    def decode(self, data):
+        """Return the value of saved data"""
+        raise NotImplementedError
+
+
+class TextCodec(Codec):
+    """Values saved as text and coerced into a Python object when loaded
+
+    This is the default, see :class:`ZkNode` for the conversions.
+
+    """
+    def __init__(self, use_json=False):
+        """Create a TextCodec
+
+        :param use_json: Whether values that look like a JSON object should
+                         be deserialized, and dicts/lists saved as JSON.
+        :type use_json: bool
+
+        """
+        self.use_json = use_json
+
+    def encode(self, value):
+        return _save_value(value, use_json=self.use_json)
+
+    def decode(self, data):
+        return _load_value(data, use_json=self.use_json)
+
+
+class RawCodec(Codec):
+    """Values saved as they are, which must be strings
+
+    None is saved as an empty string. Nothing is decoded.
+
+    """
+    cached = False
+
+    def encode(self, value):
+        if value is None:
+            return ''
+        return value
+
+    def decode(self, data):
+        return data
+
+
+class JsonCodec(Codec):
+    """Values saved as JSON, without guessing at their type"""
+    def encode(self, value):
+        return json.dumps(value, separators=(',', ':'))
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """Values saved as MessagePack, a compact binary format
+
+    Requires the ``msgpack`` package.
+
+    """
+    def __init__(self):
+        if msgpack is None:  # pragma: nocover
+            raise ImportError("msgpack is required for MsgpackCodec")
+
+    def encode(self, value):
+        return msgpack.packb(value)
+
+    def decode(self, data):
+        return msgpack.unpackb(data)
+
+
+class CompressedCodec(Codec):
+    """Values of another codec, compressed with zlib once large enough
+
+    Compressed data starts with :obj:`COMPRESSED_HEADER`, a byte that
+    never starts text, JSON or MessagePack data. Data without it is
+    decoded as is, so compression can be turned on for nodes saved
+    without it.
+
+    """
+    def __init__(self, codec=None, min_size=512, level=6):
+        """Create a CompressedCodec
+
+        :param codec: Codec of the values, :obj:`JSON_CODEC` by default
+        :type codec: :class:`Codec`
+        :param min_size: Size of the encoded data from which it's
+                         compressed
+        :type min_size: int
+        :param level: zlib compression level
+        :type level: int
+
+        """
+        self.codec = codec or JSON_CODEC
+        self.min_size = min_size
+        self.level = level
+
+    def encode(self, value):
+        data = self.codec.encode(value)
+        if len(data) < self.min_size:
+            return data
+        return COMPRESSED_HEADER + zlib.compress(data, self.level)
+
+    def decode(self, data):
+        if data[:1] == COMPRESSED_HEADER:
+            data = zlib.decompress(data[1:])
+        return self.codec.decode(data)
+
+
+# Invalid in UTF-8, and never used in MessagePack
+COMPRESSED_HEADER = '\xc1'
+
+TEXT_CODEC = TextCodec()
+TEXT_JSON_CODEC = TextCodec(use_json=True)
+RAW_CODEC = RawCodec()
+JSON_CODEC = JsonCodec()
+
+
+class DecodedValueCache(object):
+    """Least recently used cache of decoded node values
+
+    Values are cached by their codec and data, so the nodes of a
+    connection holding the same data, and a node set back to a prior
+    value, decode it once.
+    The :class:`ZkNode` and :class:`ZkNodeTree` objects of a connection
+    share a cache, see :func:`decoded_value_cache`.
+
+    .. note::
+
+        Decoded values are shared, and must not be modified.
+
+    """
+    def __init__(self, max_size=1024):
+        """Create a DecodedValueCache
+
+        :param max_size: Amount of values to keep
+        :type max_size: int
+
+        """
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def decode(self, data, codec=TEXT_CODEC):
+        """Return the decoded value of node data
+
+        :param data: Data of the node
+        :type data: str
+        :param codec: Codec to decode the data with
+        :type codec: :class:`Codec`
+
+        """
+        if not codec.cached:
+            return codec.decode(data)
+        key = (codec, data)
+        with self._lock:
+            try:
+                value = self._values.pop(key)
+            except KeyError:
+                self._misses += 1
+            else:
+                # Most recently used last
+                self._values[key] = value
+                self._hits += 1
+                return value
+        value = codec.decode(data)
+        with self._lock:
+            self._values[key] = value
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+        return value
+
+    def clear(self):
+        """Drop all the cached values"""
+        with self._lock:
+            self._values.clear()
+
+    def stats(self):
+        """Return a dict of cache counters
+
+        The counters include the amount of ``hits`` and ``misses``, and
+        the current ``size`` and ``max_size`` of the cache.
+
+        """
+        with self._lock:
+            return dict(hits=self._hits, misses=self._misses,
+                        size=len(self._values), max_size=self.max_size)
+
+
+_value_caches = weakref.WeakKeyDictionary()
+_value_caches_lock = threading.Lock()
+
+
+def decoded_value_cache(connection):
+    """Return the decoded value cache shared by all nodes of a connection
+
+    :param connection: Zookeeper connection object
+    :type connection: zc.zk Zookeeper instance
+    :returns: :class:`DecodedValueCache`
+
+    """
+    with _value_caches_lock:
+        cache = _value_caches.get(connection)
+        if cache is None:
+            cache = _value_caches[connection] = DecodedValueCache()
+        return cache
+
+
+class _NodeState(object):
+    """Data and children of a node shared by the :class:`ZkNode` objects
+    of a connection
+
+    The node is read once with a data watch set, and read again when the
+    watch fires. Values are decoded once for each codec, through the
+    decoded value cache of the connection. The children are only
+    read, with a child watch, once asked for.
+
+    """
+    def __init__(self, connection, path):
+        self._zk = connection
+        self.path = path
+        self._values = decoded_value_cache(connection)
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._handle = self._children_handle = None
+        # (data, stat, decoded values by codec), replaced as a whole
+        self._current = None
+        # Bumped when the node is deleted, so reads made before aren't
+        # kept
+        self._generation = 0
+        self._children = None
+        # ZkNode objects with subscribers
+        self._holders = weakref.WeakKeyDictionary()
+
+        # Pending watches must not keep the state alive once no ZkNode
+        # uses it
+        ref = weakref.ref(self)
+
+        def watcher(handle, type, state, path):
+            node_state = ref()
+            if node_state is not None:
+                node_state._watched(type, state)
+
+        def child_watcher(handle, type, state, path):
+            node_state = ref()
+            if node_state is not None:
+                node_state._child_watched(type, state)
+        self._watcher = watcher
+        self._child_watcher = child_watcher
+
+    @property
+    def loaded(self):
+        return self._current is not None and \
+            self._handle == getattr(self._zk, 'handle', None)
+
+    @property
+    def children_loaded(self):
+        return self._children is not None and \
+            self._children_handle == getattr(self._zk, 'handle', None)
+
+    @property
+    def last_modified(self):
+        return self._current[1][u'mtime']
+
+    @property
+    def version(self):
+        return self._current[1][u'version']
+
+    def replaced(self, stat):
+        """Indicate whether the loaded value is of a node deleted since,
+        judging by the stat of the node now there"""
+        current = self._current
+        return current is not None and \
+            current[1][u'czxid'] != stat[u'czxid']
+
+    @property
+    def children(self):
+        return self._children
+
+    def load(self, call, force=False):
+        """Read the node with a data watch, unless it's already loaded
+
+        :param call: Function calling a connection method, which loads
+                     the node on behalf of a :class:`ZkNode`
+
+        """
+        with self._load_lock:
+            if self.loaded and not force:
+                return
+            while 1:
+                handle = getattr(self._zk, 'handle', None)
+                generation = self._generation
+                data, stat = metrics.timed_call(
+                    'node_load', self.path, call, 'get', self.path,
+                    self._watcher)
+                if generation == self._generation:
+                    break
+                # Deleted since it was read, read it again
+            self._handle = handle
+            self._current = (data, stat, {})
+
+    def refresh(self, call):
+        """Read the node again, keeping the pending data watch"""
+        if not self.loaded:
+            return self.load(call)
+        generation = self._generation
+        data, stat = metrics.timed_call('node_load', self.path, call,
+                                        'get', self.path)
+        with self._load_lock:
+            if generation != self._generation:
+                # Deleted since it was read
+                return
+            current = self._current
+            # Don't go back to an older version read by the watch
+            if current is None or \
+               stat[u'version'] >= current[1][u'version']:
+                self._current = (data, stat, {})
+
+    def load_children(self, call):
+        """Read the children with a child watch, unless they're already
+        loaded"""
+        with self._load_lock:
+            if self.children_loaded:
+                return
+            handle = getattr(self._zk, 'handle', None)
+            children = call('get_children', self.path, self._child_watcher)
+            self._children_handle = handle
+            self._children = sorted(children)
+
+    def value(self, codec):
+        return self._decode(self._current, codec)
+
+    def versioned_value(self, codec):
+        """Return the value and the version it has"""
+        current = self._current
+        return self._decode(current, codec), current[1][u'version']
+
+    def _decode(self, current, codec):
+        data, stat, decoded = current
+        try:
+            return decoded[codec]
+        except KeyError:
+            value = decoded[codec] = self._values.decode(data, codec)
+            return value
+
+    def saved(self, data, version=None):
+        """Reflect data set on the node, ahead of the watch firing
+
+        :param version: Version of the node after a version-checked set
+
+        """
+        current = self._current
+        if current is not None:
+            stat = current[1]
+            if version is not None:
+                stat = dict(stat)
+                stat[u'version'] = version
+            self._current = (data, stat, {})
+
+    def add_holder(self, node):
+        """Notify a ZkNode of changes"""
+        with self._lock:
+            self._holders[node] = True
+
+    def _changed(self, method):
+        with self._lock:
+            holders = list(self._holders.keys())
+        for holder in holders:
+            getattr(holder, method)()
+
+    def _watched(self, type, state):
+        # Changes arriving while a read is waiting are collapsed
+        if type == zookeeper.CHANGED_EVENT:
+            get_dispatcher().submit_latest(self, self._reload)
+        elif type == zookeeper.DELETED_EVENT or \
+                state in (zookeeper.EXPIRED_SESSION_STATE,
+                          zookeeper.AUTH_FAILED_STATE):
+            # The watch is gone, load again when next used. Reads still
+            # in flight are dropped.
+            self._generation += 1
+            self._current = None
+
+    def _reload(self):
+        generation = self._generation
+
+        def reloaded(handle, return_code, data=None, stat=None):
+            if generation != self._generation:
+                return
+            if return_code != zookeeper.OK:
+                # Without a watch, load again when next used
+                self._current = None
+                return
+            self._current = (data, stat, {})
+            self._changed('_value_changed')
+        # Read asynchronously, so a connection loss doesn't hold a
+        # dispatcher worker
+        async_call(self._zk, 'aget', (self.path, self._watcher),
+                   metrics.timed_completion('node_load', self.path,
+                                            reloaded))
+
+    def _child_watched(self, type, state):
+        if type == zookeeper.CHILD_EVENT:
+            get_dispatcher().submit_latest(self, self._reload_children)
+        elif type == zookeeper.DELETED_EVENT or \
+                state in (zookeeper.EXPIRED_SESSION_STATE,
+                          zookeeper.AUTH_FAILED_STATE):
+            self._children = None
+
+    def _reload_children(self):
+        def reloaded(handle, return_code, children=None):
+            if return_code != zookeeper.OK:
+                self._children = None
+                return
+            self._children = sorted(children)
+            self._changed('_children_changed')
+        async_call(self._zk, 'aget_children',
+                   (self.path, self._child_watcher), reloaded)
+
+
+_node_states = weakref.WeakKeyDictionary()
+_node_states_lock = threading.Lock()
+
+
+def _node_state(connection, path):
+    """Return the state shared by the ZkNode objects of a connection for
+    a path"""
+    with _node_states_lock:
+        states = _node_states.get(connection)
+        if states is None:
+            states = _node_states[connection] = \
+                weakref.WeakValueDictionary()
+        state = states.get(path)
+        if state is None:
+            state = states[path] = _NodeState(connection, path)
+        return state
+
+
 class ZkNode(object):
     """Zookeeper Node
 
@@ -100,6 +632,10 @@ class ZkNode(object):
         be a JSON object and will be coerced if possible. If coercion
         fails, the string will be returned as is.
 
+    Values can instead be saved with another :class:`Codec`, such as
+    :obj:`RAW_CODEC` to use strings as they are, :obj:`JSON_CODEC`, or a
+    :class:`CompressedCodec` for large values.
+
     Example::
 
         from zc.zk import ZooKeeper
@@ -114,25 +650,36 @@ class ZkNode(object):
         # Set the value in zookeeper
         node.value = 483.24
 
+        # Subscribe a function to be called when the node's value
+        # changes (note this will be called immediately with the
+        # current value)
+        @node.subscribe
+        def value_changed(value):
+            # do something with the value
+
         # Show the children of the node
         print list(node.children)
 
         # Subscribe a function to be called when the node's
         # children change (note this will be called immediately
-        # with a zc.zk Children instance)
+        # with the node's children)
         @node.children
         def my_function(children):
-            # do something with node.children or prior_children
+            # do something with the children
 
     The default behavior is to track changes to the node, so that
     the ``value`` attribute always reflects the node's value in
     Zookeeper. Additional subscriber functions are called when the
-    Zookeeper event watch is triggered and are run in a separate
-    event thread. Depending on how fast the value/children are
+    Zookeeper event watch is triggered and are run on
+    :func:`~zktools.util.get_callback_dispatcher`, one at a time for each
+    :class:`ZkNode`. Depending on how fast the value/children are
     changing the subscriber functions may run consecutively and
-    could miss intermediate values.
+    could miss intermediate values, changes made while a notification
+    is waiting to run are collapsed into a single call with the latest
+    value.
 
-    Return values of subscriber functions are ignored.
+    Return values of subscriber functions are ignored. Subscriptions last
+    as long as the :class:`ZkNode` they were made on.
 
     .. warning::
 
@@ -142,7 +689,8 @@ class ZkNode(object):
 
     """
     def __init__(self, connection, path, default=None, use_json=False,
-                 permission=ZOO_OPEN_ACL_UNSAFE, create_mode=0):
+                 permission=ZOO_OPEN_ACL_UNSAFE, create_mode=0,
+                 retry_policy=None, codec=None):
         """Create a Zookeeper Node
 
         Creating a ZkNode by default attempts to load the value, and
@@ -167,35 +715,63 @@ class ZkNode(object):
         :type permission: dict
         :param create_mode: Persistent or ephemeral creation mode
         :type create_mode: int
+        :param retry_policy: Policy to retry loading and saving the value
+                             with after connection loss, connection errors
+                             are raised right away by default.
+        :type retry_policy: :class:`~zktools.util.RetryPolicy`
+        :param codec: Codec to save and load the value with, use_json is
+                      ignored when given.
+        :type codec: :class:`Codec`
         """
         self._zk = connection
+        self._retry_policy = retry_policy
         self._path = path
-        self._cv = threading.Condition()
-        self._use_json = use_json
-        self._value = None
-        self._reload_data = False
-
-        if not connection.exists(path):
-            self._zk.create(self._path,
-                            _save_value(default, use_json=use_json),
-                            [permission], create_mode)
-        self._load()
+        self._permission = permission
+        self._create_mode = create_mode
+        self._codec = codec or (use_json and TEXT_JSON_CODEC or TEXT_CODEC)
+        self._value_subscribers = []
+        self._children_subscribers = []
+        self._state = state = _node_state(connection, path)
 
-    def _node_watcher(self, handle, type, state, path):
-        """Watch a node for updates"""
-        if type == zookeeper.CHANGED_EVENT:
-            data = self._zk.get(self._path, self._node_watcher)
-            self.last_modified = data[1][u'mtime']
-            self._value = _load_value(data[0], use_json=self._use_json)
-        elif type in (zookeeper.EXPIRED_SESSION_STATE,
-                      zookeeper.AUTH_FAILED_STATE):
-            self._reload_data = True
+        # Persistent nodes seen before in this session need no checking.
+        # A node created or replaced since the shared state was loaded
+        # is read again, as its deletion may not have been seen yet.
+        reload = False
+        if not is_known_path(connection, path):
+            stat = self._call('exists', path)
+            if not stat:
+                reload = self._create(default, permission, create_mode)
+            else:
+                reload = state.replaced(stat)
+        try:
+            state.load(self._call, force=reload)
+        except zookeeper.NoNodeException:
+            # Removed since we last saw it
+            forget_path(connection, path)
+            self._create(default, permission, create_mode)
+            state.load(self._call)
+        if not create_mode & zookeeper.EPHEMERAL:
+            add_known_path(connection, path)
 
-    def _load(self):
-        """Load data from the node, and coerce as necessary"""
-        data = self._zk.get(self._path, self._node_watcher)
-        self.last_modified = data[1][u'mtime']
-        self._value = _load_value(data[0], use_json=self._use_json)
+    def _call(self, func, *args):
+        """Call a connection method, retrying with the retry policy"""
+        if self._retry_policy is None:
+            return getattr(self._zk, func)(*args)
+        return safe_call(self._zk, func, *args,
+                         retry_policy=self._retry_policy)
+
+    def _create(self, default, permission, create_mode):
+        """Create the node with its default value
+
+        :returns: False if the node already existed
+
+        """
+        try:
+            self._call('create', self._path, self._codec.encode(default),
+                       [permission], create_mode)
+        except zookeeper.NodeExistsException:
+            return False
+        return True
 
     @property
     def value(self):
@@ -205,10 +781,17 @@ class ZkNode(object):
         the value reloaded.
 
         """
-        if self._reload_data:
-            self._load()
-            self._reload = False
-        return self._value
+        if not self._state.loaded:
+            self._state.load(self._call)
+        return self._state.value(self._codec)
+
+    @property
+    def last_modified(self):
+        """Zookeeper modification time of the node, in milliseconds from
+        epoch"""
+        if not self._state.loaded:
+            self._state.load(self._call)
+        return self._state.last_modified
 
     @value.setter
     def value(self, value):
@@ -218,8 +801,481 @@ class ZkNode(object):
         :type value: Any str'able object
 
         """
-        self._value = val = _save_value(value, use_json=self._use_json)
-        self._zk.set(self._path, val)
+        val = self._codec.encode(value)
+        try:
+            self._call('set', self._path, val)
+        except zookeeper.NoNodeException:
+            # Removed since we last saw it
+            forget_path(self._zk, self._path)
+            self._create(value, self._permission, self._create_mode)
+            self._call('set', self._path, val)
+            if not self._create_mode & zookeeper.EPHEMERAL:
+                add_known_path(self._zk, self._path)
+            # The loaded stat is of the node removed
+            self._state.load(self._call, force=True)
+            return
+        self._state.saved(val)
+
+    @property
+    def version(self):
+        """Zookeeper version of the node's value, for
+        :meth:`compare_and_set`"""
+        if not self._state.loaded:
+            self._state.load(self._call)
+        return self._state.version
+
+    def compare_and_set(self, expected_version, value):
+        """Set the value to a new one, if the node's value still has a
+        version
+
+        This takes a single request, rather than holding a lock around
+        reading and setting the value.
+
+        :param expected_version: Version of the value being replaced, as
+                                 given by :attr:`version`
+        :type expected_version: int
+        :param value: The value of the node
+        :returns: True if the value was set, False if it was changed in
+                  the meantime, in which case the node's value is read
+                  again.
+        :rtype: bool
+        :raises: :class:`zookeeper.ConnectionLossException` if the
+                 connection was lost before the reply arrived, whether
+                 the value was set is then unknown.
+
+        .. note::
+
+            The set isn't retried after connection loss, even with a
+            ``retry_policy``. If the first attempt went through, the
+            retry would fail with a bad version and the caller would
+            set the value again.
+
+        """
+        val = self._codec.encode(value)
+        try:
+            safe_call(self._zk, 'set', self._path, val, expected_version,
+                      retry_policy=_NO_RETRY_POLICY)
+        except zookeeper.BadVersionException:
+            self._state.refresh(self._call)
+            return False
+        self._state.saved(val, expected_version + 1)
+        return True
+
+    def update(self, func, max_attempts=None):
+        """Change the value with a function of the current value
+
+        The function is called with the value, and its result is set with
+        :meth:`compare_and_set`. If the value was changed in the meantime,
+        the function is called again with the new value.
+
+        Example::
+
+            node.update(lambda value: value + 1)
+
+        :param func: Function returning the new value
+        :param max_attempts: How many times to try at most, tries until
+                             the value is set by default.
+        :type max_attempts: int
+        :returns: The new value
+        :raises: :class:`zookeeper.BadVersionException` if the value
+                 kept changing for max_attempts, and the connection loss
+                 errors of :meth:`compare_and_set`
+
+        """
+        attempts = 0
+        while 1:
+            if not self._state.loaded:
+                self._state.load(self._call)
+            current, version = self._state.versioned_value(self._codec)
+            value = func(current)
+            if self.compare_and_set(version, value):
+                return value
+            attempts += 1
+            if max_attempts is not None and attempts >= max_attempts:
+                raise zookeeper.BadVersionException(
+                    "%s changed %s times" % (self._path, attempts))
+
+    @property
+    def children(self):
+        """The children of the node, see :class:`NodeChildren`"""
+        return NodeChildren(self)
+
+    def subscribe(self, func):
+        """Subscribe a function to changes of the node's value
+
+        The function is called right away with the current value, and
+        with the new value after each change. It can be used as a
+        decorator.
+
+        :param func: Function to call with the value
+        :returns: The function
+
+        """
+        self._value_subscribers.append(func)
+        self._state.add_holder(self)
+        func(self.value)
+        return func
+
+    def unsubscribe(self, func):
+        """Stop calling a function subscribed to the node's value or
+        children"""
+        for subscribers in (self._value_subscribers,
+                            self._children_subscribers):
+            if func in subscribers:
+                subscribers.remove(func)
+
+    def _value_changed(self):
+        if self._value_subscribers:
+            get_callback_dispatcher().submit_latest(self,
+                                                    self._notify_value)
+
+    def _children_changed(self):
+        if self._children_subscribers:
+            get_callback_dispatcher().submit_latest(self,
+                                                    self._notify_children)
+
+    def _notify_value(self):
+        if not self._state.loaded:
+            return
+        self._notify(self._value_subscribers,
+                     self._state.value(self._codec))
+
+    def _notify_children(self):
+        if not self._state.children_loaded:
+            return
+        self._notify(self._children_subscribers, self.children)
+
+    def _notify(self, subscribers, value):
+        for func in list(subscribers):
+            try:
+                func(value)
+            except Exception:
+                log.exception("Error in subscriber %r of %s", func,
+                              self._path)
+
+    @property
+    def connected(self):
+        """Indicate whether a connection to Zookeeper exists"""
+        return self._zk.connected
+
+
+class NodeChildren(object):
+    """Children of a :class:`ZkNode`
+
+    Iterating over it gives the names of the node's children, sorted.
+    They're kept up to date with a child watch shared by the
+    :class:`ZkNode` objects of the connection, and only read once first
+    asked for.
+
+    Calling it with a function subscribes the function to changes of
+    the children, it's called right away and after each change with
+    this object. It can be used as a decorator, see :class:`ZkNode`.
+
+    """
+    def __init__(self, node):
+        self._node = node
+
+    def _names(self):
+        state = self._node._state
+        if not state.children_loaded:
+            state.load_children(self._node._call)
+        return state.children
+
+    def __iter__(self):
+        return iter(self._names())
+
+    def __len__(self):
+        return len(self._names())
+
+    def __contains__(self, name):
+        return name in self._names()
+
+    def __repr__(self):
+        return '<NodeChildren %s %r>' % (self._node._path, self._names())
+
+    def __call__(self, func):
+        node = self._node
+        node._children_subscribers.append(func)
+        node._state.add_holder(node)
+        # Set the child watch even if the function doesn't read them
+        self._names()
+        func(self)
+        return func
+
+
+class ZkNodeTree(object):
+    """Mirror of a subtree of Zookeeper nodes
+
+    The values and children of a node and all of its descendants are
+    kept in memory, and up to date with data and child watches. Values
+    are converted like those of :class:`ZkNode`.
+
+    The tree is read one level at a time, sending the reads of all the
+    nodes of a level at once, so loading it costs a round-trip per level
+    rather than per node. Nodes created later are read the same way when
+    the child watch of their parent fires.
+
+    Nodes are looked up by their path relative to the root of the tree,
+    the root itself being ``''``.
+
+    Example::
+
+        from zc.zk import ZooKeeper
+        from zktools.node import ZkNodeTree
+
+        conn = ZooKeeper()
+        config = ZkNodeTree(conn, '/services/web')
+
+        # prints out the value of /services/web/db/host
+        print config['db/host']
+
+        # prints out the names of the children of /services/web/db
+        print config.children('db')
+
+    If the Zookeeper session expired, the tree is read again when next
+    used.
+
+    """
+    def __init__(self, connection, path, use_json=False, retry_policy=None,
+                 codec=None):
+        """Create a Zookeeper Node Tree
+
+        :param connection: Zookeeper connection object
+        :type connection: zc.zk Zookeeper instance
+        :param path: Path to the root node of the tree, which must exist
+        :type path: str
+        :param use_json: Whether values that look like a JSON object should
+                         be deserialized.
+        :type use_json: bool
+        :param retry_policy: Policy to retry reading nodes with after
+                             connection loss, connection errors are raised
+                             right away by default.
+        :type retry_policy: :class:`~zktools.util.RetryPolicy`
+        :param codec: Codec to load the values with, use_json is ignored
+                      when given.
+        :type codec: :class:`Codec`
+
+        :raises: :class:`zookeeper.NoNodeException` if the root node
+                 doesn't exist
+        """
+        self._zk = connection
+        self._path = path.rstrip('/') or '/'
+        self._codec = codec or (use_json and TEXT_JSON_CODEC or TEXT_CODEC)
+        self._retry_policy = retry_policy
+        self._values = decoded_value_cache(connection)
+        self._lock = threading.Lock()
+        self._handle = None
+        self._expired = False
+        # (data, stat, decoded values by codec) by relative path
+        self._nodes = {}
+        # Sorted names of the children by relative path
+        self._children = {}
+
+        # Pending watches must not keep the tree alive once unused
+        ref = weakref.ref(self)
+
+        def watcher(handle, type, state, path):
+            tree = ref()
+            if tree is not None:
+                tree._watched(type, state, path, tree._reload)
+
+        def child_watcher(handle, type, state, path):
+            tree = ref()
+            if tree is not None:
+                tree._watched(type, state, path, tree._reload_children)
+        self._watcher = watcher
+        self._child_watcher = child_watcher
+        self._load()
+
+    def _full(self, key):
+        if not key:
+            return self._path
+        return self._path.rstrip('/') + '/' + key
+
+    def _relative(self, path):
+        return path[len(self._path):].lstrip('/')
+
+    def _call(self, func, *args):
+        """Call a connection method, retrying with the retry policy
+
+        Returns None rather than raising if the node doesn't exist.
+
+        """
+        try:
+            if self._retry_policy is None:
+                return getattr(self._zk, func)(*args)
+            return safe_call(self._zk, func, *args,
+                             retry_policy=self._retry_policy)
+        except zookeeper.NoNodeException:
+            return None
+
+    def _load(self):
+        """Read the whole tree"""
+        handle = getattr(self._zk, 'handle', None)
+        self._expired = False
+        with self._lock:
+            self._nodes.clear()
+            self._children.clear()
+        self._load_subtrees([''])
+        if '' not in self._nodes:
+            raise zookeeper.NoNodeException(self._path)
+        self._handle = handle
+
+    def _load_subtrees(self, keys):
+        """Read nodes and all of their descendants, a level at a time"""
+        while keys:
+            calls = []
+            for key in keys:
+                path = self._full(key)
+                calls.append(('aget', (path, self._watcher)))
+                calls.append(('aget_children', (path, self._child_watcher)))
+            results = pipeline(self._zk, calls)
+
+            next_keys = []
+            for index, key in enumerate(keys):
+                path = self._full(key)
+                got, listed = results[2 * index:2 * index + 2]
+                if got[0] == zookeeper.OK:
+                    got = got[1:]
+                elif got[0] == zookeeper.NONODE:
+                    got = None
+                else:
+                    # Let the synchronous call retry or raise the error
+                    got = self._call('get', path, self._watcher)
+                if listed[0] == zookeeper.OK:
+                    listed = listed[1]
+                elif listed[0] == zookeeper.NONODE:
+                    listed = None
+                else:
+                    listed = self._call('get_children', path,
+                                        self._child_watcher)
+                if got is None or listed is None:
+                    self._remove(key)
+                    continue
+
+                data, stat = got
+                prefix = key and key + '/' or ''
+                with self._lock:
+                    self._nodes[key] = (data, stat, {})
+                    self._children[key] = sorted(listed)
+                next_keys.extend(prefix + name for name in listed)
+            keys = next_keys
+
+    def _remove(self, key):
+        """Forget a node and its descendants"""
+        prefix = key + '/'
+        with self._lock:
+            for known in [x for x in self._nodes
+                          if x == key or x.startswith(prefix) or not key]:
+                del self._nodes[known]
+                self._children.pop(known, None)
+
+    def _watched(self, type, state, path, reload):
+        if state in (zookeeper.EXPIRED_SESSION_STATE,
+                     zookeeper.AUTH_FAILED_STATE):
+            # The watches are gone, read the tree again when next used
+            self._expired = True
+        elif type in (zookeeper.CHANGED_EVENT, zookeeper.DELETED_EVENT,
+                      zookeeper.CHILD_EVENT):
+            # Reading the node requires synchronous calls, which must not
+            # be run in the Zookeeper event thread nor hold up its other
+            # events. Changes of a node are handled in order, and
+            # collapsed while waiting.
+            get_callback_dispatcher().submit_latest((self, path), reload,
+                                                    self._relative(path))
+
+    def _reload(self, key):
+        got = self._call('get', self._full(key), self._watcher)
+        if got is None:
+            self._remove(key)
+            return
+        data, stat = got
+        with self._lock:
+            if key in self._nodes:
+                self._nodes[key] = (data, stat, {})
+
+    def _reload_children(self, key):
+        children = self._call('get_children', self._full(key),
+                              self._child_watcher)
+        if children is None:
+            # The data watch removes the node
+            return
+        prefix = key and key + '/' or ''
+        with self._lock:
+            if key not in self._nodes:
+                return
+            prior = set(self._children.get(key, ()))
+            self._children[key] = sorted(children)
+        for name in prior.difference(children):
+            self._remove(prefix + name)
+        self._load_subtrees([prefix + name for name in children
+                             if name not in prior])
+
+    def _check_handle(self):
+        if self._expired or \
+           self._handle != getattr(self._zk, 'handle', None):
+            self._load()
+
+    def __getitem__(self, key):
+        """Return the value of a node
+
+        :param key: Path of the node relative to the root of the tree
+        :raises: :class:`KeyError` if the node isn't in the tree
+
+        """
+        self._check_handle()
+        data, stat, decoded = self._nodes[key]
+        try:
+            return decoded[self._codec]
+        except KeyError:
+            value = decoded[self._codec] = self._values.decode(
+                data, self._codec)
+            return value
+
+    def get(self, key, default=None):
+        """Return the value of a node, or a default if it isn't in the
+        tree"""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        self._check_handle()
+        return key in self._nodes
+
+    def __len__(self):
+        self._check_handle()
+        return len(self._nodes)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        """Return the relative paths of the nodes in the tree, sorted"""
+        self._check_handle()
+        return sorted(self._nodes)
+
+    def items(self):
+        """Return the relative paths and values of the nodes in the tree,
+        sorted by path"""
+        return [(key, self.get(key)) for key in self.keys()]
+
+    def children(self, key=''):
+        """Return the sorted names of the children of a node
+
+        :param key: Path of the node relative to the root of the tree
+        :raises: :class:`KeyError` if the node isn't in the tree
+
+        """
+        self._check_handle()
+        return list(self._children[key])
+
+    def last_modified(self, key=''):
+        """Return the Zookeeper modification time of a node, in
+        milliseconds from epoch"""
+        self._check_handle()
+        return self._nodes[key][1][u'mtime']
 
     @property
     def connected(self):
@@ -0,0 +1,584 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""In-memory Zookeeper for Tests and Benchmarks
+
+This module provides :class:`FakeZooKeeper`, a pure-Python stand-in for
+the zc.zk ``ZooKeeper`` connection object that implements the parts of
+its API used by `zktools`, backed by a :class:`FakeZooKeeperServer` held
+in memory. Several sessions can share a server to simulate separate
+clients contending for the same locks.
+
+Like the real client, each session sends its requests in order, and
+calls completion callbacks and watchers from a single event thread.
+Latency can be added to every request, and connection loss, session
+expiration and other errors can be injected to test how the code using
+Zookeeper copes with them.
+
+Neither Zookeeper nor its Python binding need to be installed. Without
+the binding, `zktools` uses the constants and exceptions defined in
+``zktools._zkconsts`` instead.
+
+Example::
+
+    from zktools.testing import FakeZooKeeper, FakeZooKeeperServer
+    from zktools.locking import ZkLock
+
+    server = FakeZooKeeperServer()
+    client1 = FakeZooKeeper(server)
+    client2 = FakeZooKeeper(server, latency=0.001)
+
+    lock = ZkLock(client1, 'my_lock')
+    with lock:
+        # client2 can't get the lock
+        ZkLock(client2, 'my_lock').acquire(timeout=0)
+
+    # Make the next create fail after it was applied, as if the
+    # connection dropped before the response arrived
+    client1.fail_next('create', zookeeper.CONNECTIONLOSS, applied=True)
+
+    # Expire the session, removing its ephemeral nodes
+    client1.expire_session()
+
+"""
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from Queue import Queue
+
+try:
+    import zookeeper
+except ImportError:  # pragma: nocover
+    from zktools import _zkconsts as zookeeper
+
+__all__ = ['FakeZooKeeper', 'FakeZooKeeperServer']
+
+log = logging.getLogger(__name__)
+
+_handles = itertools.count(1)
+
+# Exceptions raised by synchronous calls for each error code
+ERRORS = {}
+for _code, _name in [
+        ('NONODE', 'NoNodeException'),
+        ('NODEEXISTS', 'NodeExistsException'),
+        ('BADVERSION', 'BadVersionException'),
+        ('NOTEMPTY', 'NotEmptyException'),
+        ('NOCHILDRENFOREPHEMERALS', 'NoChildrenForEphemeralsException'),
+        ('BADARGUMENTS', 'BadArgumentsException'),
+        ('CONNECTIONLOSS', 'ConnectionLossException'),
+        ('OPERATIONTIMEOUT', 'OperationTimeoutException'),
+        ('SESSIONEXPIRED', 'SessionExpiredException'),
+        ('CLOSING', 'ClosingException')]:
+    ERRORS[getattr(zookeeper, _code)] = getattr(zookeeper, _name)
+del _code, _name
+
+
+class _Error(Exception):
+    """Carries an error code out of a server operation"""
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+class _Node(object):
+    __slots__ = ('data', 'children', 'owner', 'czxid', 'mzxid', 'pzxid',
+                 'ctime', 'mtime', 'version', 'cversion')
+
+    def __init__(self, data, owner, zxid, now):
+        self.data = data
+        self.children = set()
+        self.owner = owner
+        self.czxid = self.mzxid = self.pzxid = zxid
+        self.ctime = self.mtime = now
+        self.version = self.cversion = 0
+
+    def stat(self):
+        return dict(czxid=self.czxid, mzxid=self.mzxid, pzxid=self.pzxid,
+                    ctime=self.ctime, mtime=self.mtime,
+                    version=self.version, cversion=self.cversion,
+                    aversion=0, ephemeralOwner=self.owner,
+                    dataLength=len(self.data or ''),
+                    numChildren=len(self.children))
+
+
+def _parent(path):
+    return path.rsplit('/', 1)[0] or '/'
+
+
+class FakeZooKeeperServer(object):
+    """In-memory Zookeeper server
+
+    Holds the node tree and watches shared by :class:`FakeZooKeeper`
+    sessions. Operation counts of every session are totalled in
+    :attr:`counts`.
+
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.zxid = 0
+        self.time = 0
+        self.nodes = {'/': _Node('', 0, 0, 0)}
+        self.data_watches = {}
+        self.child_watches = {}
+        self.counts = {}
+
+    def _now(self):
+        # Keep modification times in the order of the changes, even when
+        # several happen within the same millisecond
+        self.time = max(int(time.time() * 1000), self.time + 1)
+        return self.time
+
+    def _node(self, path):
+        node = self.nodes.get(path)
+        if node is None:
+            raise _Error(zookeeper.NONODE)
+        return node
+
+    def _add_watch(self, watches, path, session, watcher):
+        if watcher is not None:
+            watches.setdefault(path, []).append((session, watcher))
+
+    def _trigger(self, watches, path, type):
+        for session, watcher in watches.pop(path, ()):
+            session._deliver(watcher, type, zookeeper.CONNECTED_STATE, path)
+
+    def count(self, operation):
+        with self.lock:
+            self.counts[operation] = self.counts.get(operation, 0) + 1
+
+    def create(self, session, path, data, acl, flags):
+        if not path.startswith('/') or path.endswith('/') and path != '/':
+            raise _Error(zookeeper.BADARGUMENTS)
+        parent_path = _parent(path)
+        parent = self._node(parent_path)
+        if parent.owner:
+            raise _Error(zookeeper.NOCHILDRENFOREPHEMERALS)
+        if flags & zookeeper.SEQUENCE:
+            path = '%s%010d' % (path, parent.cversion)
+        if path in self.nodes:
+            raise _Error(zookeeper.NODEEXISTS)
+
+        self.zxid += 1
+        owner = flags & zookeeper.EPHEMERAL and session.handle or 0
+        self.nodes[path] = _Node(data, owner, self.zxid, self._now())
+        parent.children.add(path.rsplit('/', 1)[1])
+        parent.cversion += 1
+        parent.pzxid = self.zxid
+        if owner:
+            session._ephemerals.add(path)
+        self._trigger(self.data_watches, path, zookeeper.CREATED_EVENT)
+        self._trigger(self.child_watches, parent_path, zookeeper.CHILD_EVENT)
+        return path
+
+    def delete(self, session, path, version):
+        node = self._node(path)
+        if version != -1 and version != node.version:
+            raise _Error(zookeeper.BADVERSION)
+        if node.children:
+            raise _Error(zookeeper.NOTEMPTY)
+        self._remove(path)
+
+    def _remove(self, path):
+        node = self.nodes.pop(path)
+        parent_path = _parent(path)
+        parent = self.nodes[parent_path]
+        self.zxid += 1
+        parent.children.discard(path.rsplit('/', 1)[1])
+        parent.cversion += 1
+        parent.pzxid = self.zxid
+        if node.owner:
+            for session in FakeZooKeeper._sessions.get(node.owner, ()):
+                session._ephemerals.discard(path)
+        self._trigger(self.data_watches, path, zookeeper.DELETED_EVENT)
+        self._trigger(self.child_watches, path, zookeeper.DELETED_EVENT)
+        self._trigger(self.child_watches, parent_path, zookeeper.CHILD_EVENT)
+
+    def set(self, session, path, data, version):
+        node = self._node(path)
+        if version != -1 and version != node.version:
+            raise _Error(zookeeper.BADVERSION)
+        self.zxid += 1
+        node.data = data
+        node.version += 1
+        node.mzxid = self.zxid
+        node.mtime = self._now()
+        self._trigger(self.data_watches, path, zookeeper.CHANGED_EVENT)
+        return node.stat()
+
+    def get(self, session, path, watcher):
+        node = self._node(path)
+        self._add_watch(self.data_watches, path, session, watcher)
+        return node.data, node.stat()
+
+    def exists(self, session, path, watcher):
+        self._add_watch(self.data_watches, path, session, watcher)
+        node = self._node(path)
+        return node.stat()
+
+    def get_children(self, session, path, watcher):
+        node = self._node(path)
+        self._add_watch(self.child_watches, path, session, watcher)
+        return list(node.children)
+
+    def remove_watches(self, session):
+        """Remove all the watches of a session, returning them"""
+        removed = []
+        for watches in (self.data_watches, self.child_watches):
+            for path in list(watches):
+                kept = []
+                for watch in watches[path]:
+                    if watch[0] is session:
+                        removed.append(watch[1])
+                    else:
+                        kept.append(watch)
+                if kept:
+                    watches[path] = kept
+                else:
+                    del watches[path]
+        return removed
+
+    def session_watchers(self, session):
+        """Return all the watchers registered by a session"""
+        watchers = []
+        for watches in (self.data_watches, self.child_watches):
+            for path_watches in watches.values():
+                watchers.extend(watcher for watch_session, watcher
+                                in path_watches if watch_session is session)
+        return watchers
+
+
+class FakeZooKeeper(object):
+    """In-memory Zookeeper connection
+
+    Implements the zc.zk ``ZooKeeper`` methods used by `zktools`. Each
+    instance is a separate Zookeeper session.
+
+    """
+    _sessions = {}
+
+    def __init__(self, server=None, latency=0):
+        """Create a fake Zookeeper connection
+
+        :param server: Server to connect to, a new one is created by
+                       default
+        :type server: :class:`FakeZooKeeperServer`
+        :param latency: Seconds added to every request, requests sent
+                        together are still handled concurrently like a
+                        pipelined Zookeeper connection
+        :type latency: float
+
+        """
+        self.server = server or FakeZooKeeperServer()
+        self.latency = latency
+        self.connected = threading.Event()
+        self.counts = {}
+        self._failures = deque()
+        self._ephemerals = set()
+        self._pending_events = []
+        self._requests = Queue()
+        self._events = Queue()
+        self._closed = False
+        self._new_session()
+        self.connected.set()
+        self._threads = []
+        for target, name in [(self._process_requests, 'requests'),
+                             (self._process_events, 'events')]:
+            thread = threading.Thread(target=target,
+                                      name='FakeZooKeeper-%s' % name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _new_session(self):
+        self.handle = next(_handles)
+        self._sessions[self.handle] = [self]
+
+    # Threads
+
+    def _process_requests(self):
+        while 1:
+            request = self._requests.get()
+            if request is None:
+                return
+            due, func, done = request
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            done(*self._run(func))
+
+    def _process_events(self):
+        while 1:
+            event = self._events.get()
+            if event is None:
+                return
+            func, args = event
+            try:
+                func(*args)
+            except Exception:
+                log.exception("Error in Zookeeper callback %r", func)
+
+    def _deliver(self, watcher, type, state, path):
+        """Deliver a watch event, holding it while disconnected"""
+        if self.connected.is_set() or type == zookeeper.SESSION_EVENT:
+            self._events.put((watcher, (self.handle, type, state, path)))
+        else:
+            self._pending_events.append((watcher, type, state, path))
+
+    # Requests
+
+    def _run(self, func):
+        """Run a server operation, returning its code and result"""
+        if self._failures:
+            with self.server.lock:
+                failure = self._match_failure(func.operation)
+            if failure is not None:
+                code, applied = failure
+                if applied:
+                    self._run_unchecked(func)
+                return code, None
+        if not self.connected.is_set():
+            return zookeeper.CONNECTIONLOSS, None
+        return self._run_unchecked(func)
+
+    def _run_unchecked(self, func):
+        try:
+            with self.server.lock:
+                return zookeeper.OK, func()
+        except _Error as error:
+            return error.code, None
+
+    def _match_failure(self, operation):
+        for failure in self._failures:
+            if failure[0] in (None, operation):
+                self._failures.remove(failure)
+                return failure[1:]
+        return None
+
+    def _request(self, operation, path, func, completion, unpack,
+                 sequence=False):
+        """Send a request, waiting for its result if no completion was
+        given"""
+        if self._closed:
+            raise zookeeper.ClosingException("Connection is closed")
+        # Like the binding, refuse a malformed path before sending it
+        if not path.startswith('/') or '//' in path or \
+                (path.endswith('/') and path != '/' and not sequence):
+            raise zookeeper.BadArgumentsException(
+                zookeeper.zerror(zookeeper.BADARGUMENTS))
+        self.server.count(operation)
+        self.counts[operation] = self.counts.get(operation, 0) + 1
+        func.operation = operation
+
+        if completion is not None:
+            def done(code, result):
+                self._events.put((completion,
+                                  (self.handle, code) + unpack(code, result)))
+            self._requests.put((time.time() + self.latency, func, done))
+            return zookeeper.OK
+
+        result = []
+        finished = threading.Event()
+        # Waiting for the event thread from itself would never return
+        in_events = threading.current_thread() is self._threads[1]
+
+        def done(code, value):
+            result.extend((code, value))
+            if in_events:
+                finished.set()
+            else:
+                # Like Zookeeper, deliver the watch events the request
+                # triggered before its response
+                self._events.put((finished.set, ()))
+        self._requests.put((time.time() + self.latency, func, done))
+        finished.wait()
+        code, value = result
+        if code != zookeeper.OK:
+            raise ERRORS.get(code, zookeeper.ZooKeeperException)(
+                zookeeper.zerror(code))
+        return value
+
+    def create(self, path, data, acl, flags=0, completion=None):
+        return self._request(
+            'create', path,
+            lambda: self.server.create(self, path, data, acl, flags),
+            completion, lambda code, value: (value,),
+            sequence=bool(flags & zookeeper.SEQUENCE))
+    acreate = create
+
+    def delete(self, path, version=-1, completion=None):
+        self._request('delete', path,
+                      lambda: self.server.delete(self, path, version),
+                      completion, lambda code, value: ())
+        return zookeeper.OK
+    adelete = delete
+
+    def set(self, path, data, version=-1, completion=None):
+        stat = self._request(
+            'set', path, lambda: self.server.set(self, path, data, version),
+            completion, lambda code, value: (value,))
+        if completion is None:
+            return zookeeper.OK
+        return stat
+    aset = set
+
+    def get(self, path, watcher=None):
+        return self._request('get', path,
+                             lambda: self.server.get(self, path, watcher),
+                             None, None)
+
+    def aget(self, path, watcher, completion):
+        return self._request('get', path,
+                             lambda: self.server.get(self, path, watcher),
+                             completion, lambda code, value: value or
+                             (None, None))
+
+    def exists(self, path, watcher=None):
+        try:
+            return self._request(
+                'exists', path,
+                lambda: self.server.exists(self, path, watcher),
+                None, None)
+        except zookeeper.NoNodeException:
+            return None
+
+    def aexists(self, path, watcher, completion):
+        return self._request(
+            'exists', path,
+            lambda: self.server.exists(self, path, watcher),
+            completion, lambda code, value: (value,))
+
+    def get_children(self, path, watcher=None):
+        return self._request(
+            'get_children', path,
+            lambda: self.server.get_children(self, path, watcher),
+            None, None)
+
+    def aget_children(self, path, watcher, completion):
+        return self._request(
+            'get_children', path,
+            lambda: self.server.get_children(self, path, watcher),
+            completion, lambda code, value: (value,))
+
+    def create_recursive(self, path, data, acl):
+        """Create a node and any missing parents"""
+        parts = path.split('/')
+        for index in range(2, len(parts) + 1):
+            try:
+                self.create('/'.join(parts[:index]), data, acl)
+            except zookeeper.NodeExistsException:
+                pass
+
+    def delete_recursive(self, path, dry_run=False, force=False,
+                         ignore_if_ephemeral=False):
+        """Delete a node and all the nodes under it"""
+        for name in sorted(self.get_children(path)):
+            self.delete_recursive(path.rstrip('/') + '/' + name, dry_run,
+                                  force, ignore_if_ephemeral)
+        if dry_run or (self.is_ephemeral(path) and not force):
+            return
+        try:
+            self.delete(path)
+        except zookeeper.NoNodeException:
+            pass
+
+    def is_ephemeral(self, path):
+        return bool(self.get(path)[1]['ephemeralOwner'])
+
+    @property
+    def state(self):
+        if self.connected.is_set():
+            return zookeeper.CONNECTED_STATE
+        return zookeeper.CONNECTING_STATE
+
+    def client_id(self):
+        return (self.handle, '')
+
+    # Fault injection
+
+    def fail_next(self, operation=None, error=zookeeper.CONNECTIONLOSS,
+                  count=1, applied=False):
+        """Make the next requests fail with an error
+
+        :param operation: Name of the operation to fail, such as
+                          ``'create'`` or ``'get_children'``, or None for
+                          any operation. Asynchronous variants share the
+                          name of the synchronous operation.
+        :type operation: str
+        :param error: Zookeeper error code to fail with
+        :type error: int
+        :param count: Amount of requests to fail
+        :type count: int
+        :param applied: Whether the operation should still take effect on
+                        the server, like a request whose response was lost
+        :type applied: bool
+
+        """
+        for x in range(count):
+            self._failures.append((operation, error, applied))
+
+    def disconnect(self):
+        """Drop the connection, failing requests with connection loss
+        until :meth:`reconnect` is called"""
+        with self.server.lock:
+            self.connected.clear()
+            watchers = self.server.session_watchers(self)
+        for watcher in watchers:
+            self._deliver(watcher, zookeeper.SESSION_EVENT,
+                          zookeeper.CONNECTING_STATE, '')
+
+    def reconnect(self):
+        """Re-establish the connection within the same session"""
+        with self.server.lock:
+            self.connected.set()
+            watchers = self.server.session_watchers(self)
+            pending, self._pending_events = self._pending_events, []
+        for watcher in watchers:
+            self._deliver(watcher, zookeeper.SESSION_EVENT,
+                          zookeeper.CONNECTED_STATE, '')
+        for event in pending:
+            self._deliver(*event)
+
+    def expire_session(self):
+        """Expire the session, then connect with a new session
+
+        Ephemeral nodes of the session are removed, and its watchers are
+        called with an expired session event and discarded.
+
+        """
+        with self.server.lock:
+            watchers = self.server.remove_watches(self)
+            for path in sorted(self._ephemerals, reverse=True):
+                if path in self.server.nodes:
+                    self.server._remove(path)
+            self._ephemerals.clear()
+            self._pending_events = []
+            self._sessions.pop(self.handle, None)
+            for watcher in watchers:
+                self._events.put((watcher, (self.handle,
+                                            zookeeper.SESSION_EVENT,
+                                            zookeeper.EXPIRED_SESSION_STATE,
+                                            '')))
+            self._new_session()
+            self.connected.set()
+
+    def close(self):
+        """Close the session, removing its ephemeral nodes"""
+        if self._closed:
+            return
+        with self.server.lock:
+            self.server.remove_watches(self)
+            for path in sorted(self._ephemerals, reverse=True):
+                if path in self.server.nodes:
+                    self.server._remove(path)
+            self._ephemerals.clear()
+            self._sessions.pop(self.handle, None)
+            self._closed = True
+        self.connected.clear()
+        self._requests.put(None)
+        self._events.put(None)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
@@ -1,3 +1,4 @@
+import os
 import unittest
 
 __all__ = ['TestBase']
@@ -9,10 +10,14 @@ connection = []
 class TestBase(unittest.TestCase):
     @property
     def conn(self):
-        from zc.zk import ZooKeeper
         if connection:
             conn = connection[0]
+        elif os.environ.get('ZKTOOLS_FAKE_ZOOKEEPER'):
+            from zktools.testing import FakeZooKeeper
+            conn = FakeZooKeeper()
+            connection.append(conn)
         else:
+            from zc.zk import ZooKeeper
             conn = ZooKeeper()
             connection.append(conn)
         return conn
@@ -0,0 +1,135 @@
+import threading
+import time
+
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_
+
+from zktools.tests import TestBase
+
+
+class TestAsyncioLocking(TestBase):
+    def setUp(self):
+        from zktools import aio
+        if aio.asyncio is None:
+            raise SkipTest("asyncio is not available")
+        self.asyncio = aio.asyncio
+        self.loop = aio.asyncio.new_event_loop()
+        if self.conn.exists('/ZktoolsLocks/zkAioLockTest'):
+            self.conn.delete_recursive(
+                '/ZktoolsLocks/zkAioLockTest', force=True)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def makeOne(self, *args, **kwargs):
+        from zktools.aio import AsyncioZkLock
+        return AsyncioZkLock(self.conn, 'zkAioLockTest', loop=self.loop,
+                             *args, **kwargs)
+
+    def makeReadLock(self):
+        from zktools.aio import AsyncioZkReadLock
+        return AsyncioZkReadLock(self.conn, 'zkAioLockTest', loop=self.loop)
+
+    def makeWriteLock(self):
+        from zktools.aio import AsyncioZkWriteLock
+        return AsyncioZkWriteLock(self.conn, 'zkAioLockTest', loop=self.loop)
+
+    def complete(self, future):
+        return self.loop.run_until_complete(future)
+
+    def wait(self, seconds):
+        future = self.asyncio.Future(loop=self.loop)
+        self.loop.call_later(seconds, future.set_result, None)
+        self.complete(future)
+
+    def testBasicLock(self):
+        lock = self.makeOne()
+        eq_(self.complete(lock.acquire()), True)
+        eq_(lock.acquired, True)
+        eq_(self.complete(lock.release()), True)
+        eq_(lock.acquired, False)
+
+    def testContextManager(self):
+        lock = self.makeOne()
+        eq_(self.complete(lock.__aenter__()), True)
+        eq_(lock.acquired, True)
+        eq_(self.complete(lock.__aexit__(None, None, None)), None)
+        eq_(lock.acquired, False)
+
+    def testTimeout(self):
+        lock1 = self.makeOne()
+        lock2 = self.makeOne()
+        eq_(self.complete(lock1.acquire()), True)
+        eq_(self.complete(lock2.acquire(timeout=0.2)), False)
+        eq_(len(self.conn.get_children('/ZktoolsLocks/zkAioLockTest')), 1)
+        self.complete(lock1.release())
+
+    def testLockHandoff(self):
+        lock1 = self.makeOne()
+        lock2 = self.makeOne()
+        eq_(self.complete(lock1.acquire()), True)
+        waiter = lock2.acquire()
+        self.wait(0.1)
+        eq_(waiter.done(), False)
+        self.complete(lock1.release())
+        eq_(self.complete(waiter), True)
+        self.complete(lock2.release())
+
+    def testSharedLocks(self):
+        r1 = self.makeReadLock()
+        r2 = self.makeReadLock()
+        w1 = self.makeWriteLock()
+        eq_(self.complete(r1.acquire()), True)
+        eq_(self.complete(r2.acquire()), True)
+        eq_(self.complete(w1.acquire(timeout=0.2)), False)
+        self.complete(r1.release())
+        self.complete(r2.release())
+        eq_(self.complete(w1.acquire()), True)
+        self.complete(w1.release())
+
+    def testPriority(self):
+        lock1 = self.makeOne()
+        batch = self.makeOne()
+        urgent = self.makeOne()
+        eq_(self.complete(lock1.acquire()), True)
+        batch_waiter = batch.acquire()
+        self.wait(0.05)
+        urgent_waiter = urgent.acquire(priority=1)
+        self.wait(0.05)
+        self.complete(lock1.release())
+        eq_(self.complete(urgent_waiter), True)
+        eq_(batch_waiter.done(), False)
+        self.complete(urgent.release())
+        eq_(self.complete(batch_waiter), True)
+        self.complete(batch.release())
+
+    def testPriorityThreadedLock(self):
+        from zktools.aio import AsyncioZkLock
+        from zktools.locking import ZkLock
+        from zktools.testing import FakeZooKeeper
+        zk = FakeZooKeeper()
+        other = FakeZooKeeper(zk.server)
+        lock1 = ZkLock(zk, 'zkAioLockTest')
+        urgent = AsyncioZkLock(zk, 'zkAioLockTest', loop=self.loop)
+        vals = []
+
+        def batch():
+            with ZkLock(other, 'zkAioLockTest'):
+                vals.append('batch')
+
+        lock1.acquire()
+        waiter = threading.Thread(target=batch)
+        waiter.start()
+        time.sleep(0.1)
+        # The threaded lock is next in line, and listed the queue before
+        # the urgent one was queued
+        urgent_waiter = urgent.acquire(priority=1)
+        self.wait(0.1)
+        lock1.release()
+        eq_(self.complete(urgent_waiter), True)
+        vals.append('urgent')
+        self.complete(urgent.release())
+        waiter.join()
+        eq_(vals, ['urgent', 'batch'])
+        other.close()
+        zk.close()
@@ -0,0 +1,57 @@
+import json
+import unittest
+from StringIO import StringIO
+
+from nose.tools import eq_
+
+
+class TestBench(unittest.TestCase):
+    def run_bench(self, *args):
+        from zktools.bench import main
+        out = StringIO()
+        results = main(['-t', '3', '-n', '5', '-l', '2'] + list(args), out)
+        return results, out.getvalue()
+
+    def test_lock_classes(self):
+        results, output = self.run_bench()
+        eq_([result['lock_class'] for result in results],
+            ['lock', 'read', 'write', 'async'])
+        for result in results:
+            eq_(result['acquisitions'], 15)
+            eq_(result['errors'], [])
+            self.assertTrue(result['ops_per_acquisition'] > 0)
+            self.assertTrue(result['latency_ms']['p50'] <=
+                            result['latency_ms']['p999'])
+        eq_(len(output.splitlines()), 5)
+
+    def test_json(self):
+        results, output = self.run_bench('-c', 'write', '--json')
+        eq_(json.loads(output)[0]['lock_class'], 'write')
+
+    def test_reader_herd(self):
+        from zktools.bench import main
+        out = StringIO()
+        result = main(['--herd', '20', '--connections', '20'], out)[0]
+        eq_(result['readers'], 20)
+        eq_(result['errors'], [])
+        # Readers are admitted without listing the lock queue again
+        eq_(result['ops'].get('get_children'), None)
+        self.assertTrue(result['ops_per_admission'] < 1)
+        eq_(len(out.getvalue().splitlines()), 2)
+
+    def test_decode(self):
+        from zktools.bench import main
+        out = StringIO()
+        result = main(['--decode', '1000'], out)[0]
+        eq_(result['values'], 1000)
+        eq_(result['mismatches'], [])
+        self.assertTrue(result['values_per_sec']['compiled'] > 0)
+        eq_(len(out.getvalue().splitlines()), 3)
+
+    def test_percentile(self):
+        from zktools.bench import percentile
+        values = range(1, 1001)
+        eq_(percentile(values, 0.5), 500)
+        eq_(percentile(values, 0.99), 990)
+        eq_(percentile(values, 0.999), 999)
+        eq_(percentile([], 0.5), 0.0)
@@ -0,0 +1,122 @@
+import threading
+import time
+
+from nose.tools import eq_
+try:
+    import zookeeper
+except ImportError:  # pragma: nocover
+    from zktools import _zkconsts as zookeeper
+
+from zktools.tests import TestBase
+
+
+class TestCounter(TestBase):
+    def makeOne(self, *args, **kwargs):
+        from zktools.counter import ZkCounter
+        return ZkCounter(self.conn, '/zkTestCounter', *args, **kwargs)
+
+    def setUp(self):
+        if self.conn.exists('/zkTestCounter'):
+            self.conn.delete_recursive('/zkTestCounter')
+
+    def test_add(self):
+        counter = self.makeOne(shards=4)
+        eq_(counter.value, 0)
+        counter.add()
+        counter.add(5)
+        counter.add(-2)
+        eq_(counter.value, 4)
+        eq_(sorted(self.conn.get_children('/zkTestCounter')),
+            ['shard-0', 'shard-1', 'shard-2', 'shard-3'])
+
+    def test_shared(self):
+        counter = self.makeOne()
+        other = self.makeOne()
+        counter.add(3)
+        other.add(4)
+        time.sleep(0.1)
+        eq_(counter.value, 7)
+        eq_(other.value, 7)
+
+    def test_concurrent(self):
+        from zktools.counter import ZkCounter
+        from zktools.testing import FakeZooKeeper
+        zk = FakeZooKeeper()
+        zk.create('/zkTestCounter', '', [], 0)
+        sessions = [FakeZooKeeper(zk.server) for x in range(4)]
+        counters = [ZkCounter(session, '/zkTestCounter', shards=2)
+                    for session in sessions]
+
+        def worker(counter):
+            for x in range(25):
+                counter.add()
+        threads = [threading.Thread(target=worker, args=(counter,))
+                   for counter in counters]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(ZkCounter(zk, '/zkTestCounter', shards=2).value, 100)
+        for session in sessions + [zk]:
+            session.close()
+
+    def test_flush_interval(self):
+        counter = self.makeOne(flush_interval=0.05)
+        for x in range(10):
+            counter.add()
+        eq_(counter.pending, 10)
+        eq_(counter.value, 0)
+        time.sleep(0.2)
+        eq_(counter.pending, 0)
+        eq_(counter.value, 10)
+        counter.add(2)
+        counter.flush()
+        eq_(counter.value, 12)
+
+    def test_lost_reply(self):
+        from zktools.counter import ZkCounter
+        from zktools.testing import FakeZooKeeper
+        from zktools.util import RetryPolicy
+        zk = FakeZooKeeper()
+        zk.create('/zkTestCounter', '', [], 0)
+        counter = ZkCounter(zk, '/zkTestCounter', shards=2,
+                            retry_policy=RetryPolicy(base_delay=0.001))
+        # The increment goes through, but its reply is lost
+        zk.fail_next('set', applied=True)
+        counter.add(5)
+        counter.add(2)
+        eq_(counter.value, 7)
+        zk.close()
+
+    def test_lost_reply_flush(self):
+        from zktools.counter import ZkCounter
+        from zktools.testing import FakeZooKeeper
+        zk = FakeZooKeeper()
+        zk.create('/zkTestCounter', '', [], 0)
+        counter = ZkCounter(zk, '/zkTestCounter', shards=2,
+                            flush_interval=60)
+        applied = counter._applied
+        failures = []
+
+        def unreadable(*args):
+            # The shard can't be read again right away
+            if not failures:
+                failures.append(args)
+                raise zookeeper.ConnectionLossException()
+            return applied(*args)
+        counter._applied = unreadable
+
+        counter.add(5)
+        # The flush goes through, but its reply is lost
+        zk.fail_next('set', applied=True)
+        try:
+            counter.flush()
+        except zookeeper.ConnectionLossException:
+            pass
+        else:  # pragma: nocover
+            raise AssertionError("No error raised")
+        counter.add(2)
+        counter.flush()
+        eq_(len(failures), 1)
+        eq_(ZkCounter(zk, '/zkTestCounter', shards=2).value, 7)
+        zk.close()
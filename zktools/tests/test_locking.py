@@ -1,7 +1,14 @@
 import threading
+import time
+import unittest
+import uuid
 
 from nose.tools import eq_
-import zookeeper
+from nose.tools import raises
+try:
+    import zookeeper
+except ImportError:  # pragma: nocover
+    from zktools import _zkconsts as zookeeper
 
 from zktools.tests import TestBase
 
@@ -29,6 +36,42 @@ class TestAsyncLocking(TestBase):
         lock.wait_for_release()
         eq_(False, lock.acquired)
 
+    def test_retry_policy(self):
+        from zktools.testing import FakeZooKeeper
+        from zktools.locking import ZkAsyncLock
+        from zktools.util import RetryPolicy
+        zk = FakeZooKeeper()
+        lock = ZkAsyncLock(zk, 'zkALockTest', retry_policy=RetryPolicy(
+            max_attempts=2, base_delay=0.001))
+        zk.fail_next('get_children', count=2)
+        lock.acquire()
+        lock.wait_for_acquire(5)
+        eq_(lock.acquired, False)
+        eq_(lock.errors, [(zookeeper.CONNECTIONLOSS, 'Check candidate nodes')])
+        zk.close()
+
+    def test_handoff(self):
+        from zktools.testing import FakeZooKeeper
+        from zktools.locking import ZkAsyncLock
+        zk = FakeZooKeeper()
+        lock1 = ZkAsyncLock(zk, 'zkALockTest')
+        lock2 = ZkAsyncLock(zk, 'zkALockTest')
+        lock1.acquire()
+        lock1.wait_for_acquire(5)
+        lock2.acquire()
+        time.sleep(0.1)
+        listed = zk.counts['get_children']
+
+        # Releasing the only node ahead hands the lock over directly
+        lock1.release()
+        eq_(lock2.wait_for_acquire(5), True)
+        eq_(zk.counts['get_children'], listed)
+        time.sleep(0.1)
+        eq_(lock2.errors, [])
+        lock2.release()
+        lock2.wait_for_release(5)
+        zk.close()
+
     def test_with_blocking(self):
         lock = self.makeOne('zkALockTest')
         with lock:
@@ -116,6 +159,175 @@ class TestLocking(TestBase):
         al.wait()
         eq_(vals, [2])
 
+    def testHandoff(self):
+        from zktools.testing import FakeZooKeeper
+        from zktools.locking import ZkLock
+        zk = FakeZooKeeper()
+        lock1 = ZkLock(zk, 'zkLockTest')
+        lock2 = ZkLock(zk, 'zkLockTest')
+        lock1.acquire()
+        waiter = threading.Thread(target=lock2.acquire)
+        waiter.start()
+        time.sleep(0.1)
+        listed = zk.counts['get_children']
+
+        lock1.release()
+        waiter.join()
+        eq_(zk.counts['get_children'], listed)
+        eq_(lock2.has_lock(), True)
+        eq_(lock2.revoked, False)
+        lock2.release()
+        zk.close()
+
+    def testTryAcquire(self):
+        from zktools.testing import FakeZooKeeper
+        from zktools.locking import ZkLock
+        from zktools.locking import try_acquire_stats
+        zk = FakeZooKeeper()
+        other = FakeZooKeeper(zk.server)
+        lock1 = ZkLock(other, 'zkLockTest')
+        lock2 = ZkLock(zk, 'zkLockTest')
+        lock1.acquire()
+        stats = try_acquire_stats()
+        eq_(lock2.try_acquire(), False)
+        created = zk.counts.get('create', 0)
+        listed = zk.counts['get_children']
+        for x in range(10):
+            eq_(lock2.try_acquire(), False)
+        eq_(zk.counts.get('create', 0), created)
+        eq_(zk.counts['get_children'], listed)
+        eq_(try_acquire_stats()['writes_avoided'] -
+            stats['writes_avoided'], 22)
+
+        lock1.release()
+        for x in range(50):
+            if lock2.try_acquire():
+                break
+            time.sleep(0.01)
+        eq_(lock2.has_lock(), True)
+        eq_(lock1.try_acquire(), False)
+        lock2.release()
+        zk.close()
+        other.close()
+
+    def testPriority(self):
+        lock1 = self.makeOne('zkLockTest')
+        batch = self.makeOne('zkLockTest')
+        urgent = self.makeOne('zkLockTest')
+        vals = []
+
+        def queued(count):
+            while len(self.conn.get_children('/ZktoolsLocks/zkLockTest')) \
+                    < count:
+                time.sleep(0.01)
+
+        def run(lock, name, **kwargs):
+            with lock(**kwargs):
+                vals.append(name)
+
+        lock1.acquire()
+        waiter1 = threading.Thread(target=run, args=(batch, 'batch'))
+        waiter1.start()
+        queued(2)
+        waiter2 = threading.Thread(target=run, args=(urgent, 'urgent'),
+                                   kwargs=dict(priority=1))
+        waiter2.start()
+        queued(3)
+        time.sleep(0.1)
+
+        # The batch lock queued first gives way to the urgent one
+        lock1.release()
+        waiter1.join()
+        waiter2.join()
+        eq_(vals, ['urgent', 'batch'])
+
+    def testPriorityOtherProcess(self):
+        from zktools.testing import FakeZooKeeper
+        from zktools.locking import ZkLock
+        zk = FakeZooKeeper()
+        other = FakeZooKeeper(zk.server)
+        lock1 = ZkLock(zk, 'zkLockTest')
+        batch = ZkLock(other, 'zkLockTest')
+        urgent = ZkLock(zk, 'zkLockTest')
+        vals = []
+
+        def run(lock, name, **kwargs):
+            with lock(**kwargs):
+                vals.append(name)
+
+        lock1.acquire()
+        waiter1 = threading.Thread(target=run, args=(batch, 'batch'))
+        waiter1.start()
+        time.sleep(0.1)
+        # The batch lock is next in line, and listed the queue before the
+        # urgent one was queued
+        waiter2 = threading.Thread(target=run, args=(urgent, 'urgent'),
+                                   kwargs=dict(priority=1))
+        waiter2.start()
+        time.sleep(0.1)
+
+        lock1.release()
+        waiter1.join()
+        waiter2.join()
+        eq_(vals, ['urgent', 'batch'])
+        other.close()
+        zk.close()
+
+    def testPriorityDelayedNotice(self):
+        from zktools.testing import FakeZooKeeper
+        from zktools.locking import ZkLock
+        zk = FakeZooKeeper()
+        other = FakeZooKeeper(zk.server, latency=0.1)
+        lock1 = ZkLock(zk, 'zkLockTest')
+        batch = ZkLock(other, 'zkLockTest')
+        urgent = ZkLock(zk, 'zkLockTest')
+        vals = []
+
+        def run(lock, name, **kwargs):
+            with lock(**kwargs):
+                vals.append(name)
+
+        lock1.acquire()
+        waiter1 = threading.Thread(target=run, args=(batch, 'batch'))
+        waiter1.start()
+        time.sleep(1)
+        waiter2 = threading.Thread(target=run, args=(urgent, 'urgent'),
+                                   kwargs=dict(priority=1))
+        waiter2.start()
+        while zk.get(batch._candidate_path)[0] != 'outranked':
+            time.sleep(0.01)
+
+        # The batch lock is told before its data is read back
+        lock1.release()
+        waiter1.join()
+        waiter2.join()
+        eq_(vals, ['urgent', 'batch'])
+        other.close()
+        zk.close()
+
+    @raises(ValueError)
+    def testNegativePriority(self):
+        self.makeOne('zkLockTest').acquire(priority=-1)
+
+    def testBulkRevokeAndClear(self):
+        from zktools.testing import FakeZooKeeper
+        from zktools.locking import ZOO_OPEN_ACL_UNSAFE
+        from zktools.locking import ZkLock
+        zk = FakeZooKeeper()
+        lock = ZkLock(zk, 'zkLockTest')
+        for x in range(300):
+            zk.create('/ZktoolsLocks/zkLockTest/stale-lock-', "0",
+                      [ZOO_OPEN_ACL_UNSAFE], zookeeper.SEQUENCE)
+        zk.latency = 0.05
+        start = time.time()
+        eq_(lock.revoke_all(), 300)
+        eq_(lock.clear(), 300)
+        # A round-trip per node would take 30 seconds
+        self.assertTrue(time.time() - start < 2)
+        eq_(lock.clear(), 0)
+        eq_(lock.revoke_all(), 0)
+        zk.close()
+
     def testLockRevoked(self):
         lock1 = self.makeOne('zkLockTest')
         lock2 = self.makeOne('zkLockTest')
@@ -145,6 +357,188 @@ class TestLocking(TestBase):
         eq_(vals, [2, 3])
 
 
+class TestHierarchicalLocking(TestBase):
+    def makeOne(self, *args, **kwargs):
+        from zktools.locking import ZkLock
+        return ZkLock(self.conn, 'zkLockTest', hierarchical=True, *args,
+                      **kwargs)
+
+    def setUp(self):
+        if self.conn.exists('/ZktoolsLocks/zkLockTest'):
+            self.conn.delete_recursive(
+                '/ZktoolsLocks/zkLockTest', force=True)
+
+    def testBasicLock(self):
+        lock = self.makeOne()
+        eq_(lock.acquire(), True)
+        eq_(lock.has_lock(), True)
+        eq_(lock.revoked, False)
+        eq_(lock.release(), True)
+        eq_(lock.has_lock(), False)
+        eq_(lock.release(), False)
+
+    def testTimeout(self):
+        lock1 = self.makeOne()
+        lock2 = self.makeOne()
+        lock1.acquire()
+        eq_(lock2.acquire(timeout=0), False)
+        eq_(lock2.acquire(timeout=0.05), False)
+        lock1.release()
+        eq_(lock2.acquire(timeout=0), True)
+        lock2.release()
+
+    def testCoalesced(self):
+        from zktools.testing import FakeZooKeeper
+        from zktools.locking import ZkLock
+        zk = FakeZooKeeper()
+        other = FakeZooKeeper(zk.server)
+        locks = [ZkLock(zk, 'zkLockTest', hierarchical=True, max_handoffs=4)
+                 for x in range(8)]
+        line = locks[0]._local._line
+        created = zk.counts.get('create', 0)
+        running = []
+        done = []
+
+        def worker(lock):
+            for x in range(5):
+                with lock:
+                    running.append(lock)
+                    assert len(running) == 1
+                    time.sleep(0.001)
+                    running.remove(lock)
+                    done.append(lock)
+
+        # Hold the lock from another process until every worker is in
+        # line, so that nobody finds the line empty on release but the
+        # last worker left
+        remote = ZkLock(other, 'zkLockTest')
+        remote.acquire()
+        threads = [threading.Thread(target=worker, args=(lock,))
+                   for lock in locks]
+        for thread in threads:
+            thread.start()
+        while len(line) < len(locks):
+            time.sleep(0.01)
+        remote.release()
+        for thread in threads:
+            thread.join()
+        eq_(len(done), 40)
+        # A candidate for every 1 + max_handoffs turns, and one for each
+        # of the last worker's turns once it is alone
+        created = zk.counts['create'] - created
+        self.assertTrue(created >= 40 / 5)
+        self.assertTrue(created <= 40 / 5 + 5)
+        eq_(zk.get_children('/ZktoolsLocks/zkLockTest'), [])
+        other.close()
+        zk.close()
+
+    def testOtherProcess(self):
+        from zktools.testing import FakeZooKeeper
+        from zktools.locking import ZkLock
+        zk = FakeZooKeeper()
+        other = FakeZooKeeper(zk.server)
+        local1 = ZkLock(zk, 'zkLockTest', hierarchical=True)
+        local2 = ZkLock(zk, 'zkLockTest', hierarchical=True)
+        remote = ZkLock(other, 'zkLockTest')
+        local1.acquire()
+        eq_(remote.acquire(timeout=0), False)
+        waiter = threading.Thread(target=local2.acquire)
+        waiter.start()
+        time.sleep(0.05)
+        # Handed over without going through Zookeeper
+        local1.release()
+        waiter.join()
+        eq_(local2.has_lock(), True)
+        eq_(remote.acquire(timeout=0), False)
+        local2.release()
+        eq_(remote.acquire(timeout=0), True)
+        remote.release()
+        other.close()
+        zk.close()
+
+
+class TestReentrantLocking(TestBase):
+    def makeOne(self, *args, **kwargs):
+        from zktools.locking import ZkRLock
+        return ZkRLock(self.conn, 'zkLockTest', *args, **kwargs)
+
+    def setUp(self):
+        if self.conn.exists('/ZktoolsLocks/zkLockTest'):
+            self.conn.delete_recursive(
+                '/ZktoolsLocks/zkLockTest', force=True)
+
+    def testReentrant(self):
+        from zktools.testing import FakeZooKeeper
+        from zktools.locking import ZkRLock
+        zk = FakeZooKeeper()
+        lock = ZkRLock(zk, 'zkLockTest')
+        with lock:
+            requests = sum(zk.counts.values())
+            with lock:
+                eq_(lock.acquire(), True)
+                eq_(lock.release(), True)
+            eq_(sum(zk.counts.values()), requests)
+            eq_(lock.has_lock(), True)
+        eq_(lock.has_lock(), False)
+        eq_(zk.get_children('/ZktoolsLocks/zkLockTest'), [])
+        zk.close()
+
+    def testOtherThread(self):
+        lock = self.makeOne()
+        lock.acquire()
+        results = []
+
+        def run():
+            results.append(lock.acquire(timeout=0))
+            try:
+                lock.release()
+            except RuntimeError:
+                results.append('error')
+        waiter = threading.Thread(target=run)
+        waiter.start()
+        waiter.join()
+        eq_(results, [False, 'error'])
+        lock.release()
+
+    def testOtherThreadWaiting(self):
+        lock = self.makeOne()
+        lock.acquire()
+        results = []
+
+        def run():
+            results.append(lock.acquire(timeout=2))
+            results.append(lock.has_lock())
+            lock.release()
+        waiter = threading.Thread(target=run)
+        waiter.start()
+        time.sleep(0.1)
+        eq_(results, [])
+        # Releasing deletes our own candidate, handing the lock over
+        eq_(lock.release(), True)
+        waiter.join()
+        eq_(results, [True, True])
+        eq_(self.conn.get_children('/ZktoolsLocks/zkLockTest'), [])
+
+    def testTryAcquire(self):
+        lock = self.makeOne()
+        eq_(lock.try_acquire(), True)
+        eq_(lock.try_acquire(), True)
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(lock.try_acquire()))
+        waiter.start()
+        waiter.join()
+        eq_(results, [False])
+        eq_(lock.release(), True)
+        eq_(lock.release(), True)
+        eq_(lock.has_lock(), False)
+
+    @raises(RuntimeError)
+    def testReleaseUnacquired(self):
+        lock = self.makeOne()
+        lock.release()
+
+
 class TestSharedLocks(TestLocking):
     def makeWriteLock(self, *args, **kwargs):
         from zktools.locking import ZkWriteLock
@@ -154,6 +548,19 @@ class TestSharedLocks(TestLocking):
         from zktools.locking import ZkReadLock
         return ZkReadLock(self.conn, *args, **kwargs)
 
+    def testTryAcquireShared(self):
+        r1 = self.makeReadLock('zkLockTest')
+        r2 = self.makeReadLock('zkLockTest')
+        w1 = self.makeWriteLock('zkLockTest')
+        eq_(r1.try_acquire(), True)
+        eq_(r2.try_acquire(), True)
+        eq_(w1.try_acquire(), False)
+        r1.release()
+        r2.release()
+        eq_(w1.try_acquire(), True)
+        eq_(r1.try_acquire(), False)
+        w1.release()
+
     def testLockQueue(self):
         r1 = self.makeReadLock('zkLockTest')
         r2 = self.makeReadLock('zkLockTest')
@@ -288,6 +695,76 @@ class TestSharedLocks(TestLocking):
         wv.wait()
         eq_(vals, [1, 3, 4])
 
+    def testReaderBehindWriters(self):
+        w1 = self.makeWriteLock('zkLockTest')
+        w2 = self.makeWriteLock('zkLockTest')
+        r1 = self.makeReadLock('zkLockTest')
+        vals = []
+
+        def queued(count):
+            while len(self.conn.get_children('/ZktoolsLocks/zkLockTest')) \
+                    < count:
+                time.sleep(0.01)
+
+        def writer():
+            vals.append(w2.acquire(timeout=0.5))
+
+        def reader():
+            with r1:
+                vals.append('r')
+
+        w1.acquire()
+        writer = threading.Thread(target=writer)
+        writer.start()
+        queued(2)
+        reader = threading.Thread(target=reader)
+        reader.start()
+        queued(3)
+
+        # The closest writer giving up leaves the reader blocked
+        writer.join()
+        time.sleep(0.1)
+        eq_(vals, [False])
+        w1.release()
+        reader.join()
+        eq_(vals, [False, 'r'])
+
+    def testReaderBehindManyWriters(self):
+        from zktools.testing import FakeZooKeeper
+        from zktools.locking import ZkReadLock
+        from zktools.locking import ZOO_OPEN_ACL_UNSAFE
+        zk = FakeZooKeeper()
+        other = FakeZooKeeper(zk.server)
+        reader = ZkReadLock(other, 'zkLockTest')
+        reader.clear()
+        writers = [zk.create('/ZktoolsLocks/zkLockTest/%s-write-' %
+                             uuid.uuid4().hex, '', [ZOO_OPEN_ACL_UNSAFE],
+                             zookeeper.SEQUENCE | zookeeper.EPHEMERAL)
+                   for x in range(10)]
+        acquired = threading.Event()
+
+        def read():
+            with reader:
+                acquired.set()
+
+        waiter = threading.Thread(target=read)
+        waiter.start()
+        while len(zk.get_children('/ZktoolsLocks/zkLockTest')) < 11:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        counts = dict(other.counts)
+
+        # Only the closest writer is watched, the others leave unseen
+        for path in writers:
+            zk.delete(path)
+        acquired.wait(5)
+        waiter.join()
+        sent = sum(other.counts.get(operation, 0) - counts.get(operation, 0)
+                   for operation in ('exists', 'get_children'))
+        assert sent <= 2, sent
+        other.close()
+        zk.close()
+
     def testClearing(self):
         w1 = self.makeReadLock('zkLockTest')
         r1 = self.makeWriteLock('zkLockTest')
@@ -310,3 +787,173 @@ class TestSharedLocks(TestLocking):
         w1.clear()
         reader.join()
         eq_(vals, [1])
+
+
+class TestLockQueue(unittest.TestCase):
+    def makeOne(self, *args, **kwargs):
+        from zktools.locking import LockQueue
+        return LockQueue(*args, **kwargs)
+
+    def test_sorted_by_sequence(self):
+        queue = self.makeOne(['b-write-0000000003', 'c-read-0000000001',
+                              'a-read-0000000002'])
+        eq_(list(queue), ['c-read-0000000001', 'a-read-0000000002',
+                          'b-write-0000000003'])
+        eq_(queue.index('b-write-0000000003'), 2)
+        eq_(queue.is_first('c-read-0000000001'), True)
+        eq_(queue.is_first('a-read-0000000002'), False)
+        eq_(queue.predecessor('c-read-0000000001'), None)
+        eq_(queue.predecessor('b-write-0000000003'), 'a-read-0000000002')
+
+    def test_prior_writers(self):
+        queue = self.makeOne(['a-write-0000000001', 'b-read-0000000002',
+                              'c-write-0000000003', 'd-read-0000000004'])
+        eq_(queue.prior_writer('a-write-0000000001'), None)
+        eq_(queue.prior_writer('b-read-0000000002'), 'a-write-0000000001')
+        eq_(queue.prior_writer('d-read-0000000004'), 'c-write-0000000003')
+        eq_(queue.prior_writers('d-read-0000000004'),
+            ['a-write-0000000001', 'c-write-0000000003'])
+        eq_(queue.find_prefix('c'), 'c-write-0000000003')
+
+    def test_created_names(self):
+        # Names as created by safe_create_ephemeral_sequence
+        queue = self.makeOne(['b-read--0000000002', 'a-write--0000000001'])
+        eq_(queue.prior_writer('b-read--0000000002'), 'a-write--0000000001')
+        eq_(queue.find_prefix('b'), 'b-read--0000000002')
+
+    def test_priorities(self):
+        queue = self.makeOne(['a-write--0000000001', 'b-read-p1--0000000002',
+                              'c-write-p2--0000000003'])
+        eq_(queue.priority('a-write--0000000001'), 0)
+        eq_(queue.priority('c-write-p2--0000000003'), 2)
+        eq_(queue.prior_writer('b-read-p1--0000000002'),
+            'a-write--0000000001')
+        eq_(queue.find_prefix('c'), 'c-write-p2--0000000003')
+        eq_(queue.has_priorities(), True)
+        eq_(self.makeOne(['a-write--0000000001']).has_priorities(), False)
+
+    def test_outranking(self):
+        from zktools.locking import PRIORITY_AGING
+        queue = self.makeOne(['a-write--0000000001', 'b-read-p1--0000000002',
+                              'c-write-p2--0000000003'])
+        eq_(queue.outranking('a-write--0000000001'),
+            ['b-read-p1--0000000002', 'c-write-p2--0000000003'])
+        eq_(queue.outranking('a-write--0000000001', writers=True),
+            ['c-write-p2--0000000003'])
+        eq_(queue.outranking('b-read-p1--0000000002'),
+            ['c-write-p2--0000000003'])
+        eq_(queue.outranking('c-write-p2--0000000003'), [])
+
+        # Waiting raises a candidate a class at a time
+        eq_(queue.outranking('a-write--0000000001', PRIORITY_AGING),
+            ['c-write-p2--0000000003'])
+        eq_(queue.outranking('a-write--0000000001', PRIORITY_AGING * 2), [])
+
+    def test_outranked(self):
+        queue = self.makeOne(['a-write--0000000001', 'b-read--0000000002',
+                              'c-write--0000000003', 'd-read-p1--0000000004',
+                              'e-write-p2--0000000005'])
+        eq_(queue.outranked('e-write-p2--0000000005'),
+            ['b-read--0000000002', 'c-write--0000000003',
+             'd-read-p1--0000000004'])
+        # Readers only outrank writers
+        eq_(queue.outranked('d-read-p1--0000000004'), ['c-write--0000000003'])
+        eq_(queue.outranked('c-write--0000000003'), [])
+
+    @raises(ValueError)
+    def test_missing(self):
+        self.makeOne([]).index('a-lock-0000000001')
+
+    def test_has_locks(self):
+        from zktools.locking import has_read_lock
+        from zktools.locking import has_write_lock
+        children = ['a-read-0000000001', 'b-read-0000000002',
+                    'c-write-0000000003']
+        eq_(has_read_lock('b-read-0000000002', children), (True, None))
+        eq_(has_write_lock('b-read-0000000002', children),
+            (False, ['a-read-0000000001']))
+        eq_(has_write_lock('a-read-0000000001', children), (True, None))
+        eq_(has_read_lock('c-write-0000000003', children), (True, None))
+
+    def test_has_locks_priority(self):
+        from zktools.locking import has_read_lock
+        from zktools.locking import has_write_lock
+        children = ['a-read-0000000001', 'b-write-p1-0000000002',
+                    'c-read-p2-0000000003']
+        # Holders aren't checked for candidates they give way to
+        eq_(has_write_lock('a-read-0000000001', children), (True, None))
+        eq_(has_write_lock('a-read-0000000001', children, 0),
+            (False, ['b-write-p1-0000000002', 'c-read-p2-0000000003']))
+        eq_(has_read_lock('a-read-0000000001', children, 0),
+            (False, ['b-write-p1-0000000002']))
+        eq_(has_read_lock('c-read-p2-0000000003', children, 0),
+            (False, ['b-write-p1-0000000002']))
+
+
+class TestLockSet(TestBase):
+    names = ['zkLockSetTest1', 'zkLockSetTest2', 'zkLockSetTest3']
+
+    def makeOne(self, *args, **kwargs):
+        from zktools.locking import ZkLockSet
+        return ZkLockSet(self.conn, *args, **kwargs)
+
+    def setUp(self):
+        for name in self.names:
+            if self.conn.exists('/ZktoolsLocks/' + name):
+                self.conn.delete_recursive('/ZktoolsLocks/' + name,
+                                           force=True)
+
+    def testAcquireAll(self):
+        locks = self.makeOne(self.names)
+        eq_(locks.acquire(), True)
+        for name in self.names:
+            eq_(len(self.conn.get_children('/ZktoolsLocks/' + name)), 1)
+        eq_(locks.release(), True)
+        for name in self.names:
+            eq_(self.conn.get_children('/ZktoolsLocks/' + name), [])
+
+    def testContended(self):
+        from zktools.locking import ZkLock
+        lock = ZkLock(self.conn, self.names[1])
+        lock.acquire()
+        locks = self.makeOne(self.names)
+        eq_(locks.acquire(timeout=0.2), False)
+        for name in self.names:
+            eq_(len(self.conn.get_children('/ZktoolsLocks/' + name)),
+                name == self.names[1] and 1 or 0)
+
+        vals = []
+
+        def run():
+            with locks:
+                vals.append(1)
+
+        waiter = threading.Thread(target=run)
+        waiter.start()
+        lock.release()
+        waiter.join()
+        eq_(vals, [1])
+
+    def testAcquireMany(self):
+        from zktools.locking import acquire_many
+        locks = acquire_many(self.conn, self.names)
+        eq_(acquire_many(self.conn, self.names, timeout=0), None)
+        locks.release()
+        locks = acquire_many(self.conn, self.names, timeout=0)
+        eq_(locks.revoked, False)
+        locks.release()
+
+
+class TestLockDir(TestBase):
+    def setUp(self):
+        if self.conn.exists('/ZktoolsLocks/zkLockDirTest'):
+            self.conn.delete_recursive('/ZktoolsLocks/zkLockDirTest',
+                                       force=True)
+
+    def testRemovedLockDir(self):
+        from zktools.locking import ZkLock
+        lock = ZkLock(self.conn, 'zkLockDirTest')
+        self.conn.delete('/ZktoolsLocks/zkLockDirTest')
+        lock = ZkLock(self.conn, 'zkLockDirTest')
+        eq_(lock.acquire(), True)
+        eq_(lock.release(), True)
@@ -0,0 +1,102 @@
+import socket
+import unittest
+
+try:
+    import zookeeper
+except ImportError:  # pragma: nocover
+    from zktools import _zkconsts as zookeeper
+from nose.tools import eq_
+
+ZOO_OPEN_ACL_UNSAFE = dict(perms=0x1f, scheme='world', id='anyone')
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        from zktools import metrics
+        from zktools.testing import FakeZooKeeper
+        self.aggregator = metrics.Aggregator()
+        metrics.set_hook(self.aggregator)
+        self.zk = FakeZooKeeper()
+
+    def tearDown(self):
+        from zktools import metrics
+        metrics.set_hook(None)
+        self.zk.close()
+
+    def test_path_prefix(self):
+        from zktools.metrics import path_prefix
+        eq_(path_prefix('/ZktoolsLocks/lock/a-lock--0000000001', 2),
+            '/ZktoolsLocks/lock')
+        eq_(path_prefix('/ZktoolsLocks', 2), '/ZktoolsLocks')
+        eq_(path_prefix('/', 2), '/')
+        eq_(path_prefix('', 2), '')
+
+    def test_safe_call(self):
+        from zktools.util import safe_call
+        self.zk.create('/alpha', '', [ZOO_OPEN_ACL_UNSAFE])
+        self.zk.fail_next('get_children')
+        eq_(safe_call(self.zk, 'get_children', '/alpha'), [])
+        try:
+            safe_call(self.zk, 'get', '/beta')
+        except zookeeper.NoNodeException:
+            pass
+        stats = self.aggregator.snapshot()
+        eq_(stats[('get_children', '/alpha')]['count'], 1)
+        eq_(stats[('get_children', '/alpha')]['retries'], 1)
+        eq_(stats[('get', '/beta')]['errors'], 1)
+
+    def test_create_ephemeral_sequence(self):
+        from zktools.util import safe_create_ephemeral_sequence
+        self.zk.create('/alpha', '', [ZOO_OPEN_ACL_UNSAFE])
+        self.zk.fail_next('create', applied=True)
+        path = safe_create_ephemeral_sequence(self.zk, '/alpha/lock', '',
+                                              [ZOO_OPEN_ACL_UNSAFE])
+        eq_(self.zk.get_children('/alpha'), [path.split('/')[-1]])
+        stats = self.aggregator.snapshot()[('create_ephemeral_sequence',
+                                            '/alpha')]
+        eq_((stats['count'], stats['retries']), (1, 1))
+
+    def test_async_lock(self):
+        from zktools.locking import ZkAsyncLock
+        lock = ZkAsyncLock(self.zk, 'metricsLock')
+        lock.acquire()
+        lock.wait_for_acquire(5)
+        lock.release()
+        lock.wait_for_release(5)
+        stats = self.aggregator.snapshot(reset=True)
+        for operation in ('acreate', 'aget_children', 'adelete'):
+            eq_(stats[(operation, '/ZktoolsLocks/metricsLock')]['count'], 1)
+        eq_(self.aggregator.snapshot(), {})
+
+    def test_node_load(self):
+        from zktools.node import ZkNode
+        ZkNode(self.zk, '/metricsNode')
+        eq_(self.aggregator.snapshot()[('node_load', '/metricsNode')]
+            ['count'], 1)
+
+    def test_statsd(self):
+        from zktools.metrics import StatsdExporter
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        exporter = StatsdExporter(self.aggregator, '127.0.0.1',
+                                  server.getsockname()[1])
+        self.aggregator.record('get', '/alpha/beta.x', 0.002, retries=2)
+        exporter.flush()
+        lines = server.recv(4096).decode('utf-8').splitlines()
+        eq_(lines[:3], ['zktools.get.alpha.beta_x.count:1|c',
+                        'zktools.get.alpha.beta_x.errors:0|c',
+                        'zktools.get.alpha.beta_x.retries:2|c'])
+        eq_(lines[3], 'zktools.get.alpha.beta_x.avg:2.000|ms')
+        server.close()
+
+
+class TestDisabled(unittest.TestCase):
+    def test_no_hook(self):
+        from zktools import metrics
+        eq_(metrics.get_hook(), None)
+
+        def completion(*args):
+            pass
+        eq_(metrics.timed_completion('aget', '/', completion), completion)
+        eq_(metrics.timed_call('node_load', '/', lambda: 42), 42)
@@ -1,13 +1,21 @@
 import datetime
 import decimal
+import threading
 import time
+import unittest
 
+from nose.plugins.skip import SkipTest
 from nose.tools import eq_
 from nose.tools import raises
-
+try:
+    import zookeeper
+except ImportError:  # pragma: nocover
+    from zktools import _zkconsts as zookeeper
 
 from zktools.tests import TestBase
 
+ZOO_OPEN_ACL_UNSAFE = dict(perms=0x1f, scheme='world', id='anyone')
+
 
 class TestNode(TestBase):
     def makeOne(self, *args, **kwargs):
@@ -82,9 +90,354 @@ class TestNode(TestBase):
         time.sleep(0.1)
         eq_(n2.value, n1.value)
 
+    def testLoadValue(self):
+        from zktools.node import _load_value
+        eq_(_load_value('12'), 12)
+        eq_(_load_value('1.50'), decimal.Decimal('1.50'))
+        eq_(_load_value('TRUE'), True)
+        eq_(_load_value('none'), None)
+        eq_(_load_value('2012-03-04T05:06:07.8Z'),
+            datetime.datetime(2012, 3, 4, 5, 6, 7, 800000))
+        eq_(_load_value('2012-03-04 05:06:07.123456Z'),
+            datetime.datetime(2012, 3, 4, 5, 6, 7, 123456))
+        eq_(_load_value('2012-03-04'), datetime.datetime(2012, 3, 4))
+        eq_(_load_value('2012-03-04T05:06:07Z'), '2012-03-04T05:06:07Z')
+        eq_(_load_value('1e5'), '1e5')
+
+    @raises(ValueError)
+    def testLoadBadDatetime(self):
+        from zktools.node import _load_value
+        _load_value('2012-03-04T05:06:07.1234567Z')
+
+    def testLoadBadMonth(self):
+        from zktools.node import _load_value
+        value = '2012-13-04T05:06:07.8Z'
+        try:
+            datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+        except ValueError as exc:
+            expected = str(exc)
+        try:
+            _load_value(value)
+        except ValueError as exc:
+            # The error strptime raised before
+            eq_(str(exc), expected)
+        else:  # pragma: nocover
+            raise AssertionError("No error raised")
+
     def testReload(self):
         n1 = self.makeOne('/zkTestNode', use_json=True)
         n1.value = now = datetime.datetime.today()
         time.sleep(0.1)
         n1._reload = True
         eq_(n1.value, now)
+
+    def testCompareAndSet(self):
+        n1 = self.makeOne('/zkTestNode', 1)
+        version = n1.version
+        eq_(n1.compare_and_set(version, 2), True)
+        eq_(n1.value, 2)
+        eq_(n1.version, version + 1)
+        eq_(n1.compare_and_set(version, 3), False)
+        eq_(n1.value, 2)
+
+    def testUpdate(self):
+        from zktools.node import ZkNode
+        from zktools.testing import FakeZooKeeper
+        zk = FakeZooKeeper()
+        other = FakeZooKeeper(zk.server)
+        n1 = ZkNode(zk, '/zkTestNode', 1)
+        n2 = ZkNode(other, '/zkTestNode')
+        calls = []
+
+        def increment(value):
+            calls.append(value)
+            if len(calls) == 1:
+                # Conflicting write
+                n2.value = 10
+            return value + 1
+        eq_(n1.update(increment), 11)
+        eq_(calls, [1, 10])
+        eq_(zk.get('/zkTestNode')[0], '11')
+        other.close()
+        zk.close()
+
+    def testUpdateConnectionLoss(self):
+        from zktools.node import ZkNode
+        from zktools.testing import FakeZooKeeper
+        from zktools.util import RetryPolicy
+        zk = FakeZooKeeper()
+        n1 = ZkNode(zk, '/zkTestNode', 1,
+                    retry_policy=RetryPolicy(base_delay=0.001))
+        # The set goes through, but its reply is lost
+        zk.fail_next('set', applied=True)
+        try:
+            n1.update(lambda value: value + 1)
+        except zookeeper.ConnectionLossException:
+            pass
+        else:  # pragma: nocover
+            raise AssertionError("No error raised")
+        eq_(zk.get('/zkTestNode')[0], '2')
+        eq_(zk.counts['set'], 1)
+        zk.close()
+
+    @raises(zookeeper.BadVersionException)
+    def testUpdateAttempts(self):
+        n1 = self.makeOne('/zkTestNode', 1)
+
+        def increment(value):
+            self.conn.set('/zkTestNode', str(value + 10))
+            return value + 1
+        n1.update(increment, max_attempts=2)
+
+    def testSharedState(self):
+        from zktools.node import ZkNode
+        from zktools.testing import FakeZooKeeper
+        zk = FakeZooKeeper()
+        other = FakeZooKeeper(zk.server)
+        nodes = [ZkNode(zk, '/zkTestNode', 12) for x in range(10)]
+        eq_(zk.counts['get'], 1)
+        eq_(len(zk.server.data_watches['/zkTestNode']), 1)
+
+        # A change is read once and seen by every node
+        ZkNode(other, '/zkTestNode').value = 'fred'
+        time.sleep(0.1)
+        eq_([node.value for node in nodes], ['fred'] * 10)
+        eq_(zk.counts['get'], 2)
+        other.close()
+        zk.close()
+
+    def testDeleted(self):
+        from zktools.node import ZkNode
+        from zktools.testing import FakeZooKeeper
+        zk = FakeZooKeeper()
+        nodes = []
+        for x in range(50):
+            if zk.exists('/zkTestNode'):
+                zk.delete('/zkTestNode')
+            # The deletion may not have been seen by the nodes yet
+            nodes[:] = [ZkNode(zk, '/zkTestNode'), ZkNode(zk, '/zkTestNode')]
+            nodes[0].value = x
+            eq_(zk.get('/zkTestNode')[0], str(x))
+        zk.close()
+
+    def testSubscribe(self):
+        n1 = self.makeOne('/zkTestNode', 1)
+        n2 = self.makeOne('/zkTestNode')
+        vals = []
+        ev = threading.Event()
+
+        @n2.subscribe
+        def changed(value):
+            vals.append(value)
+            if value == 3:
+                ev.set()
+
+        n1.value = 2
+        time.sleep(0.1)
+        n1.value = 3
+        ev.wait(5)
+        eq_(vals, [1, 2, 3])
+
+        n2.unsubscribe(changed)
+        n1.value = 4
+        time.sleep(0.1)
+        eq_(vals, [1, 2, 3])
+
+    def testBlockedSubscriber(self):
+        from zktools.node import ZkNode
+        from zktools.testing import FakeZooKeeper
+        from zktools.util import Dispatcher
+        from zktools.util import get_callback_dispatcher
+        from zktools.util import get_dispatcher
+        from zktools.util import set_callback_dispatcher
+        from zktools.util import set_dispatcher
+        prior = get_dispatcher(), get_callback_dispatcher()
+        set_dispatcher(Dispatcher(max_workers=1))
+        set_callback_dispatcher(Dispatcher(max_workers=1))
+        zk = FakeZooKeeper()
+        other = FakeZooKeeper(zk.server)
+        blocked = threading.Event()
+        try:
+            slow = ZkNode(zk, '/zkTestSlow', 1)
+            fast = ZkNode(zk, '/zkTestFast', 1)
+            slow.subscribe(lambda value: value == 2 and blocked.wait(5))
+            ZkNode(other, '/zkTestSlow').value = 2
+            time.sleep(0.1)
+
+            # The subscriber holds the only callback worker, changes of
+            # other nodes are still read
+            ZkNode(other, '/zkTestFast').value = 2
+            deadline = time.time() + 2
+            while fast.value != 2 and time.time() < deadline:
+                time.sleep(0.01)
+            eq_(fast.value, 2)
+        finally:
+            blocked.set()
+            set_dispatcher(prior[0])
+            set_callback_dispatcher(prior[1])
+            other.close()
+            zk.close()
+
+    def testChildren(self):
+        n1 = self.makeOne('/zkTestNode')
+        eq_(list(n1.children), [])
+        calls = []
+        ev = threading.Event()
+
+        @n1.children
+        def changed(children):
+            calls.append(list(children))
+            if len(calls) == 3:
+                ev.set()
+
+        self.conn.create('/zkTestNode/b', '', [ZOO_OPEN_ACL_UNSAFE], 0)
+        time.sleep(0.1)
+        self.conn.create('/zkTestNode/a', '', [ZOO_OPEN_ACL_UNSAFE], 0)
+        ev.wait(5)
+        eq_(calls, [[], ['b'], ['a', 'b']])
+        self.assertTrue('a' in n1.children)
+        eq_(len(n1.children), 2)
+
+
+class TestCodecs(TestBase):
+    def makeOne(self, *args, **kwargs):
+        from zktools.node import ZkNode
+        return ZkNode(self.conn, '/zkTestNode', *args, **kwargs)
+
+    def setUp(self):
+        if self.conn.exists('/zkTestNode'):
+            self.conn.delete_recursive('/zkTestNode')
+
+    def testRaw(self):
+        from zktools.node import RAW_CODEC
+        n1 = self.makeOne('42', codec=RAW_CODEC)
+        eq_(n1.value, '42')
+        n1.value = 'true'
+        eq_(n1.value, 'true')
+
+    def testJson(self):
+        from zktools.node import JSON_CODEC
+        n1 = self.makeOne({'alpha': [1, 2]}, codec=JSON_CODEC)
+        eq_(self.conn.get('/zkTestNode')[0], '{"alpha":[1,2]}')
+        eq_(n1.value, {'alpha': [1, 2]})
+        n1.value = '12'
+        eq_(n1.value, '12')
+
+    def testCompressed(self):
+        from zktools.node import COMPRESSED_HEADER
+        from zktools.node import CompressedCodec
+        codec = CompressedCodec(min_size=100)
+        n1 = self.makeOne(['small'], codec=codec)
+        eq_(self.conn.get('/zkTestNode')[0], '["small"]')
+        value = dict(('key%s' % x, 'value') for x in range(100))
+        n1.value = value
+        data = self.conn.get('/zkTestNode')[0]
+        eq_(data[:1], COMPRESSED_HEADER)
+        self.assertTrue(len(data) < len(codec.codec.encode(value)))
+        eq_(n1.value, value)
+
+    def testMsgpack(self):
+        from zktools import node
+        if node.msgpack is None:
+            raise SkipTest("msgpack is not available")
+        n1 = self.makeOne([1, 2], codec=node.MsgpackCodec())
+        eq_(n1.value, [1, 2])
+
+
+class TestDecodedValueCache(unittest.TestCase):
+    def makeOne(self, *args, **kwargs):
+        from zktools.node import DecodedValueCache
+        return DecodedValueCache(*args, **kwargs)
+
+    def testCached(self):
+        from zktools.node import TEXT_JSON_CODEC
+        cache = self.makeOne()
+        value = cache.decode('{"alpha": 1}', TEXT_JSON_CODEC)
+        eq_(value, {'alpha': 1})
+        self.assertTrue(cache.decode('{"alpha": 1}', TEXT_JSON_CODEC)
+                        is value)
+        eq_(cache.decode('{"alpha": 1}'), '{"alpha": 1}')
+        stats = cache.stats()
+        eq_((stats['hits'], stats['misses'], stats['size']), (1, 2, 2))
+
+    def testLeastRecentlyUsed(self):
+        cache = self.makeOne(max_size=2)
+        cache.decode('1')
+        cache.decode('2')
+        cache.decode('1')
+        cache.decode('3')
+        cache.decode('1')
+        eq_(cache.stats()['hits'], 2)
+        cache.decode('2')
+        eq_(cache.stats()['misses'], 4)
+        eq_(cache.stats()['size'], 2)
+
+    def testSharedByNodes(self):
+        from zktools.node import ZkNode
+        from zktools.node import decoded_value_cache
+        from zktools.testing import FakeZooKeeper
+        zk = FakeZooKeeper()
+        cache = decoded_value_cache(zk)
+        nodes = [ZkNode(zk, '/zkTestNode%s' % x, '{"alpha": 1}',
+                        use_json=True) for x in range(5)]
+        eq_([node.value for node in nodes], [{'alpha': 1}] * 5)
+        eq_(cache.stats()['misses'], 1)
+        eq_(cache.stats()['hits'], 4)
+        zk.close()
+
+
+class TestNodeTree(TestBase):
+    def makeOne(self, *args, **kwargs):
+        from zktools.node import ZkNodeTree
+        return ZkNodeTree(self.conn, '/zkTestTree', *args, **kwargs)
+
+    def setUp(self):
+        if self.conn.exists('/zkTestTree'):
+            self.conn.delete_recursive('/zkTestTree')
+        for path, value in [('/zkTestTree', ''), ('/zkTestTree/db', ''),
+                            ('/zkTestTree/db/host', 'localhost'),
+                            ('/zkTestTree/db/port', '5432'),
+                            ('/zkTestTree/name', 'web')]:
+            self.conn.create(path, value, [ZOO_OPEN_ACL_UNSAFE], 0)
+
+    def testLoad(self):
+        tree = self.makeOne()
+        eq_(tree.keys(), ['', 'db', 'db/host', 'db/port', 'name'])
+        eq_(tree['db/host'], 'localhost')
+        eq_(tree['db/port'], 5432)
+        eq_(tree.get('db/user', 'nobody'), 'nobody')
+        eq_(tree.children(), ['db', 'name'])
+        eq_(tree.children('db'), ['host', 'port'])
+        self.assertTrue('db/port' in tree)
+        self.assertTrue(tree.last_modified('name') > 0)
+
+    @raises(KeyError)
+    def testMissingKey(self):
+        tree = self.makeOne()
+        tree['db/user']
+
+    def testRequestsPerLevel(self):
+        from zktools.node import ZkNodeTree
+        from zktools.testing import FakeZooKeeper
+        zk = FakeZooKeeper(latency=0.05)
+        zk.create('/zkTestTree', '', [ZOO_OPEN_ACL_UNSAFE], 0)
+        for x in range(20):
+            zk.create('/zkTestTree/%s' % x, str(x), [ZOO_OPEN_ACL_UNSAFE], 0)
+        start = time.time()
+        tree = ZkNodeTree(zk, '/zkTestTree')
+        # Two levels, read at once
+        self.assertTrue(time.time() - start < 0.5)
+        eq_(tree['19'], 19)
+        zk.close()
+
+    def testUpdates(self):
+        tree = self.makeOne()
+        self.conn.set('/zkTestTree/name', 'api')
+        self.conn.create('/zkTestTree/db/user', 'admin',
+                         [ZOO_OPEN_ACL_UNSAFE], 0)
+        self.conn.delete('/zkTestTree/db/port')
+        time.sleep(0.2)
+        eq_(tree['name'], 'api')
+        eq_(tree['db/user'], 'admin')
+        eq_(tree.children('db'), ['host', 'user'])
+        self.assertFalse('db/port' in tree)
@@ -0,0 +1,195 @@
+import threading
+import time
+import unittest
+
+try:
+    import zookeeper
+except ImportError:  # pragma: nocover
+    from zktools import _zkconsts as zookeeper
+from nose.tools import eq_
+from nose.tools import raises
+
+ZOO_OPEN_ACL_UNSAFE = dict(perms=0x1f, scheme='world', id='anyone')
+
+
+class TestFakeZooKeeper(unittest.TestCase):
+    def setUp(self):
+        from zktools.testing import FakeZooKeeperServer
+        self.server = FakeZooKeeperServer()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+
+    def makeOne(self, **kwargs):
+        from zktools.testing import FakeZooKeeper
+        client = FakeZooKeeper(self.server, **kwargs)
+        self.clients.append(client)
+        return client
+
+    def test_nodes(self):
+        zk = self.makeOne()
+        eq_(zk.create('/alpha', 'a', [ZOO_OPEN_ACL_UNSAFE]), '/alpha')
+        zk.create('/alpha/beta', 'b', [ZOO_OPEN_ACL_UNSAFE])
+        eq_(zk.get_children('/alpha'), ['beta'])
+        eq_(zk.get('/alpha/beta')[0], 'b')
+        eq_(zk.set('/alpha/beta', 'c'), zookeeper.OK)
+        data, stat = zk.get('/alpha/beta')
+        eq_(data, 'c')
+        eq_(stat['version'], 1)
+        eq_(zk.exists('/alpha')['numChildren'], 1)
+        eq_(zk.exists('/gamma'), None)
+        zk.delete_recursive('/alpha')
+        eq_(zk.exists('/alpha'), None)
+
+    def test_errors(self):
+        zk = self.makeOne()
+        zk.create('/alpha', 'a', [ZOO_OPEN_ACL_UNSAFE])
+        zk.create('/alpha/beta', 'b', [ZOO_OPEN_ACL_UNSAFE])
+
+        @raises(zookeeper.NodeExistsException)
+        def create():
+            zk.create('/alpha', 'a', [ZOO_OPEN_ACL_UNSAFE])
+
+        @raises(zookeeper.NoNodeException)
+        def create_orphan():
+            zk.create('/gamma/delta', 'a', [ZOO_OPEN_ACL_UNSAFE])
+
+        @raises(zookeeper.NotEmptyException)
+        def delete():
+            zk.delete('/alpha')
+
+        @raises(zookeeper.BadVersionException)
+        def set():
+            zk.set('/alpha', 'b', 3)
+
+        @raises(zookeeper.BadArgumentsException)
+        def get_malformed():
+            # Refused before sending, even with a completion
+            zk.aget('alpha/', None, lambda *args: None)
+        create()
+        create_orphan()
+        delete()
+        set()
+        get_malformed()
+
+    def test_sequence(self):
+        zk = self.makeOne()
+        zk.create('/alpha', 'a', [ZOO_OPEN_ACL_UNSAFE])
+        first = zk.create('/alpha/lock-', '', [ZOO_OPEN_ACL_UNSAFE],
+                          zookeeper.SEQUENCE)
+        zk.create('/alpha/other', '', [ZOO_OPEN_ACL_UNSAFE])
+        second = zk.create('/alpha/lock-', '', [ZOO_OPEN_ACL_UNSAFE],
+                           zookeeper.SEQUENCE)
+        eq_(first, '/alpha/lock-0000000000')
+        eq_(second, '/alpha/lock-0000000002')
+
+    def test_async(self):
+        zk = self.makeOne()
+        ev = threading.Event()
+        vals = []
+
+        def completion(handle, rc, value):
+            vals.append((rc, value))
+            if len(vals) == 2:
+                ev.set()
+
+        zk.acreate('/alpha', 'a', [ZOO_OPEN_ACL_UNSAFE], 0, completion)
+        zk.acreate('/alpha', 'a', [ZOO_OPEN_ACL_UNSAFE], 0, completion)
+        ev.wait(5)
+        eq_(vals, [(zookeeper.OK, '/alpha'), (zookeeper.NODEEXISTS, None)])
+
+    def test_watches(self):
+        zk = self.makeOne()
+        other = self.makeOne()
+        ev = threading.Event()
+        events = []
+
+        def watcher(handle, type, state, path):
+            events.append((type, path))
+            ev.set()
+
+        zk.create('/alpha', 'a', [ZOO_OPEN_ACL_UNSAFE])
+        zk.get_children('/alpha', watcher)
+        other.create('/alpha/beta', 'b', [ZOO_OPEN_ACL_UNSAFE])
+        ev.wait(5)
+        eq_(events, [(zookeeper.CHILD_EVENT, '/alpha')])
+
+        # Watches only fire once
+        ev.clear()
+        zk.exists('/gamma', watcher)
+        other.create('/alpha/delta', 'b', [ZOO_OPEN_ACL_UNSAFE])
+        other.create('/gamma', 'c', [ZOO_OPEN_ACL_UNSAFE])
+        ev.wait(5)
+        eq_(events[1:], [(zookeeper.CREATED_EVENT, '/gamma')])
+
+    def test_expire_session(self):
+        zk = self.makeOne()
+        other = self.makeOne()
+        ev = threading.Event()
+        events = []
+
+        def watcher(handle, type, state, path):
+            events.append((type, state))
+            ev.set()
+
+        zk.create('/alpha', 'a', [ZOO_OPEN_ACL_UNSAFE], zookeeper.EPHEMERAL)
+        zk.exists('/alpha', watcher)
+        handle = zk.handle
+        zk.expire_session()
+        ev.wait(5)
+        eq_(events, [(zookeeper.SESSION_EVENT,
+                      zookeeper.EXPIRED_SESSION_STATE)])
+        eq_(other.exists('/alpha'), None)
+        self.assertNotEqual(zk.handle, handle)
+
+    def test_disconnect(self):
+        zk = self.makeOne()
+        zk.disconnect()
+
+        @raises(zookeeper.ConnectionLossException)
+        def get():
+            zk.get_children('/')
+        get()
+        zk.reconnect()
+        eq_(zk.get_children('/'), [])
+
+    def test_fail_next(self):
+        zk = self.makeOne()
+        zk.fail_next('create', applied=True)
+
+        @raises(zookeeper.ConnectionLossException)
+        def create():
+            zk.create('/alpha', 'a', [ZOO_OPEN_ACL_UNSAFE])
+        create()
+        eq_(zk.get('/alpha')[0], 'a')
+
+        zk.fail_next('get', zookeeper.OPERATIONTIMEOUT)
+
+        @raises(zookeeper.OperationTimeoutException)
+        def get():
+            zk.get('/alpha')
+        get()
+        eq_(zk.counts['create'], 1)
+        eq_(self.server.counts['get'], 2)
+
+    def test_latency(self):
+        zk = self.makeOne(latency=0.1)
+        ev = threading.Event()
+        vals = []
+
+        def completion(handle, rc, value):
+            vals.append(value)
+            if len(vals) == 5:
+                ev.set()
+
+        # Pipelined requests share the latency
+        start = time.time()
+        for x in range(5):
+            zk.acreate('/node%s' % x, '', [ZOO_OPEN_ACL_UNSAFE], 0,
+                       completion)
+        ev.wait(5)
+        elapsed = time.time() - start
+        eq_(len(vals), 5)
+        self.assertTrue(0.1 <= elapsed < 0.4)
@@ -0,0 +1,295 @@
+import threading
+import time
+import unittest
+
+from nose.tools import eq_
+try:
+    import zookeeper
+except ImportError:  # pragma: nocover
+    from zktools import _zkconsts as zookeeper
+
+from zktools.tests import TestBase
+
+ZOO_OPEN_ACL_UNSAFE = dict(perms=0x1f, scheme='world', id='anyone')
+
+
+class TestDispatcher(unittest.TestCase):
+    def makeOne(self, *args, **kwargs):
+        from zktools.util import Dispatcher
+        return Dispatcher(*args, **kwargs)
+
+    def test_runs_tasks(self):
+        dispatcher = self.makeOne()
+        ev = threading.Event()
+        vals = []
+
+        def task(val):
+            vals.append(val)
+            ev.set()
+
+        dispatcher.submit(None, task, 42)
+        ev.wait(5)
+        eq_(vals, [42])
+
+    def test_key_ordering(self):
+        dispatcher = self.makeOne(max_workers=4)
+        done = threading.Event()
+        running = []
+        vals = []
+
+        def task(val):
+            running.append(val)
+            assert len(running) == 1
+            time.sleep(0.01)
+            vals.append(val)
+            running.remove(val)
+            if len(vals) == 10:
+                done.set()
+
+        for x in range(10):
+            dispatcher.submit('lock', task, x)
+        done.wait(5)
+        eq_(vals, range(10))
+
+    def test_bounded_workers(self):
+        dispatcher = self.makeOne(max_workers=2)
+        release = threading.Event()
+        done = []
+
+        def task():
+            release.wait(5)
+            done.append(1)
+
+        for x in range(10):
+            dispatcher.submit(None, task)
+        stats = dispatcher.stats()
+        eq_(stats['workers'], 2)
+        eq_(stats['submitted'], 10)
+        self.assertTrue(dispatcher.queue_depth >= 8)
+        release.set()
+        while len(done) < 10:
+            time.sleep(0.01)
+        eq_(dispatcher.stats()['completed'], 10)
+
+    def test_task_errors_are_logged(self):
+        dispatcher = self.makeOne(max_workers=1)
+        ev = threading.Event()
+
+        def bad():
+            raise Exception("oops")
+
+        dispatcher.submit(None, bad)
+        dispatcher.submit(None, ev.set)
+        ev.wait(5)
+        eq_(ev.is_set(), True)
+
+    def test_submit_latest(self):
+        dispatcher = self.makeOne(max_workers=1)
+        release = threading.Event()
+        done = threading.Event()
+        vals = []
+
+        def task(val):
+            vals.append(val)
+            done.set()
+
+        dispatcher.submit('node', release.wait, 5)
+        for x in range(5):
+            dispatcher.submit_latest('node', task, x)
+        release.set()
+        done.wait(5)
+        time.sleep(0.05)
+        eq_(vals, [4])
+        eq_(dispatcher.stats()['coalesced'], 4)
+
+    def test_submit_later(self):
+        dispatcher = self.makeOne()
+        ev = threading.Event()
+        vals = []
+
+        def task(val):
+            vals.append(val)
+            if len(vals) == 2:
+                ev.set()
+
+        start = time.time()
+        dispatcher.submit_later(0.1, None, task, 2)
+        dispatcher.submit_later(0.05, None, task, 1)
+        ev.wait(5)
+        eq_(vals, [1, 2])
+        assert time.time() - start >= 0.1
+
+    def test_dispatched(self):
+        from zktools.util import dispatched
+        ev = threading.Event()
+
+        class Thing(object):
+            @dispatched
+            def callback(self, val):
+                self.val = val
+                ev.set()
+
+        thing = Thing()
+        thing.callback(3)
+        ev.wait(5)
+        eq_(thing.val, 3)
+
+
+class TestChildrenCache(TestBase):
+    def makeOne(self, *args, **kwargs):
+        from zktools.util import ChildrenCache
+        return ChildrenCache(self.conn, *args, **kwargs)
+
+    def setUp(self):
+        if self.conn.exists('/zkTestCache'):
+            self.conn.delete_recursive('/zkTestCache')
+        self.conn.create('/zkTestCache', '', [ZOO_OPEN_ACL_UNSAFE], 0)
+
+    def test_cached(self):
+        cache = self.makeOne()
+        children = cache.get('/zkTestCache')
+        eq_(children, [])
+        self.assertTrue(cache.get('/zkTestCache') is children)
+
+    def test_watch_invalidates(self):
+        cache = self.makeOne(transform=sorted)
+        eq_(cache.get('/zkTestCache'), [])
+        self.conn.create('/zkTestCache/b', '', [ZOO_OPEN_ACL_UNSAFE], 0)
+        self.conn.create('/zkTestCache/a', '', [ZOO_OPEN_ACL_UNSAFE], 0)
+        time.sleep(0.1)
+        eq_(cache.get('/zkTestCache'), ['a', 'b'])
+
+    def test_refresh(self):
+        cache = self.makeOne()
+        eq_(cache.get('/zkTestCache'), [])
+        self.conn.create('/zkTestCache/a', '', [ZOO_OPEN_ACL_UNSAFE], 0)
+        eq_(cache.get('/zkTestCache', refresh=True), ['a'])
+
+
+class TestKnownPaths(TestBase):
+    def test_known_paths(self):
+        from zktools.util import add_known_path
+        from zktools.util import forget_path
+        from zktools.util import is_known_path
+        eq_(is_known_path(self.conn, '/zkKnown'), False)
+        add_known_path(self.conn, '/zkKnown')
+        add_known_path(self.conn, '/zkKnown/child')
+        add_known_path(self.conn, '/zkKnownOther')
+        eq_(is_known_path(self.conn, '/zkKnown/child'), True)
+        forget_path(self.conn, '/zkKnown')
+        eq_(is_known_path(self.conn, '/zkKnown'), False)
+        eq_(is_known_path(self.conn, '/zkKnown/child'), False)
+        eq_(is_known_path(self.conn, '/zkKnownOther'), True)
+        forget_path(self.conn, '/zkKnownOther')
+
+
+class TestPipeline(unittest.TestCase):
+    def test_window(self):
+        from zktools.testing import FakeZooKeeper
+        from zktools.util import pipeline
+        zk = FakeZooKeeper(latency=0.05)
+        calls = [('aexists', ('/', None)) for x in range(30)]
+        start = time.time()
+        results = pipeline(zk, calls, window=10)
+        # Three rounds of ten requests
+        assert time.time() - start >= 0.15
+        eq_([result[0] for result in results], [zookeeper.OK] * 30)
+        zk.close()
+
+    def test_invalid_path(self):
+        from zktools.testing import FakeZooKeeper
+        from zktools.util import pipeline
+        zk = FakeZooKeeper()
+        results = pipeline(zk, [('aexists', ('/', None)),
+                                ('aexists', ('no/slash', None)),
+                                ('aexists', ('/', None))])
+        eq_([result[0] for result in results],
+            [zookeeper.OK, zookeeper.BADARGUMENTS, zookeeper.OK])
+        assert isinstance(results[1][1], zookeeper.BadArgumentsException)
+        zk.close()
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        from zktools.testing import FakeZooKeeper
+        self.zk = FakeZooKeeper()
+
+    def tearDown(self):
+        self.zk.close()
+
+    def makeOne(self, **kwargs):
+        from zktools.util import RetryPolicy
+        kwargs.setdefault('base_delay', 0.001)
+        kwargs.setdefault('max_delay', 0.01)
+        return RetryPolicy(**kwargs)
+
+    def test_backoff(self):
+        policy = self.makeOne(base_delay=0.1, max_delay=1.0)
+        delay = 0.1
+        for x in range(20):
+            next_delay = policy.backoff(delay)
+            assert 0.1 <= next_delay <= min(1.0, delay * 3)
+            delay = next_delay
+
+    def test_retries(self):
+        from zktools.util import safe_call
+        self.zk.fail_next('get_children', count=2)
+        eq_(safe_call(self.zk, 'get_children', '/',
+                      retry_policy=self.makeOne()), [])
+
+    def test_max_attempts(self):
+        from zktools.util import safe_call
+        self.zk.fail_next('get_children', count=3)
+        try:
+            safe_call(self.zk, 'get_children', '/',
+                      retry_policy=self.makeOne(max_attempts=3))
+        except zookeeper.ConnectionLossException:
+            pass
+        else:  # pragma: nocover
+            raise AssertionError("No error raised")
+        eq_(self.zk.counts['get_children'], 3)
+
+    def test_async_retries(self):
+        from zktools.util import async_call
+        self.zk.fail_next('get_children', count=2)
+        results = []
+        ev = threading.Event()
+
+        def completion(handle, return_code, *values):
+            results.append((return_code,) + values)
+            ev.set()
+        async_call(self.zk, 'aget_children', ('/', None), completion,
+                   retry_policy=self.makeOne())
+        ev.wait(5)
+        eq_(results, [(zookeeper.OK, [])])
+        eq_(self.zk.counts['get_children'], 3)
+
+    def test_async_max_attempts(self):
+        from zktools.util import async_call
+        self.zk.fail_next('get_children', count=3)
+        results = []
+        ev = threading.Event()
+
+        def completion(handle, return_code, *values):
+            results.append(return_code)
+            ev.set()
+        async_call(self.zk, 'aget_children', ('/', None), completion,
+                   retry_policy=self.makeOne(max_attempts=3))
+        ev.wait(5)
+        eq_(results, [zookeeper.CONNECTIONLOSS])
+        eq_(self.zk.counts['get_children'], 3)
+
+    def test_deadline(self):
+        state = self.makeOne(deadline=0.05).start()
+        self.zk.disconnect()
+        start = time.time()
+        eq_(state.wait(self.zk), False)
+        assert time.time() - start < 1
+
+    def test_budget(self):
+        from zktools.util import RetryBudget
+        budget = RetryBudget(rate=0, capacity=2)
+        state = self.makeOne(budget=budget).start()
+        eq_(state.wait(self.zk), True)
+        eq_(state.wait(self.zk), True)
+        eq_(state.wait(self.zk), False)
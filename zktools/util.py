@@ -2,16 +2,203 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 """Utility functions for Zookeeper"""
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
 import uuid
+import weakref
+from collections import deque
 from functools import wraps
 from threading import Thread
+from Queue import Queue
 
-import zookeeper
+try:
+    import zookeeper
+except ImportError:  # pragma: nocover
+    from zktools import _zkconsts as zookeeper
+
+from zktools import metrics
+
+log = logging.getLogger(__name__)
+
+
+# Errors after which a request may be retried once the connection is back
+RETRYABLE_ERRORS = (zookeeper.ClosingException,
+                    zookeeper.ConnectionLossException,
+                    zookeeper.OperationTimeoutException)
+
+# Return codes of asynchronous requests that may be retried
+RETRYABLE_CODES = (zookeeper.CONNECTIONLOSS, zookeeper.CLOSING,
+                   zookeeper.OPERATIONTIMEOUT)
+
+# Return codes of the errors raised by a request that can't be sent
+_ERROR_CODES = {
+    zookeeper.BadArgumentsException: zookeeper.BADARGUMENTS,
+    zookeeper.InvalidStateException: zookeeper.INVALIDSTATE,
+    zookeeper.SessionExpiredException: zookeeper.SESSIONEXPIRED,
+    zookeeper.NoAuthException: zookeeper.NOAUTH,
+}
+
+
+class RetryBudget(object):
+    """Limit on the rate of retries shared by many requests
+
+    The budget holds up to ``capacity`` retries and regains ``rate`` of
+    them per second. Once it runs out, failing requests give up rather
+    than retrying, so a struggling ensemble isn't flooded with retries.
+
+    """
+    def __init__(self, rate=10.0, capacity=100):
+        """Create a retry budget
+
+        :param rate: Retries regained per second
+        :type rate: float
+        :param capacity: Most retries that can be saved up
+        :type capacity: int
+
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def withdraw(self):
+        """Take a retry from the budget, returning False if none are
+        left"""
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.capacity, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RetryPolicy(object):
+    """Policy for retrying Zookeeper requests after connection loss
+
+    Waits between attempts grow exponentially with decorrelated jitter:
+    each delay is picked at random between ``base_delay`` and three
+    times the prior delay, capped at ``max_delay``. This spreads out the
+    retries of many clients that lost their connection at the same time.
+
+    Example::
+
+        policy = RetryPolicy(max_attempts=5, deadline=10,
+                             budget=RetryBudget(rate=5))
+        safe_call(zk, 'get', '/some/node', retry_policy=policy)
+        lock = ZkLock(zk, 'my_lock', retry_policy=policy)
+
+    """
+    def __init__(self, max_attempts=None, deadline=None, base_delay=0.05,
+                 max_delay=5.0, budget=None):
+        """Create a retry policy
+
+        :param max_attempts: Most attempts to make, including the first,
+                             defaults to trying until successful
+        :type max_attempts: int
+        :param deadline: Seconds after the first attempt to give up after
+        :type deadline: float
+        :param base_delay: Shortest wait between attempts, in seconds
+        :type base_delay: float
+        :param max_delay: Longest wait between attempts, in seconds
+        :type max_delay: float
+        :param budget: Retry budget shared with other policies
+        :type budget: :class:`RetryBudget`
+
+        """
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+
+    def backoff(self, delay):
+        """Return the delay to use after the given prior delay"""
+        return min(self.max_delay,
+                   random.uniform(self.base_delay, delay * 3))
+
+    def start(self):
+        """Return a :class:`RetryState` for a new request"""
+        return RetryState(self)
+
+
+class RetryState(object):
+    """Retries made so far by a single request"""
+    def __init__(self, policy):
+        self.policy = policy
+        self.attempts = 1
+        self.delay = policy.base_delay
+        self.started = time.time()
+
+    def remaining(self):
+        """Seconds left before the deadline, or None without one"""
+        if self.policy.deadline is None:
+            return None
+        return self.started + self.policy.deadline - time.time()
+
+    def next_delay(self):
+        """Count a failed attempt and return how long to wait before the
+        next one, or None to give up"""
+        policy = self.policy
+        if policy.max_attempts is not None and \
+           self.attempts >= policy.max_attempts:
+            return None
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            return None
+        if policy.budget is not None and not policy.budget.withdraw():
+            return None
+        self.attempts += 1
+        self.delay = policy.backoff(self.delay)
+        if remaining is not None:
+            return min(self.delay, remaining)
+        return self.delay
+
+    def wait(self, zk):
+        """Wait until the next attempt should be made
+
+        Waits for the connection to return, then for the backoff delay.
+
+        :returns: False if the request should give up instead
+        :rtype: bool
+
+        """
+        delay = self.next_delay()
+        if delay is None:
+            return False
+        zk.connected.wait(self.remaining())
+        if not zk.connected.is_set():
+            return False
+        remaining = self.remaining()
+        if remaining is not None:
+            delay = min(delay, max(remaining, 0))
+        time.sleep(delay)
+        return True
+
+
+# Retry until successful, spacing out the attempts
+DEFAULT_RETRY_POLICY = RetryPolicy()
 
 
 def safe_call(zk, func, *args, **kwargs):
     """Safely call a function while handling connection loss
 
+    :param zk: Zookeeper instance
+    :param func: Name of the method to call
+    :type func: str
+    :param retry_policy: Keyword argument for the policy to retry with,
+                         :obj:`DEFAULT_RETRY_POLICY` by default
+    :type retry_policy: :class:`RetryPolicy`
+
+    The remaining arguments are passed to the method.
+
     .. note::
 
         This function merely retries the query until an active
@@ -20,17 +207,54 @@ def safe_call(zk, func, *args, **kwargs):
         result in a NodeAlreadyExists exception because the create
         ran twice.
 
+    When the retry policy gives up, the last connection loss exception
+    is raised.
+
     """
+    policy = kwargs.pop('retry_policy', None) or DEFAULT_RETRY_POLICY
+    if metrics.hook is not None:
+        return _recorded_safe_call(metrics.hook, zk, func, args, kwargs,
+                                   policy)
+    retries = None
     while 1:
         try:
             return getattr(zk, func)(*args, **kwargs)
-        except (zookeeper.ClosingException,
-                zookeeper.ConnectionLossException,
-                zookeeper.OperationTimeoutException):
-            zk.connected.wait()
+        except RETRYABLE_ERRORS:
+            if retries is None:
+                retries = policy.start()
+            if not retries.wait(zk):
+                raise
 
 
-def safe_create_ephemeral_sequence(zk, name, data, acl):
+def _recorded_safe_call(hook, zk, func, args, kwargs, policy):
+    """:func:`safe_call` reporting to a metrics hook"""
+    path = args and isinstance(args[0], str) and args[0] or ''
+    retries = None
+    wait = 0.0
+    start = time.time()
+    while 1:
+        try:
+            result = getattr(zk, func)(*args, **kwargs)
+        except RETRYABLE_ERRORS as exc:
+            if retries is None:
+                retries = policy.start()
+            wait_start = time.time()
+            if not retries.wait(zk):
+                hook.record(func, path, time.time() - start,
+                            retries.attempts - 1, wait, exc)
+                raise
+            wait += time.time() - wait_start
+        except Exception as exc:
+            hook.record(func, path, time.time() - start,
+                        retries and retries.attempts - 1 or 0, wait, exc)
+            raise
+        else:
+            hook.record(func, path, time.time() - start,
+                        retries and retries.attempts - 1 or 0, wait)
+            return result
+
+
+def safe_create_ephemeral_sequence(zk, name, data, acl, retry_policy=None):
     """Safely creates an ephemeral sequence node using a UUID prefix
 
     This function properly handles zookeeper ConnectionLoss exceptions
@@ -41,6 +265,9 @@ def safe_create_ephemeral_sequence(zk, name, data, acl):
     :param name: Name of the node, it will be prefixed by the UUID
     :param data: Data to set on the node
     :param acl: ACL to set for the node
+    :param retry_policy: Policy to retry with after connection loss,
+                         :obj:`DEFAULT_RETRY_POLICY` by default
+    :type retry_policy: :class:`RetryPolicy`
     :returns: Name of the created node
 
     The name will be split so that its prefixed by the UUID and
@@ -55,24 +282,365 @@ def safe_create_ephemeral_sequence(zk, name, data, acl):
         '/path/to/node/dfad3fa294d745e499d883b0a38bbc93-myname-0001'
 
     """
+    policy = retry_policy or DEFAULT_RETRY_POLICY
     prefix = uuid.uuid4().hex + '-'
     path, node_name = name.rsplit('/', 1)
     node_name = '/'.join([path, prefix + node_name + '-'])
+    hook = metrics.hook
+    if hook is not None:
+        start = time.time()
+    retries = None
 
     while 1:
         try:
-            return zk.create(node_name, data, acl,
-                             zookeeper.EPHEMERAL | zookeeper.SEQUENCE)
-        except (zookeeper.ClosingException,
-                zookeeper.ConnectionLossException,
-                zookeeper.OperationTimeoutException):
+            created = zk.create(node_name, data, acl,
+                                zookeeper.EPHEMERAL | zookeeper.SEQUENCE)
+            break
+        except RETRYABLE_ERRORS as exc:
+            if retries is None:
+                retries = policy.start()
+            if not retries.wait(zk):
+                if hook is not None:
+                    hook.record('create_ephemeral_sequence', path,
+                                time.time() - start, retries.attempts - 1,
+                                error=exc)
+                raise
             # Check children to see if the node was created
-            children = safe_call(zk, 'get_children', path)
+            children = safe_call(zk, 'get_children', path,
+                                 retry_policy=policy)
             created = [x for x in children if x.startswith(prefix)]
             if created:
-                return '/'.join([path, created[0]])
+                created = '/'.join([path, created[0]])
+                break
             # We've verified the create failed, retry
             continue
+        except Exception as exc:
+            if hook is not None:
+                hook.record('create_ephemeral_sequence', path,
+                            time.time() - start,
+                            retries and retries.attempts - 1 or 0, error=exc)
+            raise
+    if hook is not None:
+        hook.record('create_ephemeral_sequence', path, time.time() - start,
+                    retries and retries.attempts - 1 or 0)
+    return created
+
+
+_known_paths = weakref.WeakKeyDictionary()
+_known_paths_lock = threading.Lock()
+
+
+def _session_paths(zk):
+    """Return the known paths of the current session of a connection"""
+    handle = getattr(zk, 'handle', None)
+    known = _known_paths.get(zk)
+    if known is None or known[0] != handle:
+        # New session, nothing is known about it
+        known = _known_paths[zk] = (handle, set())
+    return known[1]
+
+
+def is_known_path(zk, path):
+    """Indicate whether a persistent node is known to exist
+
+    Lock and node objects record the persistent nodes they've created or
+    found, so that creating many objects for the same path only checks
+    for the node once per Zookeeper session.
+
+    :param zk: Zookeeper instance
+    :param path: Path to the node
+    :type path: str
+    :rtype: bool
+
+    """
+    with _known_paths_lock:
+        return path in _session_paths(zk)
+
+
+def add_known_path(zk, path):
+    """Record that a persistent node exists
+
+    :param zk: Zookeeper instance
+    :param path: Path to the node
+    :type path: str
+
+    """
+    with _known_paths_lock:
+        if getattr(zk, 'handle', None) is not None:
+            _session_paths(zk).add(path)
+
+
+def forget_path(zk, path):
+    """Forget about a node, and all nodes under it
+
+    This should be called when an operation fails with a NoNode error
+    for a path that was known to exist.
+
+    :param zk: Zookeeper instance
+    :param path: Path to the node
+    :type path: str
+
+    """
+    with _known_paths_lock:
+        known = _session_paths(zk)
+        prefix = path + '/'
+        for known_path in [x for x in known
+                           if x == path or x.startswith(prefix)]:
+            known.discard(known_path)
+
+
+def pipeline(zk, calls, window=None):
+    """Run asynchronous Zookeeper calls concurrently and wait for them all
+
+    Rather than paying a round-trip per call, all of the calls are sent
+    at once and their completions are collected.
+
+    :param zk: Zookeeper instance
+    :param calls: Calls to make, each a tuple of the asynchronous method
+                  name and its arguments without the completion callback
+    :type calls: list
+    :param window: Maximum number of calls waiting for their completion
+                   at a time, calls are all sent at once by default.
+    :type window: int
+    :returns: A tuple per call of the return code followed by the values
+              passed to its completion, in the same order as the calls.
+              A call that couldn't be sent has the return code of its
+              error followed by the exception raised.
+    :rtype: list
+
+    Example:
+
+    .. code-block:: pycon
+
+        >>> pipeline(zk, [('aget_children', ('/locks/a', None)),
+                          ('aget_children', ('/locks/b', None))])
+        [(0, ['dfad3fa294d745e499d883b0a38bbc93-lock-0000000001']), (0, [])]
+
+    .. warning::
+
+        This blocks until all the completions have been called, and
+        must not be called from a Zookeeper callback.
+
+    """
+    results = [None] * len(calls)
+    pending = [len(calls)]
+    cv = threading.Condition()
+
+    def completion(index):
+        def callback(handle, return_code, *values):
+            results[index] = (return_code,) + values
+            with cv:
+                pending[0] -= 1
+                if not pending[0] or window:
+                    cv.notify()
+        return callback
+
+    for index, (func, args) in enumerate(calls):
+        if window:
+            with cv:
+                # Calls sent minus calls completed
+                while index - (len(calls) - pending[0]) >= window:
+                    cv.wait()
+        callback = completion(index)
+        if metrics.hook is not None:
+            callback = metrics.timed_completion(func, args[0], callback)
+        try:
+            getattr(zk, func)(*(tuple(args) + (callback,)))
+        except (zookeeper.ClosingException,
+                zookeeper.ConnectionLossException,
+                zookeeper.OperationTimeoutException):
+            completion(index)(None, zookeeper.CONNECTIONLOSS)
+        except Exception as exc:
+            # The call couldn't be sent, such as for a malformed path
+            completion(index)(None, _ERROR_CODES.get(
+                type(exc), zookeeper.APIERROR), exc)
+
+    with cv:
+        while pending[0]:
+            cv.wait()
+    return results
+
+
+def async_call(zk, func, args, completion, retry_policy=None):
+    """Make an asynchronous Zookeeper call, retrying it after connection
+    loss without waiting for it
+
+    Unlike :func:`safe_call`, no thread is held while the request is
+    outstanding or waiting to be retried, which makes it suitable for
+    work run on the :class:`Dispatcher`. Retries are submitted to the
+    process-wide dispatcher once the retry policy's backoff has passed.
+
+    :param zk: Zookeeper instance
+    :param func: Name of the asynchronous method to call
+    :type func: str
+    :param args: Arguments of the method, without the completion callback
+    :type args: tuple
+    :param completion: Zookeeper completion callback, called once with
+                       the handle, the return code and the values of the
+                       last attempt. It must not block.
+    :param retry_policy: Policy to retry with after connection loss,
+                         :obj:`DEFAULT_RETRY_POLICY` by default
+    :type retry_policy: :class:`RetryPolicy`
+
+    Example:
+
+    .. code-block:: python
+
+        def loaded(handle, return_code, data, stat):
+            if return_code == zookeeper.OK:
+                print data
+
+        async_call(zk, 'aget', ('/my/node', watcher), loaded)
+
+    """
+    policy = retry_policy or DEFAULT_RETRY_POLICY
+    retries = []
+
+    def callback(handle, return_code, *values):
+        if return_code in RETRYABLE_CODES:
+            if not retries:
+                retries.append(policy.start())
+            delay = retries[0].next_delay()
+            if delay is not None:
+                get_dispatcher().submit_later(delay, None, attempt)
+                return
+        completion(handle, return_code, *values)
+
+    def attempt():
+        wrapped = callback
+        if metrics.hook is not None:
+            wrapped = metrics.timed_completion(func, args[0], callback)
+        try:
+            getattr(zk, func)(*(tuple(args) + (wrapped,)))
+        except RETRYABLE_ERRORS:
+            callback(getattr(zk, 'handle', None), zookeeper.CONNECTIONLOSS)
+
+    attempt()
+
+
+class ChildrenCache(object):
+    """Watch-driven cache of the children of Zookeeper nodes
+
+    The children of a path are loaded once with a child watch set, and
+    served from memory until the watch fires. Concurrent loads of the
+    same path are collapsed into a single ``get_children`` call, so
+    many lock objects in a process waking up at once cost a single
+    round-trip.
+
+    Cached entries are dropped when their watch fires, on session
+    events, and when the connection's session handle changes.
+
+    Example::
+
+        cache = ChildrenCache(zk, transform=sorted)
+        children = cache.get('/ZktoolsLocks/my_lock')
+
+    """
+    def __init__(self, connection, transform=list):
+        """Create a ChildrenCache
+
+        :param connection: Zookeeper connection object
+        :type connection: zc.zk Zookeeper instance
+        :param transform: Function called with the list of children,
+                          its result is what gets cached.
+
+        """
+        self._zk = connection
+        self._transform = transform
+        self._cv = threading.Condition()
+        self._handle = getattr(connection, 'handle', None)
+        self._entries = {}
+        self._generation = {}
+        self._loading = set()
+        self._watched = set()
+
+    def get(self, path, refresh=False):
+        """Return the (transformed) children of a path
+
+        :param path: Path to the node
+        :type path: str
+        :param refresh: Whether to ignore a cached value and load the
+                        children from Zookeeper
+        :type refresh: bool
+
+        .. note::
+
+            The returned value is shared, and must not be modified.
+
+        """
+        with self._cv:
+            self._check_handle()
+            while 1:
+                if not refresh and path in self._entries:
+                    return self._entries[path]
+                if path not in self._loading:
+                    break
+                # Someone else is loading, their result will do
+                self._cv.wait()
+                refresh = False
+            self._loading.add(path)
+            generation = self._generation.get(path, 0)
+            watcher = self._watcher
+            if path in self._watched:
+                # Don't pile up watches for a path already watched
+                watcher = None
+            else:
+                self._watched.add(path)
+
+        loaded = False
+        try:
+            children = safe_call(self._zk, 'get_children', path, watcher)
+            value = self._transform(children)
+            loaded = True
+        finally:
+            with self._cv:
+                self._loading.discard(path)
+                if not loaded and watcher is not None:
+                    self._watched.discard(path)
+                elif loaded and generation == self._generation.get(path, 0):
+                    self._entries[path] = value
+                self._cv.notify_all()
+        return value
+
+    def invalidate(self, path=None):
+        """Drop the cached children of a path, or of all paths
+
+        :param path: Path to drop, or None to drop every entry
+
+        """
+        with self._cv:
+            if path is None:
+                self._clear()
+            else:
+                self._entries.pop(path, None)
+                self._generation[path] = self._generation.get(path, 0) + 1
+
+    def _clear(self):
+        for path in self._entries:
+            self._generation[path] = self._generation.get(path, 0) + 1
+        for path in self._loading:
+            self._generation[path] = self._generation.get(path, 0) + 1
+        self._entries.clear()
+
+    def _check_handle(self):
+        handle = getattr(self._zk, 'handle', None)
+        if handle != self._handle:
+            # New session, the prior watches are gone
+            self._handle = handle
+            self._watched.clear()
+            self._clear()
+
+    def _watcher(self, handle, type, state, path):
+        # Runs in the Zookeeper event thread, so no Zookeeper calls
+        with self._cv:
+            if type == zookeeper.SESSION_EVENT:
+                if state != zookeeper.CONNECTED_STATE:
+                    self._watched.clear()
+                    self._clear()
+                return
+            self._watched.discard(path)
+            self._entries.pop(path, None)
+            self._generation[path] = self._generation.get(path, 0) + 1
 
 
 def threaded(func):
@@ -104,3 +672,309 @@ def threaded(func):
         func_hl.start()
         return func_hl
     return threaded_func
+
+
+class Dispatcher(object):
+    """Bounded thread-pool that runs Zookeeper callbacks
+
+    Zookeeper completion and watch callbacks must not block the
+    Zookeeper event thread, so they are handed off to a small, fixed
+    number of worker threads rather than a new thread per event.
+
+    Tasks submitted with the same ``key`` are run one at a time in
+    the order they were submitted, while tasks with different keys
+    (or no key at all) may run concurrently.
+
+    Example::
+
+        dispatcher = Dispatcher(max_workers=4)
+        dispatcher.submit(my_lock, my_lock.callback, 'arg')
+
+        # Report queue depth and task latencies
+        print dispatcher.stats()
+
+    .. note::
+
+        Tasks should not block for long periods, as every blocked
+        task holds one of the ``max_workers`` threads. Zookeeper
+        requests made by tasks should use :func:`async_call`, and
+        user callbacks run on :func:`get_callback_dispatcher`.
+
+    """
+    def __init__(self, max_workers=8, name='zktools-dispatcher'):
+        """Create a Dispatcher
+
+        :param max_workers: Maximum amount of worker threads to start
+        :type max_workers: int
+        :param name: Prefix for the worker thread names
+        :type name: str
+
+        """
+        self.max_workers = max_workers
+        self.name = name
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._strands = {}
+        self._workers = []
+        self._idle = 0
+        self._ready = 0
+        self._depth = 0
+        self._submitted = 0
+        self._completed = 0
+        self._coalesced = 0
+        self._latest = {}
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._run_time = 0.0
+        self._max_run_time = 0.0
+        self._timers = []
+        self._timer_ids = itertools.count()
+        self._timer_cv = threading.Condition()
+        self._timer_thread = None
+
+    def submit(self, key, func, *args, **kwargs):
+        """Submit a function to be run by a worker thread
+
+        :param key: Ordering key, functions submitted with the same key
+                    never run concurrently and run in submission order.
+                    Use None for functions without ordering constraints.
+        :param func: Function to run, it will be called with the
+                     remaining positional and keyword arguments.
+
+        """
+        task = (key, func, args, kwargs, time.time())
+        with self._lock:
+            self._submitted += 1
+            self._depth += 1
+            if key is not None:
+                pending = self._strands.get(key)
+                if pending is not None:
+                    # Another task for this key is queued or running
+                    pending.append(task)
+                    return
+                self._strands[key] = deque()
+            self._ready += 1
+            if self._ready > self._idle and \
+               len(self._workers) < self.max_workers:
+                self._start_worker()
+        self._queue.put(task)
+
+    def submit_latest(self, key, func, *args, **kwargs):
+        """Submit a function, replacing the arguments of a call to it
+        submitted with the same key that hasn't started yet
+
+        Rapid successive updates collapse into a single call with the
+        latest arguments, rather than queueing a call for each of them.
+
+        The arguments are the same as :meth:`submit`.
+
+        """
+        with self._lock:
+            pending = self._latest.get((key, func))
+            if pending is not None:
+                pending[:] = [args, kwargs]
+                self._coalesced += 1
+                return
+            pending = self._latest[(key, func)] = [args, kwargs]
+        self.submit(key, self._run_latest, key, func, pending)
+
+    def _run_latest(self, key, func, pending):
+        with self._lock:
+            if self._latest.get((key, func)) is pending:
+                del self._latest[(key, func)]
+            args, kwargs = pending
+        func(*args, **kwargs)
+
+    def submit_later(self, delay, key, func, *args, **kwargs):
+        """Submit a function once a delay has passed
+
+        Waiting for the delay doesn't hold a worker thread.
+
+        :param delay: Seconds to wait before submitting the function
+        :type delay: float
+
+        The remaining arguments are the same as :meth:`submit`.
+
+        """
+        timer = (time.time() + delay, next(self._timer_ids), key, func,
+                 args, kwargs)
+        with self._timer_cv:
+            heapq.heappush(self._timers, timer)
+            if self._timer_thread is None:
+                self._timer_thread = Thread(target=self._run_timers,
+                                            name='%s-timer' % self.name)
+                self._timer_thread.daemon = True
+                self._timer_thread.start()
+            self._timer_cv.notify()
+
+    def _run_timers(self):
+        while 1:
+            with self._timer_cv:
+                while 1:
+                    if not self._timers:
+                        self._timer_cv.wait()
+                        continue
+                    due = self._timers[0][0] - time.time()
+                    if due <= 0:
+                        break
+                    self._timer_cv.wait(due)
+                timer = heapq.heappop(self._timers)
+            self.submit(timer[2], timer[3], *timer[4], **timer[5])
+
+    def _start_worker(self):
+        worker = Thread(target=self._work,
+                        name='%s-%s' % (self.name, len(self._workers)))
+        worker.daemon = True
+        self._workers.append(worker)
+        self._idle += 1
+        worker.start()
+
+    def _work(self):
+        while 1:
+            key, func, args, kwargs, queued = self._queue.get()
+            started = time.time()
+            with self._lock:
+                self._idle -= 1
+                self._ready -= 1
+                self._depth -= 1
+                wait = started - queued
+                self._wait_time += wait
+                if wait > self._max_wait_time:
+                    self._max_wait_time = wait
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                log.exception("Error running dispatched function %r", func)
+            finished = time.time()
+            with self._lock:
+                self._completed += 1
+                run = finished - started
+                self._run_time += run
+                if run > self._max_run_time:
+                    self._max_run_time = run
+                self._idle += 1
+                if key is not None:
+                    pending = self._strands[key]
+                    if pending:
+                        self._ready += 1
+                        self._queue.put(pending.popleft())
+                    else:
+                        del self._strands[key]
+            # Don't keep the last task alive while waiting for the next
+            key = func = args = kwargs = pending = None
+
+    @property
+    def queue_depth(self):
+        """Amount of submitted tasks that haven't started yet"""
+        return self._depth
+
+    def stats(self):
+        """Return a dict of counters for this dispatcher
+
+        The counters include the number of ``workers``, the current
+        ``queue_depth``, the amount of ``submitted`` and ``completed``
+        tasks, the amount of calls ``coalesced`` by
+        :meth:`submit_latest`, and the average and maximum seconds spent
+        waiting in the queue (``avg_wait``, ``max_wait``) and running
+        (``avg_run``, ``max_run``).
+
+        """
+        with self._lock:
+            completed = self._completed or 1
+            return dict(workers=len(self._workers),
+                        queue_depth=self._depth,
+                        submitted=self._submitted,
+                        completed=self._completed,
+                        coalesced=self._coalesced,
+                        avg_wait=self._wait_time / completed,
+                        max_wait=self._max_wait_time,
+                        avg_run=self._run_time / completed,
+                        max_run=self._max_run_time)
+
+
+_dispatcher = []
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """Return the process-wide :class:`Dispatcher`
+
+    The dispatcher is created on first use.
+
+    """
+    if not _dispatcher:
+        with _dispatcher_lock:
+            if not _dispatcher:
+                _dispatcher.append(Dispatcher())
+    return _dispatcher[0]
+
+
+def set_dispatcher(dispatcher):
+    """Replace the process-wide :class:`Dispatcher`
+
+    Tasks already submitted to the prior dispatcher will still run
+    on it.
+
+    :param dispatcher: The dispatcher to use from now on
+    :type dispatcher: :class:`Dispatcher`
+
+    """
+    with _dispatcher_lock:
+        del _dispatcher[:]
+        _dispatcher.append(dispatcher)
+
+
+def dispatched(func):
+    """Decorator to run a method on the process-wide :class:`Dispatcher`
+
+    Calls for the same instance are run in order and never
+    concurrently, which makes it suitable for the callbacks of a
+    single lock object.
+
+    :param func: Method to run on the dispatcher
+
+    Example::
+
+        class Watcher(object):
+            @dispatched
+            def callback(self, handle, type, state, path):
+                do_something
+
+    """
+    @wraps(func)
+    def dispatched_func(self, *args, **kwargs):
+        get_dispatcher().submit(self, func, self, *args, **kwargs)
+    return dispatched_func
+
+
+_callback_dispatcher = []
+
+
+def get_callback_dispatcher():
+    """Return the process-wide :class:`Dispatcher` for user callbacks
+
+    Functions given to zktools, such as :class:`~zktools.node.ZkNode`
+    subscribers and :class:`~zktools.locking.ZkAsyncLock` callbacks, and
+    other work that may block for long, run on this dispatcher. A slow
+    callback then can't hold up the Zookeeper events handled by
+    :func:`get_dispatcher`. It's created on first use.
+
+    """
+    if not _callback_dispatcher:
+        with _dispatcher_lock:
+            if not _callback_dispatcher:
+                _callback_dispatcher.append(
+                    Dispatcher(name='zktools-callbacks'))
+    return _callback_dispatcher[0]
+
+
+def set_callback_dispatcher(dispatcher):
+    """Replace the process-wide :class:`Dispatcher` for user callbacks
+
+    :param dispatcher: The dispatcher to use from now on
+    :type dispatcher: :class:`Dispatcher`
+
+    """
+    with _dispatcher_lock:
+        del _callback_dispatcher[:]
+        _callback_dispatcher.append(dispatcher)